@@ -1,29 +1,86 @@
+import contextlib
 import glob
 import io
 import os
 import re
+import shutil
 import sys
+import tempfile
+from collections import namedtuple
 from datetime import datetime, timedelta
 from io import TextIOWrapper
 from pathlib import Path
 from typing import List, Optional
 
-import ccsdspy
+import numpy as np
 import typer
-from ccsdspy import PacketField
-from ccsdspy.utils import iter_packet_bytes
 from click.exceptions import Exit
 from rich.progress import Progress, track
 
 from constants import CONSTANTS
-from packet_util import get_imap_basic_packet_def, parse_apids
+from packet_dedupe import (
+    DEDUPE_WINDOW_HELP,
+    KEY_STORE_SUFFIX,
+    NO_VALUE,
+    PacketKeySet,
+    PacketKeyStore,
+    packet_digests,
+)
+from packet_index import (
+    INDEX_CACHE_SUFFIX,
+    PacketFileReader,
+    PacketIndex,
+    append_file,
+    discard_preloaded_indexes,
+    open_for_append,
+    preload_packet_indexes,
+    read_packet_file,
+    read_packet_lengths,
+    write_packets,
+)
+from packet_sort import (
+    DEFAULT_MAX_MEMORY,
+    MAX_MEMORY_HELP,
+    OUTPUT_BUFFER_BYTES,
+    parse_memory_size,
+    sort_packet_file,
+    write_packets_from_files,
+)
+from packet_util import parse_apids
+from parallel import create_process_pool, resolve_jobs, validate_jobs
 
 app = typer.Typer()
 
 packet_counter = 0
 is_multi_file = False
-unique_packets = set()
+unique_packets = PacketKeySet()
 needs_sort = False
+# with --sort-packets into an empty output file, the packets selected from each input
+# file are only written once they have all been seen, so they can be sorted on the way
+sort_in_one_pass = False
+packets_to_sort: list[tuple[Path, PacketIndex]] = []
+# with --check-conflicts, the packets kept are remembered by where they were found - the
+# number of the file in checked_files and the offset in it - so later duplicates can
+# be compared to them
+checked_files: list[Path] = []
+LOCATION_OFFSET_BITS = 40
+
+# the packets of one file chosen by _select_packets_to_filter - selected are the
+# positions matching the ApID filters (up to the limit), saved the positions of the
+# packets to save, and counter the number of packets saved so far in the run
+FilterSelection = namedtuple(
+    "FilterSelection",
+    [
+        "selected",
+        "is_new",
+        "is_conflict",
+        "saved",
+        "considered_packets",
+        "processed_bytes",
+        "limit_reached",
+        "counter",
+    ],
+)
 
 
 @app.callback(
@@ -62,14 +119,53 @@ def filter_packets(
         "-s",
         help="Sort packets by SHCOARSE, APID, SEQ COUNT in the outputted file",
     ),
+    max_memory: str = typer.Option(
+        DEFAULT_MAX_MEMORY,
+        "--max-memory",
+        help=MAX_MEMORY_HELP,
+    ),
+    dedupe_window: int = typer.Option(
+        0,
+        "--dedupe-window",
+        help=DEDUPE_WINDOW_HELP,
+    ),
+    check_conflicts: bool = typer.Option(
+        False,
+        "--check-conflicts/--no-check-conflicts",
+        help="Compare the contents of each duplicate packet with the packet kept with the same ApID, SHCOARSE and seq count, and report duplicates with different contents as conflicts. Packets already in an output file with --dedupe-store are not compared",
+    ),
+    use_dedupe_store: bool = typer.Option(
+        False,
+        "--dedupe-store/--no-dedupe-store",
+        help=f"Keep the keys of the packets in the output file in a {KEY_STORE_SUFFIX} file next to it, so packets already in the output file are not appended to it again. It is built from the output file if it is missing or out of date",
+    ),
+    use_mmap: bool = typer.Option(
+        True,
+        "--mmap/--no-mmap",
+        help="Memory map the input file(s) and read packets in place rather than loading each file into memory",
+    ),
+    use_index_cache: bool = typer.Option(
+        False,
+        "--index-cache/--no-index-cache",
+        help="Reuse (or create) a .pktidx packet index next to each input file so later commands on the same file can skip re-reading the packet headers",
+    ),
+    jobs: int = typer.Option(
+        1,
+        "--jobs",
+        "-j",
+        help="Number of worker processes to filter the files with when given a folder or glob. 0 = one per CPU core. The output, --limit and the dedupe across files are the same as with 1",
+    ),
 ):
     """
     Extract and dedupe raw packets based on apid. Removes and flags duplicates based on apid and seq count. Can filter out other instruments or apids.
     """
 
     global is_multi_file
+    global packet_counter
     global unique_packets
     global needs_sort
+    global sort_in_one_pass
+    global checked_files
 
     globPath = None
 
@@ -79,42 +175,78 @@ def filter_packets(
         globPath = str(packet_files)
 
     if output_file and output_file.exists() and not is_multi_file:
-        print(
-            f"{output_file} already exists and will be appended to. Packets in this file already will not be duplicated against (to do that, use this file as an input file to filter-packets and create a new file rather than append to it)."
-        )
+        if use_dedupe_store:
+            print(
+                f"{output_file} already exists and will be appended to. Packets in this file already will be skipped using {output_file}{KEY_STORE_SUFFIX}."
+            )
+        else:
+            print(
+                f"{output_file} already exists and will be appended to. Packets in this file already will not be duplicated against (to do that, use --dedupe-store or use this file as an input file to filter-packets and create a new file rather than append to it)."
+            )
+
+    max_memory_bytes = parse_memory_size(max_memory)
+    if not validate_jobs(jobs) or max_memory_bytes is None:
+        raise typer.Abort()
+
+    if dedupe_window < 0:
+        print("dedupe-window must be 0 or a positive number of seconds")
+        raise typer.Abort()
+
+    # checked before the files are split between worker processes, so --jobs gives the
+    # same result as a serial run
+    _validate_filter_packets_options(output_file, limit, apids)
+
+    if not is_multi_file:
+        packet_counter = 0
+        unique_packets = PacketKeySet(dedupe_window, with_values=check_conflicts)
+        checked_files = []
 
     if globPath:
         _filter_packets_in_multiple_files_from_glob(
-            globPath, output_file, ctx, limit, apids, mag_only, sort_packets
+            globPath,
+            output_file,
+            ctx,
+            limit,
+            apids,
+            mag_only,
+            sort_packets,
+            max_memory,
+            dedupe_window,
+            check_conflicts,
+            use_dedupe_store,
+            use_mmap,
+            use_index_cache,
+            jobs,
         )
         return
 
-    _validate_filter_packets_args(packet_files, output_file, limit, apids)
+    _validate_filter_packets_args(packet_files)
 
     filter_to_apids = parse_apids(apids)
 
     packet_file_name = packet_files
     if not output_file:
-        output_file = (
-            packet_file_name.parent
-            / f"{packet_file_name.stem}_{datetime.now().strftime('%Y%m%d%H%M%S')}.bin"
-        )
+        output_file = _default_output_file(packet_file_name)
+
+    if not is_multi_file:
+        sort_in_one_pass = sort_packets and _can_sort_in_one_pass(output_file)
 
     _filter_packets_in_one_file(
-        packet_file_name, output_file, limit, mag_only, filter_to_apids
+        packet_file_name,
+        output_file,
+        limit,
+        mag_only,
+        filter_to_apids,
+        use_mmap,
+        use_index_cache,
+        use_dedupe_store,
+        check_conflicts,
     )
 
     if not is_multi_file:
-        if needs_sort:
-            if sort_packets:
-                _sort_packets_in_one_file(output_file)
-            else:
-                print(
-                    f"Packet sorting needed in {output_file} - rerun with --sort-packets"
-                )
-            needs_sort = False
-        else:
-            print(f"Packets in {output_file} are sorted correctly")
+        _finish_output_file(
+            output_file, sort_packets, max_memory_bytes, use_dedupe_store
+        )
 
     print(f"Filtered packets saved to {output_file.absolute()}")
 
@@ -125,107 +257,482 @@ def _filter_packets_in_one_file(
     limit: int,
     mag_only: bool,
     apid_filter: List[int],
+    use_mmap: bool = True,
+    use_index_cache: bool = False,
+    use_dedupe_store: bool = False,
+    check_conflicts: bool = False,
 ):
-    global exit_code
-    global packet_counter
-    global unique_packets
     global needs_sort
 
-    pktDefinition = get_imap_basic_packet_def()
-
     if limit != 0 and packet_counter >= limit:
         return
 
-    size = os.path.getsize(packet_file)
-    processed_bytes = 0
-    ignored_packets = 0
+    reader = PacketFileReader(packet_file, use_mmap, use_index_cache)
+    data, index = reader.data, reader.index
+
+    if not output_file.parent.exists():
+        output_file.parent.mkdir(parents=True)
+
+    key_store = PacketKeyStore(output_file) if use_dedupe_store else None
+    selection = _select_packets_to_filter(
+        packet_file,
+        data,
+        index,
+        limit,
+        mag_only,
+        apid_filter,
+        check_conflicts,
+        key_store.contains if key_store is not None else None,
+    )
+
+    with open_for_append(output_file) as output_file_handle:
+        with Progress(refresh_per_second=1) as progress:
+            task1 = progress.add_task(f"Processing {packet_file}", total=reader.size)
+            if _check_packets_to_filter(index, selection):
+                needs_sort = True
+            if sort_in_one_pass:
+                packets_to_sort.append((packet_file, index.take(selection.saved)))
+            else:
+                write_packets(
+                    output_file_handle, data, index, selection.saved, packet_file
+                )
+            progress.update(task1, advance=selection.processed_bytes)
+
+    reader.close()
+
+    if key_store is not None and not sort_in_one_pass:
+        key_store.add(index.keys()[selection.saved])
+
+    _print_filtered_file(packet_file, output_file, index, selection, limit)
+
+
+def _select_packets_to_filter(
+    packet_file: Path,
+    data: np.ndarray | None,
+    index: PacketIndex,
+    limit: int,
+    mag_only: bool,
+    apid_filter: List[int],
+    check_conflicts: bool,
+    in_output_file,
+) -> FilterSelection:
+    """
+    Choose the packets of one file to save, dropping the ones seen in earlier files (or
+    that in_output_file finds are in the output file already) and stopping at the
+    limit, and add them to the packets seen. This is done for each file in order, so it
+    gives the same result whether the files are then written one by one or by workers.
+    data is only needed with check_conflicts.
+    """
+    global packet_counter
+
+    selected = index.select(mag_only, apid_filter)
+    keys = index.keys()[selected]
+    is_new = unique_packets.first_seen(keys)
+    is_conflict = np.zeros(len(selected), dtype=bool)
+    if check_conflicts:
+        is_conflict = _find_conflicting_duplicates(data, index, selected, is_new)
+    if in_output_file is not None:
+        is_new &= ~in_output_file(keys)
+
+    considered_packets = len(index)
+    limit_reached = False
+    to_save = np.flatnonzero(is_new & ~is_conflict)
+    if limit > 0 and len(to_save) >= limit - packet_counter:
+        # stop at the packet that reaches the limit
+        last = int(to_save[limit - packet_counter - 1]) + 1
+        selected, is_new, is_conflict = (
+            selected[:last],
+            is_new[:last],
+            is_conflict[:last],
+        )
+        to_save = to_save[: limit - packet_counter]
+        considered_packets = int(selected[-1]) + 1
+        limit_reached = True
+
+    saved = selected[to_save]
+    packet_counter += len(saved)
+    if check_conflicts:
+        checked_files.append(packet_file)
+        unique_packets.add(
+            keys[to_save],
+            ((len(checked_files) - 1) << LOCATION_OFFSET_BITS) | index.offset[saved],
+        )
+    else:
+        unique_packets.add(keys[to_save])
+
+    return FilterSelection(
+        selected,
+        is_new,
+        is_conflict,
+        saved,
+        considered_packets,
+        int(index.length[:considered_packets].sum()),
+        limit_reached,
+        packet_counter,
+    )
+
+
+def _check_packets_to_filter(index: PacketIndex, selection: FilterSelection) -> bool:
+    """Warn about the duplicates skipped and the packets saved that are out of time or
+    seq count order. Returns True if the packets saved need sorting"""
+    unsorted = False
     previous_packet_timestamp = 0
     previous_packet_seq_count: dict[int, int] = {}  # apid -> seq_count
-    with open(output_file, "ab") as output_file_handle:
-        with Progress(refresh_per_second=1) as progress:
-            task1 = progress.add_task(f"Processing {packet_file}", total=size)
-            for packet_bytes in iter_packet_bytes(
-                packet_file, include_primary_header=True
-            ):
-                progress.update(task1, advance=len(packet_bytes))
-                processed_bytes += len(packet_bytes)
-
-                fileLikeObject = io.BytesIO(packet_bytes)
-                pkt = pktDefinition.load(fileLikeObject, include_primary_header=True)
-                apid = int(pkt["CCSDS_APID"][0])
-                sequence_count = int(pkt["CCSDS_SEQUENCE_COUNT"][0])
-                shcourse = int(pkt["SHCOARSE"][0])
-
-                # check the packet shopuld not be filtered out
-                if mag_only:
-                    if apid < CONSTANTS.APID_MAG_START or apid > CONSTANTS.APID_MAG_END:
-                        ignored_packets += 1
-                        continue
-
-                if apid_filter:
-                    if apid not in apid_filter:
-                        ignored_packets += 1
-                        continue
-
-                if not output_file.parent.exists():
-                    output_file.parent.mkdir(parents=True)
-
-                unique_id = (apid, pkt["SHCOARSE"][0], sequence_count)
-                if unique_id in unique_packets:
-                    print(
-                        f"Duplicate packet found - ApID: {hex(apid)} Seq Count: {sequence_count} SHCOARSE: {shcourse}. Skipping it.",
-                        file=sys.stderr,
-                    )
-                    ignored_packets += 1
-                    continue
+    selected = selection.selected
+    for apid, sequence_count, shcourse, new, conflict in zip(
+        index.apid[selected].tolist(),
+        index.seq_count[selected].tolist(),
+        index.shcoarse[selected].tolist(),
+        selection.is_new.tolist(),
+        selection.is_conflict.tolist(),
+    ):
+        if conflict:
+            print(
+                f"Conflicting duplicate packet found - ApID: {hex(apid)} Seq Count: {sequence_count} SHCOARSE: {shcourse} has different contents to the packet kept. Skipping it.",
+                file=sys.stderr,
+            )
+            continue
 
-                if shcourse < previous_packet_timestamp:
-                    print(
-                        f"WARNING: {CONSTANTS.NON_SEQUENTIAL} time detected at SHCOURSE {shcourse} (previous was {previous_packet_timestamp})",
-                        file=sys.stderr,
-                    )
-                    needs_sort = True
-                previous_packet_timestamp = shcourse
-
-                if (
-                    apid in previous_packet_seq_count
-                    and sequence_count
-                    != (
-                        (previous_packet_seq_count[apid] + 1)
-                        % CONSTANTS.MAX_SEQUENCE_COUNT
-                    )
-                    and sequence_count != 0
-                ):
-                    print(
-                        f"WARNING: {CONSTANTS.NON_SEQUENTIAL} sequence count detected for ApID {hex(apid)} at Seq Count {sequence_count} (previous was {previous_packet_seq_count[apid]})",
-                        file=sys.stderr,
-                    )
-                    needs_sort = True
-                previous_packet_seq_count[apid] = sequence_count
+        if not new:
+            print(
+                f"Duplicate packet found - ApID: {hex(apid)} Seq Count: {sequence_count} SHCOARSE: {shcourse}. Skipping it.",
+                file=sys.stderr,
+            )
+            continue
+
+        if shcourse < previous_packet_timestamp:
+            print(
+                f"WARNING: {CONSTANTS.NON_SEQUENTIAL} time detected at SHCOURSE {shcourse} (previous was {previous_packet_timestamp})",
+                file=sys.stderr,
+            )
+            unsorted = True
+        previous_packet_timestamp = shcourse
+
+        if (
+            apid in previous_packet_seq_count
+            and sequence_count
+            != ((previous_packet_seq_count[apid] + 1) % CONSTANTS.MAX_SEQUENCE_COUNT)
+            and sequence_count != 0
+        ):
+            print(
+                f"WARNING: {CONSTANTS.NON_SEQUENTIAL} sequence count detected for ApID {hex(apid)} at Seq Count {sequence_count} (previous was {previous_packet_seq_count[apid]})",
+                file=sys.stderr,
+            )
+            unsorted = True
+        previous_packet_seq_count[apid] = sequence_count
+
+    return unsorted
+
+
+def _print_filtered_file(
+    packet_file: Path,
+    output_file: Path,
+    index: PacketIndex,
+    selection: FilterSelection,
+    limit: int,
+):
+    if selection.limit_reached:
+        print(f"Limit of {limit} packets reached")
 
-                unique_packets.add(unique_id)
-                output_file_handle.write(packet_bytes)
-                packet_counter += 1
+    conflicting_packets = int(np.count_nonzero(selection.is_conflict))
+    if conflicting_packets:
+        print(
+            f"Skipped {conflicting_packets} packets in {packet_file} with the same ApID, SHCOARSE and seq count as a packet kept but different contents"
+        )
 
-                if limit > 0 and packet_counter >= limit:
-                    print(f"Limit of {limit} packets reached")
-                    break
+    # duplicates, and packets that did not match the apid filters before the limit
+    ignored_packets = selection.considered_packets - len(selection.saved)
+    if sort_in_one_pass:
+        print(
+            f"Selected {selection.counter} packets from {packet_file} for {output_file.name} ({selection.processed_bytes} bytes processed, {int(index.length[selection.saved].sum())} bytes to write). Ignored {ignored_packets} packets."
+        )
+        return
 
     print(
-        f"Saved {packet_counter} packets from {packet_file} to {output_file.name} ({processed_bytes} bytes processed, {os.path.getsize(output_file)} bytes written). Ignored {ignored_packets} packets."
+        f"Saved {selection.counter} packets from {packet_file} to {output_file.name} ({selection.processed_bytes} bytes processed, {os.path.getsize(output_file)} bytes written). Ignored {ignored_packets} packets."
     )
 
 
+def _find_conflicting_duplicates(
+    data: np.ndarray, index: PacketIndex, selected: np.ndarray, is_new: np.ndarray
+) -> np.ndarray:
+    """
+    Which of the selected packets are duplicates of a packet kept (from this file or an
+    earlier one) that have different contents. Only the duplicates and the packets they
+    duplicate are digested, so this costs next to nothing when there are few duplicates.
+    """
+    is_conflict = np.zeros(len(selected), dtype=bool)
+    duplicates = np.flatnonzero(~is_new)
+    if len(duplicates) == 0:
+        return is_conflict
+
+    keys = index.keys()[selected]
+    kept_digests = np.zeros(len(duplicates), dtype=np.uint32)
+
+    # packets kept from earlier files, digested from a memory map of their file
+    locations = unique_packets.values_of(keys[duplicates])
+    in_earlier_file = (locations != NO_VALUE) & unique_packets.contains(
+        keys[duplicates]
+    )
+    file_numbers = locations >> np.uint64(LOCATION_OFFSET_BITS)
+    offsets = (locations & np.uint64((1 << LOCATION_OFFSET_BITS) - 1)).astype(np.int64)
+    for file_number in np.unique(file_numbers[in_earlier_file]).tolist():
+        in_file = in_earlier_file & (file_numbers == file_number)
+        earlier_data = read_packet_file(checked_files[file_number], True)
+        kept_digests[in_file] = packet_digests(
+            earlier_data,
+            offsets[in_file],
+            read_packet_lengths(earlier_data, offsets[in_file]),
+        )
+
+    # packets kept from this file are the first selected packet with the same key
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    first_of_duplicates = first[inverse[duplicates]]
+    in_this_file = ~in_earlier_file & is_new[first_of_duplicates]
+    kept = selected[first_of_duplicates[in_this_file]]
+    kept_digests[in_this_file] = packet_digests(
+        data, index.offset[kept], index.length[kept]
+    )
+
+    compared = in_earlier_file | in_this_file
+    duplicate_positions = selected[duplicates[compared]]
+    is_conflict[duplicates[compared]] = (
+        packet_digests(
+            data, index.offset[duplicate_positions], index.length[duplicate_positions]
+        )
+        != kept_digests[compared]
+    )
+    return is_conflict
+
+
+def _filter_packets_in_worker(
+    packet_file: str,
+    index: PacketIndex,
+    selection: FilterSelection,
+    worker_file: Path | None,
+    use_mmap: bool,
+) -> tuple[bool, str]:
+    """
+    Check the packets chosen from one file and write the ones to save to worker_file
+    (unless they are held back to be sorted in one pass). Returns whether they need
+    sorting and the warnings printed, so they can be shown in file order.
+    """
+    warnings = io.StringIO()
+    with contextlib.redirect_stderr(warnings):
+        unsorted = _check_packets_to_filter(index, selection)
+
+    if worker_file is not None:
+        with PacketFileReader(packet_file, use_mmap, index=index) as reader:
+            with open(worker_file, "wb") as worker_file_handle:
+                write_packets(
+                    worker_file_handle,
+                    reader.data,
+                    index,
+                    selection.saved,
+                    Path(packet_file),
+                )
+    return unsorted, warnings.getvalue()
+
+
+def _filter_packets_in_parallel(
+    filenames: List[str],
+    output_file: Path | None,
+    limit: int,
+    mag_only: bool,
+    apid_filter: List[int],
+    check_conflicts: bool,
+    use_dedupe_store: bool,
+    use_mmap: bool,
+    use_index_cache: bool,
+    jobs: int,
+) -> int:
+    """
+    Filter several files at once. The files are indexed in parallel, then the packets to
+    save from each file are chosen in file order (so --limit and the dedupe across files
+    give the same result as a serial run) and each file is checked and written by a
+    worker process to a file of its own. These are then appended to the output file in
+    file order.
+    """
+    multifile_exit_code = 0
+    indexes = preload_packet_indexes(filenames, jobs, use_index_cache)
+    discard_preloaded_indexes()
+
+    worker_folder = (output_file or Path(filenames[0])).parent
+    worker_folder.mkdir(parents=True, exist_ok=True)
+    worker_root = Path(tempfile.mkdtemp(prefix=".filter-packets-", dir=worker_folder))
+    # output file -> its dedupe store and the keys of the packets to be appended to it
+    key_stores: dict[Path, tuple[PacketKeyStore, PacketKeySet]] = {}
+    filters = []
+
+    with create_process_pool(jobs) as pool:
+        for file_number, filename in enumerate(filenames):
+            packet_file = Path(filename)
+            file_output = output_file or _default_output_file(packet_file)
+            index = indexes[filename]
+            selection = None
+            worker_file = None
+            if isinstance(index, Exception):
+                filters.append((packet_file, file_output, index, None, None, index))
+                continue
+
+            if limit != 0 and packet_counter >= limit:
+                filters.append((packet_file, file_output, index, None, None, None))
+                continue
+
+            try:
+                file_output.parent.mkdir(parents=True, exist_ok=True)
+                in_output_file = None
+                if use_dedupe_store:
+                    in_output_file = _in_output_file(key_stores, file_output)
+                data = read_packet_file(packet_file, True) if check_conflicts else None
+                selection = _select_packets_to_filter(
+                    packet_file,
+                    data,
+                    index,
+                    limit,
+                    mag_only,
+                    apid_filter,
+                    check_conflicts,
+                    in_output_file,
+                )
+                if not sort_in_one_pass:
+                    if use_dedupe_store:
+                        key_stores[file_output][1].add(index.keys()[selection.saved])
+                    worker_file = worker_root / f"{file_number}.bin"
+                filtered = pool.submit(
+                    _filter_packets_in_worker,
+                    filename,
+                    index,
+                    selection,
+                    worker_file,
+                    use_mmap,
+                )
+            except Exception as e:
+                filtered = e
+            filters.append(
+                (packet_file, file_output, index, selection, worker_file, filtered)
+            )
+
+        for (
+            packet_file,
+            file_output,
+            index,
+            selection,
+            worker_file,
+            filtered,
+        ) in filters:
+            try:
+                if isinstance(filtered, Exception):
+                    raise filtered
+                if filtered is not None:
+                    _append_filtered_file(
+                        packet_file,
+                        file_output,
+                        index,
+                        selection,
+                        worker_file,
+                        filtered.result(),
+                        key_stores.get(file_output),
+                        limit,
+                    )
+                print(f"Filtered packets saved to {file_output.absolute()}")
+            except Exception as e:
+                print(f"Error processing {packet_file}: {e}", file=sys.stderr)
+                if multifile_exit_code == 0:
+                    multifile_exit_code = 1
+
+    shutil.rmtree(worker_root, ignore_errors=True)
+
+    return multifile_exit_code
+
+
+def _in_output_file(key_stores: dict, output_file: Path):
+    """A check for which keys are in output_file already or are to be appended to it
+    from an earlier file, opening its dedupe store the first time it is needed"""
+    if output_file not in key_stores:
+        key_stores[output_file] = (PacketKeyStore(output_file), PacketKeySet())
+    key_store, to_append = key_stores[output_file]
+    return lambda keys: key_store.contains(keys) | to_append.contains(keys)
+
+
+def _append_filtered_file(
+    packet_file: Path,
+    output_file: Path,
+    index: PacketIndex,
+    selection: FilterSelection,
+    worker_file: Path | None,
+    result: tuple[bool, str],
+    key_store: tuple[PacketKeyStore, PacketKeySet] | None,
+    limit: int,
+):
+    """Add the packets a worker filtered from one file to the output, as
+    _filter_packets_in_one_file would"""
+    global needs_sort
+
+    unsorted, warnings = result
+    sys.stderr.write(warnings)
+    if unsorted:
+        needs_sort = True
+
+    if sort_in_one_pass:
+        packets_to_sort.append((packet_file, index.take(selection.saved)))
+    else:
+        with open_for_append(output_file) as output_file_handle:
+            append_file(output_file_handle, worker_file)
+        os.remove(worker_file)
+        if key_store is not None:
+            key_store[0].add(index.keys()[selection.saved])
+
+    _print_filtered_file(packet_file, output_file, index, selection, limit)
+
+
 def _filter_packets_in_multiple_files_from_glob(
-    globPath, output_file, ctx, limit, apids, mag_only, sort_packets
+    globPath,
+    output_file,
+    ctx,
+    limit,
+    apids,
+    mag_only,
+    sort_packets,
+    max_memory,
+    dedupe_window,
+    check_conflicts,
+    use_dedupe_store,
+    use_mmap,
+    use_index_cache,
+    jobs,
 ):
     multifile_exit_code = 0
     files = 0
     global is_multi_file
     global needs_sort
+    global sort_in_one_pass
     is_multi_file = True
     needs_sort = False
-    for filename in glob.glob(globPath):
+    sort_in_one_pass = sort_packets and _can_sort_in_one_pass(output_file)
+    filenames = [
+        filename
+        for filename in glob.glob(globPath)
+        if not filename.endswith(INDEX_CACHE_SUFFIX)
+    ]
+
+    if resolve_jobs(jobs) > 1 and len(filenames) > 1:
+        files = len(filenames)
+        multifile_exit_code = _filter_packets_in_parallel(
+            filenames,
+            output_file,
+            limit,
+            mag_only,
+            parse_apids(apids),
+            check_conflicts,
+            use_dedupe_store,
+            use_mmap,
+            use_index_cache,
+            jobs,
+        )
+        filenames = []
+
+    for filename in filenames:
         files += 1
         try:
             result = ctx.invoke(
@@ -237,6 +744,13 @@ def _filter_packets_in_multiple_files_from_glob(
                 apids=apids,
                 mag_only=mag_only,
                 sort_packets=False,
+                max_memory=max_memory,
+                dedupe_window=dedupe_window,
+                check_conflicts=check_conflicts,
+                use_dedupe_store=use_dedupe_store,
+                use_mmap=use_mmap,
+                use_index_cache=use_index_cache,
+                jobs=jobs,
             )
             if result and result.exit_code != 0:
                 multifile_exit_code = result.exit_code
@@ -252,14 +766,9 @@ def _filter_packets_in_multiple_files_from_glob(
     if files == 0:
         multifile_exit_code = 1
 
-    if needs_sort:
-        if sort_packets:
-            _sort_packets_in_one_file(output_file)
-        else:
-            print(f"Packet sorting needed in {output_file} - rerun with --sort-packets")
-        needs_sort = False
-    else:
-        print(f"Packets in {output_file} are sorted correctly")
+    _finish_output_file(
+        output_file, sort_packets, parse_memory_size(max_memory), use_dedupe_store
+    )
 
     print(f"Processed {files} files matching {globPath}")
 
@@ -269,12 +778,7 @@ def _filter_packets_in_multiple_files_from_glob(
         raise typer.Exit(code=multifile_exit_code)
 
 
-def _validate_filter_packets_args(
-    data_file: Path,
-    output_file: Path | None,
-    limit: int,
-    apids: List[str] | None,
-):
+def _validate_filter_packets_args(data_file: Path):
     if not data_file.exists():
         print(f"{data_file} does not exist")
         raise typer.Abort()
@@ -283,6 +787,12 @@ def _validate_filter_packets_args(
         print("data_file name is empty or invalid")
         raise typer.Abort()
 
+
+def _validate_filter_packets_options(
+    output_file: Path | None,
+    limit: int,
+    apids: List[str] | None,
+):
     if output_file and output_file.is_dir():
         print(f"output_file {output_file} is a directory, please provide a file path")
         raise typer.Abort()
@@ -299,44 +809,89 @@ def _validate_filter_packets_args(
                 raise typer.Abort()
 
 
-def _sort_packets_in_one_file(
-    packet_file: Path,
+def _default_output_file(packet_file: Path) -> Path:
+    return (
+        packet_file.parent
+        / f"{packet_file.stem}_{datetime.now().strftime('%Y%m%d%H%M%S')}.bin"
+    )
+
+
+def _can_sort_in_one_pass(output_file: Path | None) -> bool:
+    """An output file that is new or empty can be written sorted in one pass, but one
+    that already has packets in it has to be sorted after they are appended"""
+    return output_file is not None and (
+        not output_file.exists() or os.path.getsize(output_file) == 0
+    )
+
+
+def _finish_output_file(
+    output_file: Path, sort_packets: bool, max_memory: int, use_dedupe_store: bool
 ):
-    pktDefinition = get_imap_basic_packet_def()
+    """Write any packets held back for sorting, and sort or check the order of output_file"""
+    global needs_sort
+    global sort_in_one_pass
+    global packets_to_sort
 
+    if sort_in_one_pass:
+        _write_packets_to_sort(output_file, use_dedupe_store)
+    elif needs_sort:
+        if sort_packets:
+            _sort_packets_in_one_file(output_file, max_memory)
+        else:
+            print(f"Packet sorting needed in {output_file} - rerun with --sort-packets")
+
+    if not needs_sort:
+        print(f"Packets in {output_file} are sorted correctly")
+    needs_sort = False
+    sort_in_one_pass = False
+    packets_to_sort = []
+
+
+def _write_packets_to_sort(output_file: Path, use_dedupe_store: bool):
+    """Write the packets selected from every input file in one pass, sorting only the
+    indexes (and only if the packets were found out of order)"""
+    packet_count = sum(len(index) for _, index in packets_to_sort)
+    total_bytes = sum(index.total_bytes for _, index in packets_to_sort)
+    key_store = PacketKeyStore(output_file) if use_dedupe_store else None
+
+    with open_for_append(
+        output_file, buffering=OUTPUT_BUFFER_BYTES
+    ) as output_file_handle:
+        with Progress(refresh_per_second=1) as progress:
+            task1 = progress.add_task(f"Writing {output_file}", total=total_bytes)
+            write_packets_from_files(
+                output_file_handle,
+                packets_to_sort,
+                needs_sort,
+                lambda bytes_written: progress.update(task1, advance=bytes_written),
+            )
+
+    if key_store is not None and packets_to_sort:
+        key_store.add(np.concatenate([index.keys() for _, index in packets_to_sort]))
+
+    if needs_sort:
+        print(
+            f"Sorted {packet_count} packets in {output_file} ({os.path.getsize(output_file)} bytes written)."
+        )
+
+
+def _sort_packets_in_one_file(packet_file: Path, max_memory: int):
     output_file = packet_file.with_name(
         f"{packet_file.stem}_sorted{packet_file.suffix}"
     )
     size = os.path.getsize(packet_file)
-    in_mem_ordered_packets: list[tuple[(tuple[int, int, int], bytes)]] = []
-    packet_counter = 0
 
-    print("Sorting packets - read all packets into memory")
+    print("Sorting packets - index all packets")
 
-    with open(output_file, "ab") as output_file_handle:
-        with Progress(refresh_per_second=1) as progress:
-            task1 = progress.add_task(f"Reading {packet_file}", total=size)
-            task2 = progress.add_task(f"Writing {output_file}", total=size)
-            for packet_bytes in iter_packet_bytes(
-                packet_file, include_primary_header=True
-            ):
-                progress.update(task1, advance=len(packet_bytes))
-
-                fileLikeObject = io.BytesIO(packet_bytes)
-                pkt = pktDefinition.load(fileLikeObject, include_primary_header=True)
-                apid = int(pkt["CCSDS_APID"][0])
-                sequence_count = int(pkt["CCSDS_SEQUENCE_COUNT"][0])
-                shcourse = int(pkt["SHCOARSE"][0])
-                in_mem_ordered_packets.append(
-                    ((shcourse, apid, sequence_count), packet_bytes)
-                )
-                packet_counter += 1
-
-            for keys, packet_bytes in sorted(in_mem_ordered_packets):
-                output_file_handle.write(packet_bytes)
-                progress.update(task2, advance=len(packet_bytes))
+    with Progress(refresh_per_second=1) as progress:
+        task1 = progress.add_task(f"Writing {output_file}", total=size)
+        packet_counter = sort_packet_file(
+            packet_file,
+            output_file,
+            max_memory,
+            lambda bytes_written: progress.update(task1, advance=bytes_written),
+        )
 
-    del in_mem_ordered_packets
     os.remove(packet_file)
     os.rename(output_file, packet_file)
 
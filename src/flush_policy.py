@@ -0,0 +1,67 @@
+import re
+import sys
+import time
+from collections import namedtuple
+
+# how often CSV writers push buffered rows to disk. None means never (until close).
+# max_latency is a bound on how long a written row can wait to be flushed, which is
+# kept by flushing on a timer thread so it holds even when no more packets arrive
+FlushPolicy = namedtuple(
+    "FlushPolicy", ["every_packets", "every_seconds", "max_latency"], defaults=[None]
+)
+
+FLUSH_EVERY_PACKET = FlushPolicy(1, None)
+FLUSH_ON_CLOSE = FlushPolicy(None, None)
+
+FLUSH_POLICY_HELP = "'packet' (default), 'close', a number of packets like '100', a number of seconds like '5s' or a latency budget like 'latency:500ms'"
+
+# bigger file buffer so rows that are not flushed every packet go out in large writes
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+
+def parse_flush_policy(value: str) -> FlushPolicy | None:
+    """Parse --flush into a FlushPolicy, or print an error and return None"""
+    value = value.strip().lower()
+    if value == "packet":
+        return FLUSH_EVERY_PACKET
+    if value == "close":
+        return FLUSH_ON_CLOSE
+
+    match = re.fullmatch(r"latency:(\d+(?:\.\d+)?)(ms|s)", value)
+    if match and float(match.group(1)) > 0:
+        seconds = float(match.group(1))
+        return FlushPolicy(
+            None, None, seconds / 1000 if match.group(2) == "ms" else seconds
+        )
+
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)(s?)", value)
+    if match and float(match.group(1)) > 0:
+        if match.group(2):
+            return FlushPolicy(None, float(match.group(1)))
+        if match.group(1).isdigit():
+            return FlushPolicy(int(match.group(1)), None)
+
+    print(f"flush must be {FLUSH_POLICY_HELP}, not '{value}'", file=sys.stderr)
+    return None
+
+
+class FlushTracker:
+    """Counts the packets written to a file and says when the policy wants a flush"""
+
+    def __init__(self, policy: FlushPolicy):
+        self.policy = policy
+        self.reset()
+
+    def reset(self):
+        self.packets_since_flush = 0
+        self.last_flush = time.monotonic()
+
+    def packet_written(self, packets: int = 1) -> bool:
+        self.packets_since_flush += packets
+        return (
+            self.policy.every_packets is not None
+            and self.packets_since_flush >= self.policy.every_packets
+        ) or (
+            self.policy.every_seconds is not None
+            and time.monotonic() - self.last_flush >= self.policy.every_seconds
+        )
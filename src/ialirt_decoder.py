@@ -1,20 +1,60 @@
-import csv
 import os
 import threading
 import time
 from collections import namedtuple
 from ctypes import c_int32
 from datetime import datetime
+from itertools import chain
 
 import numpy as np
 
 from constants import CONSTANTS
+from flush_policy import FLUSH_EVERY_PACKET, FlushPolicy, FlushTracker
 from science_mode import ModeName
 from src import time_util
+from table_writer import Column, OutputFormat, open_table_file, table_file_suffix
 from time_util import get_met_from_shcourse, humanise_timedelta
 
 Vector = namedtuple("Vector", ["x", "y", "z", "rng"])
 
+# where the 12 bytes of mag data start in each kind of I-ALiRT packet
+MAG_DATA_OFFSETS = {
+    CONSTANTS.APID_SPACECRAFT_IALIRT: 171,
+    CONSTANTS.APID_MAG_IALIRT: 10,
+}
+MAG_DATA_BYTES = 12
+MAG_DATA = np.dtype(
+    [
+        ("coarse", ">u4"),
+        ("fine", ">u2"),
+        ("status", np.uint8, (3,)),
+        ("sci", np.uint8, (3,)),
+    ]
+)
+# an I-ALiRT vector pair is spread over a group of 4 packets, counted 0 to 3
+QUARTET_PACKETS = 4
+# how many packets past the end of a group its missing packets can still arrive
+REORDER_WINDOW_PACKETS = 16
+SEQUENCE_COUNT_MODULO = 1 << 14
+# a bigger jump in SHCOARSE than this (seconds) starts reassembly afresh
+MAX_REORDER_SHCOARSE_JUMP = 1024
+IALIRT_COLUMNS = [
+    Column("x_pri", np.int32, "pri"),
+    Column("y_pri", np.int32, "pri"),
+    Column("z_pri", np.int32, "pri"),
+    Column("rng_pri", np.uint8, "pri"),
+    Column("x_sec", np.int32, "sec"),
+    Column("y_sec", np.int32, "sec"),
+    Column("z_sec", np.int32, "sec"),
+    Column("rng_sec", np.uint8, "sec"),
+    Column("pri_coarse", np.uint32, "pri"),
+    Column("pri_fine", np.uint16, "pri"),
+    Column("sec_coarse", np.uint32, "sec"),
+    Column("sec_fine", np.uint16, "sec"),
+    Column("pri_utc", "datetime64[us]", "pri"),
+    Column("sec_utc", "datetime64[us]", "sec"),
+]
+
 
 class _IALIRTFileWriter:
 
@@ -22,6 +62,8 @@ class _IALIRTFileWriter:
         self,
         folder: str,
         packet_type: str = "mag",
+        flush_policy: FlushPolicy = FLUSH_EVERY_PACKET,
+        output_format: OutputFormat = OutputFormat.csv,
     ):
 
         self.time_now = datetime.now().strftime("%Y%m%d-%Hh%M")
@@ -29,11 +71,14 @@ class _IALIRTFileWriter:
         self.file = None
         self.isOpen = 0
         self.closePending = False
-        self.writer = None
         self.idleTimer = None
         self.base_path = folder
         self.packet_type = packet_type
         self.data_start_timestamp = None
+        self.flush_tracker = FlushTracker(flush_policy)
+        self.output_format = output_format
+        # held while writing so the idle timer thread can not flush part way through
+        self.lock = threading.RLock()
 
     def _first_write(self, firstPriCoarse, firstPriFine):
 
@@ -49,36 +94,16 @@ class _IALIRTFileWriter:
             self.packet_type,
             self.data_start_timestamp.strftime("%Y%m%d-%Hh%Mm%Ss"),
         )
-        exists_already = os.path.isfile(self.filename)
-        self.file = open(self.filename, "a")
+        self.file = open_table_file(self.output_format, self.filename, IALIRT_COLUMNS)
         self.isOpen = 1
         self.closePending = False
-        self.writer = csv.writer(self.file)
-        if not exists_already:
-            self.writer.writerow(
-                [
-                    "x_pri",
-                    "y_pri",
-                    "z_pri",
-                    "rng_pri",
-                    "x_sec",
-                    "y_sec",
-                    "z_sec",
-                    "rng_sec",
-                    "pri_coarse",
-                    "pri_fine",
-                    "sec_coarse",
-                    "sec_fine",
-                    "pri_utc",
-                    "sec_utc",
-                ]
-            )
+        if not self.file.exists_already:
             print(f"Opened new alirt data file {self.filename}")
         else:
             print(f"Appending to existing alirt data file {self.filename}")
 
     def _generateFileName(self, packet_type, data_start_timestamp):
-        return f"{self.base_path}/IALiRT-{packet_type}-{data_start_timestamp}.csv"
+        return f"{self.base_path}/IALiRT-{packet_type}-{data_start_timestamp}{table_file_suffix(self.output_format)}"
 
     def write(
         self,
@@ -90,189 +115,437 @@ class _IALIRTFileWriter:
         secondary_science_time_fine,
         pri_time_utc,
         sec_time_utc,
+    ):
+        with self.lock:
+            self._write(
+                1,
+                [
+                    *(primary_vector or [None] * 4),
+                    *(secondary_vector or [None] * 4),
+                    primary_science_time_coarse,
+                    primary_science_time_fine,
+                    secondary_science_time_coarse,
+                    secondary_science_time_fine,
+                    pri_time_utc,
+                    sec_time_utc,
+                ],
+                {"pri": int(bool(primary_vector)), "sec": int(bool(secondary_vector))},
+                primary_science_time_coarse,
+                primary_science_time_fine,
+            )
+
+    def _write(
+        self,
+        rows: int,
+        values: list,
+        counts: dict[str, int],
+        firstPriCoarse,
+        firstPriFine,
     ):
         if self.isOpen == 0:
-            self._first_write(primary_science_time_coarse, primary_science_time_fine)
+            self._first_write(firstPriCoarse, firstPriFine)
 
-        assert self.writer is not None
+        assert self.file is not None
 
         if self.isOpen == 1:
-            self.writer.writerow(
+            self.file.write(rows, values, counts)
+            # flush to disk as often as the flush policy asks
+            if self.flush_tracker.packet_written(rows):
+                self.flush()
+            else:
+                self._start_idle_timer()
+
+    def write_rows(
+        self,
+        primary_vectors: Vector,
+        secondary_vectors: Vector,
+        primary_science_time_coarse: np.ndarray,
+        primary_science_time_fine: np.ndarray,
+        secondary_science_time_coarse: np.ndarray,
+        secondary_science_time_fine: np.ndarray,
+        pri_time_utc: np.ndarray,
+        sec_time_utc: np.ndarray,
+    ):
+        """Write a row for each vector in arrays of primary and secondary vectors"""
+        rows = len(primary_vectors.x)
+        with self.lock:
+            self._write(
+                rows,
                 [
-                    primary_vector.x if primary_vector else None,
-                    primary_vector.y if primary_vector else None,
-                    primary_vector.z if primary_vector else None,
-                    primary_vector.rng if primary_vector else None,
-                    secondary_vector.x if secondary_vector else None,
-                    secondary_vector.y if secondary_vector else None,
-                    secondary_vector.z if secondary_vector else None,
-                    secondary_vector.rng if secondary_vector else None,
-                    primary_science_time_coarse if primary_vector else None,
-                    primary_science_time_fine if primary_vector else None,
-                    secondary_science_time_coarse if secondary_vector else None,
-                    secondary_science_time_fine if secondary_vector else None,
-                    pri_time_utc if primary_vector else None,
-                    sec_time_utc if secondary_vector else None,
-                ]
+                    *primary_vectors,
+                    *secondary_vectors,
+                    primary_science_time_coarse,
+                    primary_science_time_fine,
+                    secondary_science_time_coarse,
+                    secondary_science_time_fine,
+                    pri_time_utc,
+                    sec_time_utc,
+                ],
+                {"pri": rows, "sec": rows},
+                primary_science_time_coarse[0],
+                primary_science_time_fine[0],
             )
-            # after each packet make sure everything is written to disk
-            self.flush()
+
+    def _start_idle_timer(self):
+        """With a latency budget, flush on a timer thread once the oldest unflushed row
+        has waited for it, so rows reach the disk in time even if no more arrive"""
+        max_latency = self.flush_tracker.policy.max_latency
+        if max_latency is not None and self.idleTimer is None:
+            self.idleTimer = threading.Timer(max_latency, self._flush_when_idle)
+            self.idleTimer.daemon = True
+            self.idleTimer.start()
+
+    def _flush_when_idle(self):
+        with self.lock:
+            # a flush since the timer was started has already written the rows
+            if self.idleTimer is threading.current_thread():
+                self.flush()
+
+    def _cancel_idle_timer(self):
+        if self.idleTimer is not None:
+            self.idleTimer.cancel()
+            self.idleTimer = None
 
     def flush(self):
-        if self.isOpen == 1 and self.file:
-            self.file.flush()
+        with self.lock:
+            self._cancel_idle_timer()
+            if self.isOpen == 1 and self.file:
+                self.file.flush()
+            self.flush_tracker.reset()
 
     def close(self):
-        if self.isOpen == 1:
-            if self.file:
-                self.file.close()
-            self.isOpen = 0
-            self.closePending = False
+        with self.lock:
+            self._cancel_idle_timer()
+            if self.isOpen == 1:
+                if self.file:
+                    self.file.close()
+                self.isOpen = 0
+                self.closePending = False
+
+
+class _QuartetReorderBuffer:
+    """
+    Reassembles the groups of 4 I-ALiRT packets (counters 0 to 3) that carry each
+    pair of vectors when packets arrive out of order. The packets of a group have
+    consecutive sequence counts, so a packet belongs to the group starting at its
+    sequence count minus its counter. Groups are released in sequence count order
+    once complete, and a group still incomplete when packets more than window past
+    its end have arrived is given up on, so the buffer never holds more than a few
+    groups. SHCOARSE is used to spot jumps in time (such as a new pass) that make the
+    wrapping sequence count ambiguous, which start afresh.
+    """
+
+    def __init__(self, window: int = REORDER_WINDOW_PACKETS):
+        self.window = window
+        self.groups = {}  # first (unwrapped) sequence count of a group -> 4 packets
+        self.newest_sequence = None
+        self.newest_shcoarse = None
+        self.next_group = None  # groups before this have been released or given up on
+        self.dropped_packets = 0
+        self.incomplete_groups = 0
+
+    def add(self, seq_count: int, shcoarse: int, pkt_counter: int, mag_data) -> list:
+        """Add a packet, returning the groups it completes or releases (in order)"""
+        released = []
+        if (
+            self.newest_shcoarse is not None
+            and abs(shcoarse - self.newest_shcoarse) > MAX_REORDER_SHCOARSE_JUMP
+        ):
+            released = self.drain()
+
+        if self.newest_sequence is None:
+            sequence = seq_count
+        else:
+            # the sequence count wraps, so unwrap it from the newest packet
+            step = (seq_count - self.newest_sequence) % SEQUENCE_COUNT_MODULO
+            if step >= SEQUENCE_COUNT_MODULO // 2:
+                step -= SEQUENCE_COUNT_MODULO
+            sequence = self.newest_sequence + step
+
+        group_start = sequence - pkt_counter
+        if self.next_group is not None and group_start < self.next_group:
+            # too late, or a repeat of a packet in a group that has been released
+            self.dropped_packets += 1
+            return released
+
+        group = self.groups.setdefault(group_start, [None] * QUARTET_PACKETS)
+        if group[pkt_counter] is not None:
+            self.dropped_packets += 1
+            return released
+        group[pkt_counter] = mag_data
+
+        if self.newest_sequence is None or sequence > self.newest_sequence:
+            self.newest_sequence = sequence
+            self.newest_shcoarse = shcoarse
+
+        return released + self._release(
+            self.newest_sequence - QUARTET_PACKETS - self.window
+        )
+
+    def can_skip(self, seq_count: int, shcoarse: int) -> bool:
+        """Whether a complete group starting at seq_count can bypass the buffer, as
+        nothing is waiting in it and the group is newer than any packet added"""
+        if self.groups:
+            return False
+        if self.newest_sequence is None:
+            return True
+        step = (seq_count - self.newest_sequence) % SEQUENCE_COUNT_MODULO
+        return (
+            0 < step < SEQUENCE_COUNT_MODULO // 2
+            and abs(shcoarse - self.newest_shcoarse) <= MAX_REORDER_SHCOARSE_JUMP
+        )
+
+    def skip(self, seq_count: int, shcoarse: int):
+        """Move on past a run of complete groups, ending with the packet at seq_count,
+        that bypassed the buffer, as if they had been added and released"""
+        if self.newest_sequence is None:
+            self.newest_sequence = seq_count
+        else:
+            # only the sequence counts relative to each other matter
+            self.newest_sequence += (
+                seq_count - self.newest_sequence
+            ) % SEQUENCE_COUNT_MODULO
+        self.newest_shcoarse = shcoarse
+        self.next_group = self.newest_sequence - (QUARTET_PACKETS - 1) + 1
+
+    def drain(self) -> list:
+        """Release every complete group and give up on the rest"""
+        released = self._release(None)
+        self.newest_sequence = None
+        self.newest_shcoarse = None
+        self.next_group = None
+        return released
+
+    def _release(self, give_up_before: int | None) -> list:
+        released = []
+        while self.groups:
+            group_start = min(self.groups)
+            group = self.groups[group_start]
+            if None not in group:
+                released.append(group)
+            elif give_up_before is None or group_start < give_up_before:
+                self.incomplete_groups += 1
+            else:
+                break
+            del self.groups[group_start]
+            self.next_group = group_start + 1
+        return released
+
+
+def _group_bytes(groups: list) -> np.ndarray:
+    """The mag data of groups of 4 packets as a uint8 array with a row per packet"""
+    return np.frombuffer(b"".join(chain.from_iterable(groups)), dtype=np.uint8).reshape(
+        -1, MAG_DATA_BYTES
+    )
+
+
+def _in_order_quartet_runs(
+    seq_counts: np.ndarray, shcoarse: np.ndarray, pkt_counter: np.ndarray
+) -> np.ndarray:
+    """
+    For each packet, how many complete groups of 4 packets in order (counters 0 to 3
+    with consecutive sequence counts) follow one after the other from it, each starting
+    at a later sequence count than the last and with no jump in SHCOARSE. 0 for packets
+    that do not start such a group.
+    """
+    runs = np.zeros(len(seq_counts), dtype=np.int64)
+    packets = len(seq_counts) - (QUARTET_PACKETS - 1)
+    if packets <= 0:
+        return runs
+
+    def step(first, second):
+        return (seq_counts[second] - seq_counts[first]) % SEQUENCE_COUNT_MODULO
+
+    def no_jump(first, second):
+        return np.abs(shcoarse[second] - shcoarse[first]) <= MAX_REORDER_SHCOARSE_JUMP
+
+    starts = np.arange(packets)
+    complete = pkt_counter[starts] == 0
+    for packet in range(1, QUARTET_PACKETS):
+        complete &= pkt_counter[starts + packet] == packet
+        complete &= step(starts + packet - 1, starts + packet) == 1
+        complete &= no_jump(starts + packet - 1, starts + packet)
+
+    # whether the group starting QUARTET_PACKETS later carries on the run
+    follows = np.zeros(packets, dtype=bool)
+    last = starts[: packets - QUARTET_PACKETS]
+    follows[: len(last)] = (
+        complete[last + QUARTET_PACKETS]
+        & (step(last + QUARTET_PACKETS - 1, last + QUARTET_PACKETS) > 0)
+        & (
+            step(last + QUARTET_PACKETS - 1, last + QUARTET_PACKETS)
+            < SEQUENCE_COUNT_MODULO // 2
+        )
+        & no_jump(last + QUARTET_PACKETS - 1, last + QUARTET_PACKETS)
+    )
+
+    # count along each chain of groups QUARTET_PACKETS apart, from its end backwards
+    for first in range(QUARTET_PACKETS):
+        chain_complete = complete[first::QUARTET_PACKETS]
+        chain_follows = follows[first::QUARTET_PACKETS] & chain_complete
+        positions = np.arange(len(chain_complete))
+        # the last group of the run each group is in
+        ends = np.where(chain_follows, len(chain_complete), positions)
+        ends = np.minimum.accumulate(ends[::-1])[::-1]
+        runs[first:packets:QUARTET_PACKETS] = np.where(
+            chain_complete, ends - positions + 1, 0
+        )
+    return runs
 
 
 class IALIRTDecoder:
 
     epoch = datetime(2010, 1, 1, 0, 0, 0)
 
-    @staticmethod
-    def toSigned16(n):
-        n = n & 0xFFFF
-        return n | (-(n & 0x8000))
-
     # in SC  packet the whole packet is 183 bytes long, mag data starts at byte offset 171 and is 12 bytes long. NO data after mag data
     # in MAG packet the whole packet is 24  bytes long, mag data starts at byte offset 10  and is 12 bytes long.  2 bytes after mag data
 
-    def __init__(self, folder, stream_type="mag"):
+    def __init__(
+        self,
+        folder,
+        stream_type="mag",
+        flush_policy: FlushPolicy = FLUSH_EVERY_PACKET,
+        output_format: OutputFormat = OutputFormat.csv,
+    ):
         self._writer = None
         self.base_path = folder
+        self.flush_policy = flush_policy
+        self.output_format = output_format
         self.last_time = None
         self.stream_type = stream_type
-        self.packet_group_sci_data = []
-        self.primary_science_time_coarse = None
-        self.primary_science_time_fine = None
-        self.secondary_science_time_coarse = None
-        self.secondary_science_time_fine = None
+        self.reorder_buffer = _QuartetReorderBuffer()
+
+    @staticmethod
+    def _mag_data_offset(apId) -> int:
+        if apId not in MAG_DATA_OFFSETS:
+            raise ValueError(f"Unsupported APID for I-ALiRT decoding: {hex(apId)}")
+        return MAG_DATA_OFFSETS[apId]
+
+    def _get_writer(self) -> _IALIRTFileWriter:
+        if self._writer is None:
+            self._writer = _IALIRTFileWriter(
+                folder=self.base_path,
+                packet_type=self.stream_type,
+                flush_policy=self.flush_policy,
+                output_format=self.output_format,
+            )
+        return self._writer
 
     def extract_packet_to_csv(
         self,
         apId,
         packet_bytes,
     ):
-        if apId == CONSTANTS.APID_SPACECRAFT_IALIRT:
-            offset = 171
-        elif apId == CONSTANTS.APID_MAG_IALIRT:
-            offset = 10
-        else:
-            raise ValueError(f"Unsupported APID for I-ALiRT decoding: {hex(apId)}")
+        offset = IALIRTDecoder._mag_data_offset(apId)
 
-        if not packet_bytes or len(packet_bytes) < offset + 12:
+        if not packet_bytes or len(packet_bytes) < offset + MAG_DATA_BYTES:
             print("Packet too short to contain mag data")
             return
 
-        mag_data_start = offset
-        course_4bytes = packet_bytes[mag_data_start : mag_data_start + 4]
-        fine_2bytes = packet_bytes[mag_data_start + 4 : mag_data_start + 6]
+        seq_count = int.from_bytes(packet_bytes[2:4], byteorder="big") & 0x3FFF
+        shcoarse = int.from_bytes(packet_bytes[6:10], byteorder="big")
+        mag_data = bytes(packet_bytes[offset : offset + MAG_DATA_BYTES])
+        # first 2 bits only of status byte 0 is pkt counter
+        pkt_counter = mag_data[6] >> 6 & 0b11
 
-        course = int.from_bytes(course_4bytes, byteorder="big", signed=False)
-        fine = int.from_bytes(fine_2bytes, byteorder="big", signed=False)
+        self._write_groups(
+            self.reorder_buffer.add(seq_count, shcoarse, pkt_counter, mag_data)
+        )
 
-        status_3bytes = packet_bytes[mag_data_start + 6 : mag_data_start + 9]
-        status = (
-            (packet_bytes[mag_data_start + 6] << 16)
-            | (packet_bytes[mag_data_start + 7] << 8)
-            | (packet_bytes[mag_data_start + 8] << 0)
-        ) & 0xFFFFFF
-        sci_3bytes = packet_bytes[mag_data_start + 9 : mag_data_start + 12]
-        # first 2 bits only of status byte 0 is pkt counter
-        pkt_counter = status_3bytes[0] >> 6 & 0b11
-
-        if pkt_counter == 0:
-            # reset the groups data
-            self.packet_group_sci_data = []
-            self.primary_science_time_coarse = None
-            self.primary_science_time_fine = None
-            self.secondary_science_time_coarse = None
-            self.secondary_science_time_fine = None
-
-        # save the chunk of science for pkt 4
-        self.packet_group_sci_data.extend(sci_3bytes)
-
-        if pkt_counter == 1:
-            self.primary_science_time_coarse = course
-            self.primary_science_time_fine = fine
-        elif pkt_counter == 2:
-            self.secondary_science_time_coarse = course
-            self.secondary_science_time_fine = fine
-
-        if pkt_counter == 3 and len(self.packet_group_sci_data) == 12:
-            # more hk info is over here
-            # https://github.com/ImperialCollegeLondon/IM-MAG-SW/blob/main/acceptance-tests/gseos/IMAP.8.7.044/Instruments/MAG_Common/ialirt_HKdecoder.py
-            FOB_RANGE = (status >> 3) & 0x3
-            FIB_RANGE = (status >> 1) & 0x3
-
-            decoded_pri_vector = [
-                IALIRTDecoder.toSigned16(
-                    ((self.packet_group_sci_data[0] << 8) & 0xFF00)
-                    | ((self.packet_group_sci_data[1] << 0) & 0x00FF)
-                ),
-                IALIRTDecoder.toSigned16(
-                    ((self.packet_group_sci_data[2] << 8) & 0xFF00)
-                    | ((self.packet_group_sci_data[3] << 0) & 0x00FF)
-                ),
-                IALIRTDecoder.toSigned16(
-                    ((self.packet_group_sci_data[4] << 8) & 0xFF00)
-                    | ((self.packet_group_sci_data[5] << 0) & 0x00FF)
-                ),
-            ]
-            decoded_sec_vector = [
-                IALIRTDecoder.toSigned16(
-                    ((self.packet_group_sci_data[6] << 8) & 0xFF00)
-                    | ((self.packet_group_sci_data[7] << 0) & 0x00FF)
-                ),
-                IALIRTDecoder.toSigned16(
-                    ((self.packet_group_sci_data[8] << 8) & 0xFF00)
-                    | ((self.packet_group_sci_data[9] << 0) & 0x00FF)
-                ),
-                IALIRTDecoder.toSigned16(
-                    ((self.packet_group_sci_data[10] << 8) & 0xFF00)
-                    | ((self.packet_group_sci_data[11] << 0) & 0x00FF)
-                ),
-            ]
-
-            pri = Vector(
-                decoded_pri_vector[0],
-                decoded_pri_vector[1],
-                decoded_pri_vector[2],
-                FOB_RANGE,
-            )
-            sec = Vector(
-                decoded_sec_vector[0],
-                decoded_sec_vector[1],
-                decoded_sec_vector[2],
-                FIB_RANGE,
-            )
+    def extract_packets_to_csv(
+        self,
+        apId,
+        data: np.ndarray,
+        offsets: np.ndarray,
+        lengths: np.ndarray,
+        seq_counts: np.ndarray,
+        shcoarse: np.ndarray,
+    ):
+        """
+        Decode a run of packets of this stream (at offsets into data, a uint8 array)
+        with the same result as calling extract_packet_to_csv for each in turn, but
+        with the vectors of all the groups they complete decoded and written together
+        """
+        offset = IALIRTDecoder._mag_data_offset(apId)
+
+        too_short = lengths < offset + MAG_DATA_BYTES
+        for _ in range(np.count_nonzero(too_short)):
+            print("Packet too short to contain mag data")
 
-            if self._writer is None:
-                self._writer = _IALIRTFileWriter(
-                    folder=self.base_path,
-                    packet_type=self.stream_type,
+        starts = offsets[~too_short] + offset
+        mag_data = data[starts[:, None] + np.arange(MAG_DATA_BYTES)]
+        seq_counts = seq_counts[~too_short].astype(np.int64)
+        shcoarse = shcoarse[~too_short].astype(np.int64)
+        pkt_counter = mag_data[:, 6] >> 6
+        quartets = _in_order_quartet_runs(seq_counts, shcoarse, pkt_counter)
+
+        # runs of complete quartets in order go straight through, and the reorder
+        # buffer only sees the packets around gaps and out of order packets
+        blocks = []
+        position = 0
+        while position < len(mag_data):
+            run = int(quartets[position])
+            if run and self.reorder_buffer.can_skip(
+                int(seq_counts[position]), int(shcoarse[position])
+            ):
+                end = position + run * QUARTET_PACKETS
+                blocks.append(mag_data[position:end])
+                self.reorder_buffer.skip(
+                    int(seq_counts[end - 1]), int(shcoarse[end - 1])
                 )
-
-            self._writer.write(
-                pri,
-                sec,
-                self.primary_science_time_coarse,
-                self.primary_science_time_fine,
-                self.secondary_science_time_coarse,
-                self.secondary_science_time_fine,
-                time_util.get_met_from_sci_timestamp(
-                    self.primary_science_time_coarse, self.primary_science_time_fine
-                ),
-                time_util.get_met_from_sci_timestamp(
-                    self.secondary_science_time_coarse, self.secondary_science_time_fine
-                ),
+                position = end
+                continue
+
+            groups = self.reorder_buffer.add(
+                int(seq_counts[position]),
+                int(shcoarse[position]),
+                int(pkt_counter[position]),
+                mag_data[position].tobytes(),
             )
+            if groups:
+                blocks.append(_group_bytes(groups))
+            position += 1
+
+        if blocks:
+            self._write_records(np.concatenate(blocks))
+
+    def _write_groups(self, groups: list):
+        """Decode and write the vectors of complete groups of 4 packets' mag data"""
+        if groups:
+            self._write_records(_group_bytes(groups))
+
+    def _write_records(self, mag_data: np.ndarray):
+        """Decode and write the vectors of complete groups of 4 packets' mag data, held
+        as a uint8 array with a row of MAG_DATA_BYTES per packet"""
+        records = (
+            np.ascontiguousarray(mag_data).view(MAG_DATA).reshape(-1, QUARTET_PACKETS)
+        )
+        # the 3 science bytes of the 4 packets are the big endian x, y, z of each sensor
+        xyz = records["sci"].reshape(-1, 12).view(">i2").astype(np.int32)
+        # more hk info is over here
+        # https://github.com/ImperialCollegeLondon/IM-MAG-SW/blob/main/acceptance-tests/gseos/IMAP.8.7.044/Instruments/MAG_Common/ialirt_HKdecoder.py
+        status = records["status"][:, 3, 2]
+        pri_coarse = records["coarse"][:, 1].astype(np.uint32)
+        pri_fine = records["fine"][:, 1].astype(np.uint16)
+        sec_coarse = records["coarse"][:, 2].astype(np.uint32)
+        sec_fine = records["fine"][:, 2].astype(np.uint16)
+
+        self._get_writer().write_rows(
+            Vector(xyz[:, 0], xyz[:, 1], xyz[:, 2], (status >> 3) & 0x3),
+            Vector(xyz[:, 3], xyz[:, 4], xyz[:, 5], (status >> 1) & 0x3),
+            pri_coarse,
+            pri_fine,
+            sec_coarse,
+            sec_fine,
+            time_util.get_met_from_sci_timestamps(pri_coarse, pri_fine),
+            time_util.get_met_from_sci_timestamps(sec_coarse, sec_fine),
+        )
 
     def close_all(self):
+        self._write_groups(self.reorder_buffer.drain())
+        if self.reorder_buffer.incomplete_groups or self.reorder_buffer.dropped_packets:
+            print(
+                f"I-ALiRT {self.stream_type} stream had {self.reorder_buffer.incomplete_groups} incomplete packet groups and dropped {self.reorder_buffer.dropped_packets} late or repeated packets"
+            )
         if self._writer is not None:
             self._writer.close()
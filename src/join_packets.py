@@ -0,0 +1,282 @@
+import os
+import re
+import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import typer
+from rich.progress import Progress
+
+from packet_archive import ARCHIVE_SUFFIX, PacketArchive
+from packet_index import MAX_PACKET_BYTES, PacketIndex
+from packet_sort import OUTPUT_BUFFER_BYTES, sort_order
+from packet_util import parse_apids
+
+app = typer.Typer()
+
+# the packets are read from a pool of threads, so many files are being opened at once
+# rather than each waiting on the file system (slow on network shares)
+JOIN_READER_THREADS = 16
+JOIN_READS_IN_FLIGHT = 1024
+# packets next to each other in an archive are read together, up to this many bytes
+JOIN_READ_BYTES = 1024 * 1024
+# the reads waiting to be written hold at most this many bytes (a packet read from its
+# own file counts as the largest packet there can be)
+JOIN_READ_BYTES_IN_FLIGHT = 32 * 1024 * 1024
+# length of the packets saved to their own file, which are read whole
+WHOLE_FILE = -1
+
+SPLIT_PACKET_FILE_NAME = re.compile(r"(\d+)-(\d+)\.bin")
+MAX_SHCOARSE = 0xFFFF_FFFF
+MAX_SEQ_COUNT = 0x3FFF
+
+
+@app.callback(
+    invoke_without_command=True
+)  # use callback because we want this to be the default command
+def join_packets(
+    split_folders: List[Path] = typer.Argument(
+        ...,
+        help=f"Folder(s) written by split-packets, holding <apid> folders of <SHCOARSE>-<seq count>.bin packet files or <apid>{ARCHIVE_SUFFIX} and <apid>_<hour or day>{ARCHIVE_SUFFIX} archives (from --packed). Where folders have the same packet, the one in the first folder given is kept",
+    ),
+    output_file: Optional[Path] = typer.Option(
+        None,
+        "--output-file",
+        "-o",
+        help="Output file path for the joined packets. Defaults to joined_[timestamp].bin in the first folder",
+    ),
+    force: bool = typer.Option(
+        False, "--force", "-f", help="Allow the overwrite of the output file"
+    ),
+    apids: Optional[List[str]] = typer.Option(
+        (),
+        "--apid",
+        help="Restrict the results to packets with one or more specificied ApIDs. Defaults to all ApIDs.",
+    ),
+    mag_only: bool = typer.Option(
+        True,
+        "--mag-only/--all",
+        help="mag-only = only process MAG packets and ignore ApIDs outside of the MAG range, all = process all packets inc spacecraft and other instruments",
+    ),
+):
+    """
+    Join the packets saved by split-packets back into one CCSDS file, sorted by SHCOARSE, ApID and seq count and with duplicates removed. The packets are ordered by their file names (or archive indexes) so no packet headers are read.
+    """
+    _validate_join_packets_args(split_folders, apids)
+
+    if not output_file:
+        output_file = (
+            split_folders[0] / f"joined_{datetime.now().strftime('%Y%m%d%H%M%S')}.bin"
+        )
+    if output_file.exists() and not force:
+        print(
+            f"{output_file} already exists - use --force to overwrite it",
+            file=sys.stderr,
+        )
+        raise typer.Abort()
+
+    index, sources, paths = _index_split_folders(split_folders)
+    selected = index.select(mag_only, parse_apids(apids))
+    index = index.take(selected)
+    sources = sources[selected]
+
+    # the sort is stable, so of the packets with the same key the first one listed is kept
+    order = sort_order(index)
+    keys = index.keys()[order]
+    keep = np.concatenate(([True], keys[1:] != keys[:-1]))
+    duplicates = int(np.count_nonzero(~keep))
+    order = order[keep]
+
+    bytes_written = _write_joined_packets(
+        output_file, index.take(order), sources[order], paths
+    )
+
+    if duplicates:
+        print(
+            f"Skipped {duplicates} duplicate packets with the same ApID, SHCOARSE and seq count as a packet kept"
+        )
+    print(
+        f"Joined {len(order)} packets from {', '.join(str(folder) for folder in split_folders)} into {output_file} ({bytes_written} bytes)"
+    )
+
+
+def _index_split_folders(
+    split_folders: List[Path],
+) -> tuple[PacketIndex, np.ndarray, List[str]]:
+    """
+    An index of the packets in split-packets output, made from the names of the packet
+    files and the indexes of the archives - offset and length are where the packet is
+    in its file, with length WHOLE_FILE for packets saved to their own file. Also the
+    number of the file each packet is in, and the paths of the files in the order the
+    folders are given.
+    """
+    paths: List[str] = []
+    parts: List[tuple] = []
+    for split_folder in split_folders:
+        for apid_folder in sorted(os.scandir(split_folder), key=lambda e: e.name):
+            if not apid_folder.is_dir() or not apid_folder.name.isdigit():
+                continue
+            apid = int(apid_folder.name)
+
+            names = []
+            for entry in os.scandir(apid_folder.path):
+                match = SPLIT_PACKET_FILE_NAME.fullmatch(entry.name)
+                if match:
+                    names.append((int(match[1]), int(match[2]), entry.path))
+                elif entry.name == f"{apid}{ARCHIVE_SUFFIX}" or (
+                    entry.name.startswith(f"{apid}_")
+                    and entry.name.endswith(ARCHIVE_SUFFIX)
+                ):
+                    parts.append(_archive_part(Path(entry.path), apid, len(paths)))
+                    paths.append(entry.path)
+            names = [
+                name
+                for name in names
+                if name[0] <= MAX_SHCOARSE and name[1] <= MAX_SEQ_COUNT
+            ]
+            if names:
+                shcoarse, seq_count, files = zip(*names)
+                parts.append(
+                    (
+                        np.zeros(len(files), dtype=np.int64),
+                        np.full(len(files), WHOLE_FILE, dtype=np.int64),
+                        np.full(len(files), apid, dtype=np.uint16),
+                        np.array(seq_count, dtype=np.uint16),
+                        np.array(shcoarse, dtype=np.uint32),
+                        np.arange(len(paths), len(paths) + len(files)),
+                    )
+                )
+                paths.extend(files)
+
+    columns = [
+        (
+            np.concatenate([part[column] for part in parts])
+            if parts
+            else np.zeros(0, dtype=np.int64)
+        )
+        for column in range(6)
+    ]
+    return PacketIndex(*columns[:5]), columns[5], paths
+
+
+def _archive_part(path: Path, apid: int, source: int) -> tuple:
+    records = PacketArchive(path).records
+    return (
+        records["offset"].astype(np.int64),
+        records["length"].astype(np.int64),
+        np.full(len(records), apid, dtype=np.uint16),
+        records["seq_count"],
+        records["shcoarse"],
+        np.full(len(records), source, dtype=np.int64),
+    )
+
+
+def _write_joined_packets(
+    output_file: Path, index: PacketIndex, sources: np.ndarray, paths: List[str]
+) -> int:
+    """Copy the packets to output_file in order, reading the packets that are next to
+    each other in an archive up to JOIN_READ_BYTES at a time, with at most
+    JOIN_READS_IN_FLIGHT reads of JOIN_READ_BYTES_IN_FLIGHT bytes in all waiting to be
+    written. Returns bytes written"""
+    starts, ends = _read_stretches(index, sources)
+    bytes_written = 0
+    with Progress(refresh_per_second=1) as progress, ThreadPoolExecutor(
+        max_workers=JOIN_READER_THREADS
+    ) as pool, open(output_file, "wb", buffering=OUTPUT_BUFFER_BYTES) as output:
+        task = progress.add_task(f"Joining into {output_file}", total=len(index))
+        reads: deque[tuple[Future, int]] = deque()
+        bytes_in_flight = 0
+
+        def write_next():
+            nonlocal bytes_written, bytes_in_flight
+            future, read_bytes = reads.popleft()
+            bytes_in_flight -= read_bytes
+            packets = future.result()
+            output.write(packets)
+            bytes_written += len(packets)
+
+        offsets = index.offset[starts]
+        lengths = np.where(
+            index.length[starts] == WHOLE_FILE,
+            WHOLE_FILE,
+            index.offset[ends - 1] + index.length[ends - 1] - offsets,
+        )
+        for read, (source, offset, length, end) in enumerate(
+            zip(
+                sources[starts].tolist(),
+                offsets.tolist(),
+                lengths.tolist(),
+                ends.tolist(),
+            )
+        ):
+            read_bytes = MAX_PACKET_BYTES if length == WHOLE_FILE else length
+            while reads and (
+                len(reads) >= JOIN_READS_IN_FLIGHT
+                or bytes_in_flight + read_bytes > JOIN_READ_BYTES_IN_FLIGHT
+            ):
+                write_next()
+            reads.append(
+                (pool.submit(_read_packets, paths[source], offset, length), read_bytes)
+            )
+            bytes_in_flight += read_bytes
+            if read % JOIN_READS_IN_FLIGHT == 0:
+                progress.update(task, completed=end)
+        while reads:
+            write_next()
+        progress.update(task, completed=len(index))
+
+    return bytes_written
+
+
+def _read_stretches(
+    index: PacketIndex, sources: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Start and end positions of the stretches of packets to read in one go - packets
+    one after the other in the same archive, up to JOIN_READ_BYTES"""
+    if len(index) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    follows = (
+        (sources[1:] == sources[:-1])
+        & (index.length[:-1] != WHOLE_FILE)
+        & (index.offset[1:] == index.offset[:-1] + index.length[:-1])
+    )
+    # split the stretches where they cross a multiple of JOIN_READ_BYTES from their start
+    stretch = np.concatenate(([0], np.cumsum(~follows)))
+    stretch_offset = index.offset[np.concatenate(([0], np.flatnonzero(~follows) + 1))]
+    block = (index.offset - stretch_offset[stretch]) // JOIN_READ_BYTES
+    follows &= block[1:] == block[:-1]
+
+    starts = np.concatenate(([0], np.flatnonzero(~follows) + 1))
+    ends = np.concatenate((starts[1:], [len(index)]))
+    return starts, ends
+
+
+def _read_packets(path: str, offset: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        if length == WHOLE_FILE:
+            return f.read()
+        f.seek(offset)
+        return f.read(length)
+
+
+def _validate_join_packets_args(split_folders: List[Path], apids: List[str] | None):
+    for split_folder in split_folders:
+        if not split_folder.is_dir():
+            print(f"{split_folder} is not a folder")
+            raise typer.Abort()
+
+    if apids:
+        for apid in apids:
+            # ensure it is an int or an int in hex format
+            if not re.match(r"^(0(x|X))?[0-9a-fA-F]+$", apid):
+                print(f"Invalid APID: {apid}")
+                raise typer.Abort()
+
+
+# only needed when this file is run as its own app
+if __name__ == "__main__":
+    app()
@@ -8,6 +8,7 @@ import typer
 
 import check_gaps
 import filter_packets
+import join_packets
 import parse_packets
 import split_packets
 
@@ -17,6 +18,7 @@ app.add_typer(check_gaps.app, name="check-gap")
 app.add_typer(split_packets.app, name="split-packets")
 app.add_typer(filter_packets.app, name="filter-packets")
 app.add_typer(parse_packets.app, name="parse-packets")
+app.add_typer(join_packets.app, name="join-packets")
 
 
 @app.command()
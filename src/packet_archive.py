@@ -0,0 +1,154 @@
+import os
+import sys
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+from packet_index import (
+    PacketIndex,
+    build_packet_index,
+    open_for_append,
+    read_packet_file,
+    write_packets,
+)
+
+ARCHIVE_SUFFIX = ".pkts"
+ARCHIVE_INDEX_SUFFIX = ".pktoff"
+# one fixed size record per packet in the archive, in the order they were appended
+ARCHIVE_INDEX_DTYPE = np.dtype(
+    [
+        ("shcoarse", "<u4"),
+        ("seq_count", "<u2"),
+        ("offset", "<u8"),
+        ("length", "<u4"),
+    ]
+)
+
+
+def archive_keys(shcoarse: np.ndarray, seq_count: np.ndarray) -> np.ndarray:
+    """Unique id (SHCOARSE, seq count) of packets of one ApID packed into a uint64"""
+    return (shcoarse.astype(np.uint64) << np.uint64(14)) | seq_count.astype(np.uint64)
+
+
+class PacketArchive:
+    """
+    An append-only file of the packets of one ApID (written by split-packets --packed),
+    with a .pktoff index next to it holding the SHCOARSE, seq count, offset and length
+    of each packet, so any packet can be read without one file per packet. Packets
+    are looked up by a binary search of their keys, sorted when first needed.
+    The packets are appended before their index records, so if a write is interrupted
+    (or the index is lost) the packets missing from the index are indexed again from
+    their headers the next time it is opened, and a packet cut off part way through
+    is trimmed off.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.index_path = Path(f"{path}{ARCHIVE_INDEX_SUFFIX}")
+        self.records = self._read_index()
+        self._sorted_keys = None
+        self._sorted_positions = None
+        self._repair()
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def size(self) -> int:
+        if len(self.records) == 0:
+            return 0
+        return int(self.records["offset"][-1] + self.records["length"][-1])
+
+    def keys(self) -> np.ndarray:
+        return archive_keys(self.records["shcoarse"], self.records["seq_count"])
+
+    def append(
+        self,
+        data: np.ndarray,
+        index: PacketIndex,
+        positions: List[int],
+        packet_file: Path | None = None,
+    ) -> int:
+        """Append the indexed packets at positions (in that order). Returns bytes written"""
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(positions) == 0:
+            return 0
+        records = np.zeros(len(positions), dtype=ARCHIVE_INDEX_DTYPE)
+        records["shcoarse"] = index.shcoarse[positions]
+        records["seq_count"] = index.seq_count[positions]
+        records["length"] = index.length[positions]
+        records["offset"] = self.size + np.concatenate(
+            ([0], np.cumsum(index.length[positions])[:-1])
+        ).astype(np.uint64)
+
+        if not self.path.parent.exists():
+            self.path.parent.mkdir(parents=True)
+        with open_for_append(self.path) as f:
+            bytes_written = write_packets(f, data, index, positions, packet_file)
+        with open(self.index_path, "ab") as f:
+            f.write(records.tobytes())
+
+        self.records = np.concatenate((self.records, records))
+        self._sorted_keys = None
+        return bytes_written
+
+    def read_packet(self, shcoarse: int, seq_count: int) -> bytes | None:
+        """The packet with this SHCOARSE and seq count, or None if it is not archived"""
+        if self._sorted_keys is None:
+            keys = self.keys()
+            self._sorted_positions = np.argsort(keys, kind="stable")
+            self._sorted_keys = keys[self._sorted_positions]
+        key = archive_keys(np.array([shcoarse]), np.array([seq_count]))[0]
+        found = int(np.searchsorted(self._sorted_keys, key))
+        if found == len(self._sorted_keys) or self._sorted_keys[found] != key:
+            return None
+        record = self.records[self._sorted_positions[found]]
+        with open(self.path, "rb") as f:
+            f.seek(int(record["offset"]))
+            return f.read(int(record["length"]))
+
+    def _read_index(self) -> np.ndarray:
+        if not self.index_path.exists():
+            return np.zeros(0, dtype=ARCHIVE_INDEX_DTYPE)
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        # a partly written last record is dropped
+        whole = len(data) - len(data) % ARCHIVE_INDEX_DTYPE.itemsize
+        return np.frombuffer(data[:whole], dtype=ARCHIVE_INDEX_DTYPE).copy()
+
+    def _repair(self):
+        """Make the archive and its index agree after an interrupted write"""
+        archive_size = os.path.getsize(self.path) if self.path.exists() else 0
+        index_size = os.path.getsize(self.index_path) if self.index_path.exists() else 0
+        if (
+            archive_size == self.size
+            and index_size == len(self.records) * ARCHIVE_INDEX_DTYPE.itemsize
+        ):
+            return
+
+        # drop the records of packets past the end of the archive
+        ends = self.records["offset"] + self.records["length"]
+        self.records = self.records[: int(np.count_nonzero(ends <= archive_size))]
+        indexed = len(self.records)
+
+        # and index the packets after the last one indexed from their headers
+        if archive_size > self.size:
+            tail = read_packet_file(self.path, use_mmap=True)[self.size :]
+            index = build_packet_index(tail, allow_partial=True)
+            records = np.zeros(len(index), dtype=ARCHIVE_INDEX_DTYPE)
+            records["shcoarse"] = index.shcoarse
+            records["seq_count"] = index.seq_count
+            records["offset"] = self.size + index.offset
+            records["length"] = index.length
+            self.records = np.concatenate((self.records, records))
+            del tail
+
+        print(
+            f"Packet archive {self.path} was not completely written - {indexed} packets were in {self.index_path}, {len(self.records) - indexed} more were indexed from the archive and it was trimmed to {self.size} bytes",
+            file=sys.stderr,
+        )
+        if self.path.exists():
+            os.truncate(self.path, self.size)
+        with open(self.index_path, "wb") as f:
+            f.write(self.records.tobytes())
@@ -0,0 +1,282 @@
+import os
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from packet_index import PacketFileReader
+
+# packet keys (see PacketIndex.keys) use the low 57 bits, so all ones is never a key
+EMPTY_SLOT = np.uint64(0xFFFF_FFFF_FFFF_FFFF)
+NO_VALUE = np.uint64(0xFFFF_FFFF_FFFF_FFFF)
+MIN_CAPACITY = 1024
+MAX_LOAD = 0.5
+# Fibonacci hashing spreads the keys of consecutive packets over the whole table
+HASH_MULTIPLIER = np.uint64(0x9E37_79B9_7F4A_7C15)
+SHCOARSE_SHIFT = np.uint64(14)
+SHCOARSE_MASK = np.uint64(0xFFFF_FFFF)
+
+KEY_STORE_SUFFIX = ".pktkeys"
+# the format version is part of the magic so an old sidecar is simply rebuilt
+KEY_STORE_MAGIC = b"PKTKEYS1"
+
+DEDUPE_WINDOW_HELP = "Only dedupe against packets up to this many seconds (of SHCOARSE) older than the newest packet seen, so memory use stays bounded on long runs. 0 = dedupe against every packet seen"
+
+
+def packet_digests(
+    data: np.ndarray, offsets: np.ndarray, lengths: np.ndarray
+) -> np.ndarray:
+    """The CRC-32 of each packet, to tell apart packets with the same key"""
+    view = memoryview(data)
+    return np.fromiter(
+        (
+            zlib.crc32(view[offset : offset + length])
+            for offset, length in zip(offsets.tolist(), lengths.tolist())
+        ),
+        dtype=np.uint32,
+        count=len(offsets),
+    )
+
+
+def _shcoarse_of(keys: np.ndarray) -> np.ndarray:
+    return (keys >> SHCOARSE_SHIFT) & SHCOARSE_MASK
+
+
+class PacketKeySet:
+    """
+    The keys of the packets seen so far, for deduping packets. Keys are held in a numpy
+    open addressing hash table with linear probing, so each key takes 16 bytes (8 bytes
+    a slot, at most half of the slots used) rather than the 200+ of a Python set, and
+    whole files of keys are checked and added with array operations.
+    With window_seconds, keys with a SHCOARSE more than that many seconds before the
+    newest key added are no longer seen as duplicates and are dropped when the table
+    next grows, so memory use is bounded by the packets in the window.
+    With with_values, a uint64 value (such as where the packet was found) is kept for
+    each key as well, for another 16 bytes a key.
+    """
+
+    def __init__(self, window_seconds: int = 0, with_values: bool = False):
+        self.window_seconds = window_seconds
+        self.newest_shcoarse = 0
+        self._slots = np.full(MIN_CAPACITY, EMPTY_SLOT)
+        self._values = np.full(MIN_CAPACITY, NO_VALUE) if with_values else None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key: int) -> bool:
+        return bool(self.contains(np.array([key], dtype=np.uint64))[0])
+
+    @property
+    def horizon(self) -> int:
+        """The oldest SHCOARSE that is still deduped against"""
+        if not self.window_seconds:
+            return 0
+        return max(0, self.newest_shcoarse - self.window_seconds)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        """True for each key that has been added (and is inside the window)"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        found = self._slots[self._find(keys)] == keys
+        if self.window_seconds:
+            found &= _shcoarse_of(keys) >= self.horizon
+        return found
+
+    def first_seen(self, keys: np.ndarray) -> np.ndarray:
+        """True for each key that has not been added and is not earlier in keys either,
+        i.e. the packets to keep. Nothing is added"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        first = np.zeros(len(keys), dtype=bool)
+        first[np.unique(keys, return_index=True)[1]] = True
+        return first & ~self.contains(keys)
+
+    def values_of(self, keys: np.ndarray) -> np.ndarray:
+        """The value kept for each key, or NO_VALUE for keys that have not been added
+        (or were added without a value)"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        slots = self._find(keys)
+        return np.where(self._slots[slots] == keys, self._values[slots], NO_VALUE)
+
+    def add(self, keys: np.ndarray, values: np.ndarray | None = None):
+        """Add keys, and their values if the set keeps them. A key that is added more
+        than once keeps its first value"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(keys) == 0:
+            return
+        if self._values is not None:
+            order = np.argsort(keys, kind="stable")
+            values = (
+                np.full(len(keys), NO_VALUE)
+                if values is None
+                else np.asarray(values, dtype=np.uint64)[order]
+            )
+            keys = keys[order]
+        else:
+            keys = np.sort(keys)
+        new = np.concatenate(([True], keys[1:] != keys[:-1]))
+        self.newest_shcoarse = max(self.newest_shcoarse, int(_shcoarse_of(keys).max()))
+        new[new] = self._slots[self._find(keys[new])] != keys[new]
+        keys = keys[new]
+        values = values[new] if self._values is not None else None
+        if self._count + len(keys) > len(self._slots) * MAX_LOAD:
+            self._rebuild(len(keys))
+        self._insert(keys, values)
+
+    def _home_slots(self, keys: np.ndarray) -> np.ndarray:
+        bits = np.uint64(64 - (len(self._slots).bit_length() - 1))
+        return ((keys * HASH_MULTIPLIER) >> bits).astype(np.int64)
+
+    def _find(self, keys: np.ndarray) -> np.ndarray:
+        """The slot holding each key, or the empty slot its probe stopped at"""
+        slots = self._home_slots(keys)
+        pending = np.arange(len(keys))
+        last_slot = len(self._slots) - 1
+        while len(pending):
+            found = self._slots[slots[pending]]
+            pending = pending[(found != keys[pending]) & (found != EMPTY_SLOT)]
+            slots[pending] = (slots[pending] + 1) & last_slot
+        return slots
+
+    def _insert(self, keys: np.ndarray, values: np.ndarray | None):
+        """Put unique keys that are not in the table yet into empty slots"""
+        slots = self._home_slots(keys)
+        pending = np.arange(len(keys))
+        last_slot = len(self._slots) - 1
+        while len(pending):
+            free = pending[self._slots[slots[pending]] == EMPTY_SLOT]
+            # when keys want the same free slot one of them gets it and the rest move on
+            self._slots[slots[free]] = keys[free]
+            if values is not None:
+                placed = free[self._slots[slots[free]] == keys[free]]
+                self._values[slots[placed]] = values[placed]
+            pending = pending[self._slots[slots[pending]] != keys[pending]]
+            slots[pending] = (slots[pending] + 1) & last_slot
+        self._count += len(keys)
+
+    def _rebuild(self, extra_keys: int):
+        """Resize the table to fit extra_keys more, dropping keys outside the window"""
+        used = self._slots != EMPTY_SLOT
+        if self.window_seconds:
+            used &= _shcoarse_of(self._slots) >= self.horizon
+        keys = self._slots[used]
+        values = self._values[used] if self._values is not None else None
+        capacity = MIN_CAPACITY
+        while (len(keys) + extra_keys) > capacity * MAX_LOAD:
+            capacity *= 2
+        self._slots = np.full(capacity, EMPTY_SLOT)
+        if values is not None:
+            self._values = np.full(capacity, NO_VALUE)
+        self._count = 0
+        self._insert(keys, values)
+
+
+class PacketKeyStore:
+    """
+    The keys of the packets in a packet file that is appended to, kept in a .pktkeys
+    sidecar next to it so that later appends can be deduped against it without reading
+    the packet file again. The sidecar holds sorted runs of keys that are memory mapped,
+    so a lookup only reads the pages it touches. Keys added are written as a new run,
+    merged with the runs before it that are less than twice its size, so there are only
+    ever a few runs and an append costs time in proportion to the keys added.
+    Each run records the size of the packet file it covers, and if the packet file is a
+    different size when the sidecar is opened (it was written to without the sidecar,
+    or a write was interrupted) the sidecar is rebuilt from the packet file.
+    """
+
+    def __init__(self, packet_file: Path):
+        self.packet_file = packet_file
+        self.path = Path(f"{packet_file}{KEY_STORE_SUFFIX}")
+        self._load()
+        if self._packet_file_size != _file_size(packet_file):
+            if self.path.exists():
+                print(
+                    f"Dedupe store {self.path} is out of date - rebuilding it from {packet_file}"
+                )
+            self._rebuild()
+
+    def __len__(self):
+        return sum(len(run) for run in self._runs)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        """True for each key that is in the packet file"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self._runs:
+            if len(run) == 0:
+                continue
+            positions = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+            found |= run[positions] == keys
+        return found
+
+    def add(self, keys: np.ndarray):
+        """Record the keys of packets that have just been appended to the packet file"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        keys = np.sort(keys[~self.contains(keys)])
+        if len(keys) == 0:
+            return
+        keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+
+        first = len(self._runs)
+        while first > 0 and len(self._runs[first - 1]) < 2 * len(keys):
+            first -= 1
+            keys = np.concatenate((self._runs[first], keys))
+        keys.sort()
+        run_start = self._run_starts[first]
+
+        self._runs = []  # release the memory map before the file is truncated
+        with open(self.path, "r+b") as f:
+            f.truncate(run_start)
+            f.seek(run_start)
+            _write_run(f, keys, _file_size(self.packet_file))
+        self._load()
+
+    def _load(self):
+        """Map the runs of the sidecar, or none if it is missing or damaged"""
+        self._runs: list[np.ndarray] = []
+        self._run_starts = [len(KEY_STORE_MAGIC)]
+        self._packet_file_size = None
+        try:
+            with open(self.path, "rb") as f:
+                if f.read(len(KEY_STORE_MAGIC)) != KEY_STORE_MAGIC:
+                    return
+            values = np.memmap(self.path, dtype="<u8", mode="r")
+        except (OSError, ValueError):
+            return
+
+        position = len(KEY_STORE_MAGIC) // 8
+        packet_file_size = 0
+        while position + 2 <= len(values):
+            count, packet_file_size = int(values[position]), int(values[position + 1])
+            if position + 2 + count > len(values):
+                return
+            self._runs.append(values[position + 2 : position + 2 + count])
+            position += 2 + count
+            self._run_starts.append(position * 8)
+        if position == len(values):
+            self._packet_file_size = packet_file_size
+        else:
+            self._runs = []
+
+    def _rebuild(self):
+        keys = np.zeros(0, dtype=np.uint64)
+        if _file_size(self.packet_file):
+            with PacketFileReader(self.packet_file) as reader:
+                keys = np.unique(reader.index.keys())
+
+        self._runs = []
+        temp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(KEY_STORE_MAGIC)
+            _write_run(f, keys, _file_size(self.packet_file))
+        os.replace(temp_path, self.path)
+        self._load()
+
+
+def _file_size(path: Path) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _write_run(f, keys: np.ndarray, packet_file_size: int):
+    f.write(np.array([len(keys), packet_file_size], dtype="<u8").tobytes())
+    f.write(keys.astype("<u8").tobytes())
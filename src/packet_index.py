@@ -0,0 +1,545 @@
+import errno
+import mmap
+import os
+import sys
+from pathlib import Path
+from typing import Iterator, List
+
+import numpy as np
+
+from constants import CONSTANTS
+from parallel import map_in_processes
+
+PRIMARY_HEADER_BYTES = 6
+MAX_PACKET_BYTES = 0xFFFF + PRIMARY_HEADER_BYTES + 1
+# shorter runs of packets are quicker to write from memory than to copy in the kernel
+KERNEL_COPY_MIN_BYTES = 64 * 1024
+COPY_CHUNK_BYTES = 1024 * 1024
+SHCOARSE_OFFSET = PRIMARY_HEADER_BYTES
+SCIENCE_HEADER_BYTES = 27  # primary header + secondary header up to VECTOR_DATA
+SCIENCE_HEADER_FIELDS = [
+    "PUS_STYPE",
+    "PUS_SSUBTYPE",
+    "COMPRESSION",
+    "FOB_ACT",
+    "FIB_ACT",
+    "PRI_SENS",
+    "PRI_VECSEC",
+    "SEC_VECSEC",
+    "PRI_COARSETM",
+    "PRI_FNTM",
+    "SEC_COARSETM",
+    "SEC_FNTM",
+]
+
+INDEX_CACHE_SUFFIX = ".pktidx"
+INDEX_CACHE_VERSION = 1
+
+
+class PacketIndex:
+    """
+    Header fields for every packet in a CCSDS file, held as one numpy array per field
+    so that commands can filter, dedupe and route packets with array operations rather
+    than decoding each packet with ccsdspy.
+    """
+
+    def __init__(
+        self,
+        offset: np.ndarray,
+        length: np.ndarray,
+        apid: np.ndarray,
+        seq_count: np.ndarray,
+        shcoarse: np.ndarray,
+        science: dict[str, np.ndarray] | None = None,
+    ):
+        self.offset = offset
+        self.length = length
+        self.apid = apid
+        self.seq_count = seq_count
+        self.shcoarse = shcoarse
+        # science sub-header fields for every packet (zero for non science packets), if known
+        self.science = science
+
+    def __len__(self):
+        return len(self.offset)
+
+    @property
+    def packet_length(self) -> np.ndarray:
+        """The CCSDS_PACKET_LENGTH header field, i.e. the packet data length minus 1"""
+        return self.length - (PRIMARY_HEADER_BYTES + 1)
+
+    @property
+    def total_bytes(self) -> int:
+        return int(self.length.sum())
+
+    def keys(self) -> np.ndarray:
+        """Unique packet id (ApID, SHCOARSE, seq count) packed into a single uint64"""
+        return (
+            (self.apid.astype(np.uint64) << np.uint64(46))
+            | (self.shcoarse.astype(np.uint64) << np.uint64(14))
+            | self.seq_count.astype(np.uint64)
+        )
+
+    def select(self, mag_only: bool, apid_filter: List[int]) -> np.ndarray:
+        """Positions of the packets that pass the --mag-only/--all and --apid filters"""
+        keep = np.ones(len(self), dtype=bool)
+        if mag_only:
+            keep &= (self.apid >= CONSTANTS.APID_MAG_START) & (
+                self.apid <= CONSTANTS.APID_MAG_END
+            )
+        if apid_filter:
+            keep &= np.isin(self.apid, apid_filter)
+        return np.flatnonzero(keep)
+
+    def science_mask(self) -> np.ndarray:
+        """True for MAG normal/burst science packets long enough to hold the science headers"""
+        return np.isin(
+            self.apid, [CONSTANTS.APID_MAG_SCIENCE_NM, CONSTANTS.APID_MAG_SCIENCE_BM]
+        ) & (self.length >= SCIENCE_HEADER_BYTES)
+
+    def take(self, positions: np.ndarray) -> "PacketIndex":
+        return PacketIndex(
+            self.offset[positions],
+            self.length[positions],
+            self.apid[positions],
+            self.seq_count[positions],
+            self.shcoarse[positions],
+            (
+                {field: values[positions] for field, values in self.science.items()}
+                if self.science is not None
+                else None
+            ),
+        )
+
+
+def _frame_packets(
+    data: np.ndarray, allow_partial: bool = False
+) -> tuple[np.ndarray, np.ndarray]:
+    """Walk the packet lengths to find where each packet starts. This is the only part
+    that has to be sequential, everything else is then read at the known offsets.
+    With allow_partial a packet cut off at the end of data is left out without a warning
+    """
+    raw = data.data
+    size = len(data)
+    offsets = []
+    lengths = []
+    offset = 0
+    while offset + PRIMARY_HEADER_BYTES <= size:
+        packet_bytes = (
+            ((raw[offset + 4] << 8) | raw[offset + 5]) + PRIMARY_HEADER_BYTES + 1
+        )
+        if offset + packet_bytes > size:
+            break
+        offsets.append(offset)
+        lengths.append(packet_bytes)
+        offset += packet_bytes
+
+    if offset != size and not allow_partial:
+        print(
+            f"WARNING: File appears truncated - {size - offset} trailing bytes do not form a complete packet and were ignored",
+            file=sys.stderr,
+        )
+
+    return np.array(offsets, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+
+def _read_uint(data: np.ndarray, positions: np.ndarray, byte_count: int) -> np.ndarray:
+    """Read a big endian unsigned int of byte_count bytes at each position"""
+    value = np.zeros(len(positions), dtype=np.uint64)
+    for i in range(byte_count):
+        value = (value << np.uint64(8)) | data[positions + i].astype(np.uint64)
+    return value
+
+
+def read_packet_lengths(data: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """The total length of the packets at offsets, from their primary headers"""
+    return (_read_uint(data, offsets + 4, 2) + (PRIMARY_HEADER_BYTES + 1)).astype(
+        np.int64
+    )
+
+
+def build_packet_index(data: np.ndarray, allow_partial: bool = False) -> PacketIndex:
+    """Index every complete packet in a buffer of CCSDS packets (as uint8 array)"""
+    offset, length = _frame_packets(data, allow_partial)
+
+    if len(offset) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return PacketIndex(
+            empty,
+            empty,
+            empty.astype(np.uint16),
+            empty.astype(np.uint16),
+            empty.astype(np.uint32),
+        )
+
+    apid = (_read_uint(data, offset, 2) & np.uint64(0x07FF)).astype(np.uint16)
+    seq_count = (_read_uint(data, offset + 2, 2) & np.uint64(0x3FFF)).astype(np.uint16)
+
+    # SHCOARSE is the first field of the secondary header, packets too short to have one read as 0
+    has_shcoarse = length >= SHCOARSE_OFFSET + 4
+    shcoarse = np.zeros(len(offset), dtype=np.uint32)
+    shcoarse[has_shcoarse] = _read_uint(
+        data, offset[has_shcoarse] + SHCOARSE_OFFSET, 4
+    ).astype(np.uint32)
+
+    return PacketIndex(offset, length, apid, seq_count, shcoarse)
+
+
+def read_science_headers(data: np.ndarray, offset: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Read the MAG science secondary header fields (see get_imap_science_packet_def)
+    for every science packet starting at the given offsets
+    """
+    offset = np.asarray(offset, dtype=np.int64)
+    flags = data[offset + 13]
+    vecsec = data[offset + 14]
+    return {
+        "PUS_STYPE": data[offset + 11],
+        "PUS_SSUBTYPE": data[offset + 12],
+        "COMPRESSION": (flags >> 7) & 0b1,
+        "FOB_ACT": (flags >> 6) & 0b1,
+        "FIB_ACT": (flags >> 5) & 0b1,
+        "PRI_SENS": (flags >> 4) & 0b1,
+        "PRI_VECSEC": (vecsec >> 5) & 0b111,
+        "SEC_VECSEC": (vecsec >> 2) & 0b111,
+        "PRI_COARSETM": _read_uint(data, offset + 15, 4).astype(np.uint32),
+        "PRI_FNTM": _read_uint(data, offset + 19, 2).astype(np.uint16),
+        "SEC_COARSETM": _read_uint(data, offset + 21, 4).astype(np.uint32),
+        "SEC_FNTM": _read_uint(data, offset + 25, 2).astype(np.uint16),
+    }
+
+
+def read_packet_file(packet_file: Path, use_mmap: bool) -> np.ndarray:
+    """The contents of packet_file as a uint8 array, memory mapped if use_mmap"""
+    if not use_mmap:
+        return np.fromfile(packet_file, dtype=np.uint8)
+
+    with open(packet_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # cannot mmap an empty file
+            return np.zeros(0, dtype=np.uint8)
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if hasattr(mapping, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+    # the array keeps the mapping alive, it is unmapped when the last view is released
+    return np.frombuffer(mapping, dtype=np.uint8)
+
+
+def iter_packet_file_chunks(
+    packet_file: Path, chunk_bytes: int
+) -> Iterator[tuple[np.ndarray, PacketIndex]]:
+    """
+    Read and index a packet file about chunk_bytes at a time, so that files bigger than
+    memory can be processed. Each chunk holds whole packets and is yielded as its bytes
+    (a uint8 array) with their index. chunk_bytes must hold the largest packet.
+    """
+    if chunk_bytes < MAX_PACKET_BYTES:
+        raise ValueError(f"Chunks of {chunk_bytes} bytes cannot hold every packet")
+
+    with open(packet_file, "rb") as f:
+        while True:
+            start = f.tell()
+            data = np.fromfile(f, dtype=np.uint8, count=chunk_bytes)
+            if len(data) == 0:
+                return
+            at_end = len(data) < chunk_bytes
+            index = build_packet_index(data, allow_partial=not at_end)
+            if len(index) == 0:
+                return
+            yield data, index
+            # carry on from the packet cut off at the end of the chunk
+            f.seek(start + index.total_bytes)
+
+
+def _index_cache_path(packet_file: Path) -> Path:
+    return Path(f"{packet_file}{INDEX_CACHE_SUFFIX}")
+
+
+def _index_cache_key(packet_file: Path) -> np.ndarray:
+    stat = os.stat(packet_file)
+    return np.array(
+        [INDEX_CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64
+    )
+
+
+def load_index_cache(packet_file: Path) -> PacketIndex | None:
+    """Load the .pktidx sidecar for packet_file if there is one and it is still valid,
+    i.e. the packet file has the same size and modification time as when it was indexed
+    """
+    cache_file = _index_cache_path(packet_file)
+    if not cache_file.exists():
+        return None
+
+    try:
+        with np.load(cache_file) as cache:
+            if not np.array_equal(cache["key"], _index_cache_key(packet_file)):
+                print(f"Packet index {cache_file} is out of date - rebuilding it")
+                return None
+            return PacketIndex(
+                cache["offset"],
+                cache["length"],
+                cache["apid"],
+                cache["seq_count"],
+                cache["shcoarse"],
+                {field: cache[field] for field in SCIENCE_HEADER_FIELDS},
+            )
+    except (OSError, ValueError, KeyError) as e:
+        print(
+            f"Unable to read packet index {cache_file} ({e}) - rebuilding it",
+            file=sys.stderr,
+        )
+        return None
+
+
+def save_index_cache(packet_file: Path, index: PacketIndex):
+    """Save the index as a .pktidx sidecar next to packet_file"""
+    cache_file = _index_cache_path(packet_file)
+    try:
+        # write to a file handle so numpy does not append .npz to the name
+        with open(cache_file, "wb") as f:
+            np.savez(
+                f,
+                key=_index_cache_key(packet_file),
+                offset=index.offset,
+                length=index.length,
+                apid=index.apid,
+                seq_count=index.seq_count,
+                shcoarse=index.shcoarse,
+                **index.science,
+            )
+    except OSError as e:
+        print(f"Unable to save packet index {cache_file}: {e}", file=sys.stderr)
+
+
+def _read_all_science_headers(data: np.ndarray, index: PacketIndex):
+    positions = np.flatnonzero(index.science_mask())
+    headers = read_science_headers(data, index.offset[positions])
+    science = {}
+    for field in SCIENCE_HEADER_FIELDS:
+        science[field] = np.zeros(len(index), dtype=headers[field].dtype)
+        science[field][positions] = headers[field]
+    return science
+
+
+class PacketFileReader:
+    """
+    Index a CCSDS packet file and hand out packets as memoryview slices of its contents.
+    With use_mmap the file is memory mapped rather than read into memory, so packets
+    are never copied and memory use does not grow with the size of the file.
+    With use_index_cache the index is loaded from (or saved to) a .pktidx sidecar file
+    so that the framing pass is only done once per file.
+    """
+
+    def __init__(
+        self,
+        packet_file: Path,
+        use_mmap: bool = True,
+        use_index_cache: bool = False,
+        index: PacketIndex | None = None,
+    ):
+        self.packet_file = packet_file
+        self.data = read_packet_file(packet_file, use_mmap)
+        self.index = index
+        if self.index is None:
+            self.index = _preloaded_indexes.pop(str(Path(packet_file)), None)
+        if self.index is None and use_index_cache:
+            self.index = load_index_cache(packet_file)
+        if self.index is None:
+            self.index = build_packet_index(self.data)
+            if use_index_cache:
+                self.index.science = _read_all_science_headers(self.data, self.index)
+                save_index_cache(packet_file, self.index)
+        self._view = memoryview(self.data)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def packet(self, position: int, skip_bytes: int = 0) -> memoryview:
+        """Zero copy view of the packet at position, optionally skipping the first bytes"""
+        start = int(self.index.offset[position])
+        end = start + int(self.index.length[position])
+        return self._view[start + skip_bytes : end]
+
+    def science_headers(self, positions: np.ndarray) -> dict[str, np.ndarray]:
+        """Science sub-header fields for the science packets at positions"""
+        if self.index.science is not None:
+            return {
+                field: values[positions] for field, values in self.index.science.items()
+            }
+        return read_science_headers(self.data, self.index.offset[positions])
+
+    def close(self):
+        self._view.release()
+        self.data = None
+
+
+_preloaded_indexes: dict[str, PacketIndex] = {}
+
+
+def _index_one_file(packet_file: str, use_index_cache: bool) -> PacketIndex:
+    with PacketFileReader(packet_file, True, use_index_cache) as reader:
+        return reader.index
+
+
+def preload_packet_indexes(
+    packet_files: List[str], jobs: int, use_index_cache: bool
+) -> dict[str, PacketIndex | Exception]:
+    """
+    Index several packet files at once in a pool of worker processes. The indexes are
+    kept so that a later PacketFileReader for the same file uses them rather than
+    indexing the file again. Returns the index (or the error) for each file.
+    """
+    results = map_in_processes(
+        _index_one_file,
+        [(packet_file, use_index_cache) for packet_file in packet_files],
+        jobs,
+    )
+    indexes = dict(zip(packet_files, results))
+    for packet_file, index in indexes.items():
+        if isinstance(index, PacketIndex):
+            _preloaded_indexes[str(Path(packet_file))] = index
+    return indexes
+
+
+def discard_preloaded_indexes():
+    _preloaded_indexes.clear()
+
+
+def index_packet_file(
+    packet_file: Path, use_mmap: bool = False
+) -> tuple[np.ndarray, PacketIndex]:
+    """Read a CCSDS packet file and index it, returning the raw bytes and the index"""
+    data = read_packet_file(packet_file, use_mmap)
+    return data, build_packet_index(data)
+
+
+def packet_runs(
+    index: PacketIndex, positions: List[int] | np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Start and end offsets of the runs of packets at positions (in that order) that are
+    next to each other in the file, so each run can be copied in one go"""
+    positions = np.asarray(positions, dtype=np.int64)
+    starts = index.offset[positions]
+    ends = starts + index.length[positions]
+    if len(positions) == 0:
+        return starts, ends
+    new_run = np.ones(len(positions), dtype=bool)
+    new_run[1:] = starts[1:] != ends[:-1]
+    run_first = np.flatnonzero(new_run)
+    run_last = np.append(run_first[1:], len(positions)) - 1
+    return starts[run_first], ends[run_last]
+
+
+def open_for_append(path: Path, buffering: int = -1):
+    """Open path to write at its end, creating it if needed. Not opened in append mode
+    (O_APPEND) because the kernel will not copy into such a file (copy_file_range and
+    sendfile fail), so write_packets would always fall back to copying in Python"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666)
+    file_handle = os.fdopen(fd, "wb", buffering=buffering)
+    file_handle.seek(0, os.SEEK_END)
+    return file_handle
+
+
+def write_packets(
+    file_handle,
+    data: np.ndarray,
+    index: PacketIndex,
+    positions: List[int],
+    packet_file: Path | None = None,
+) -> int:
+    """Write the indexed packets to file_handle in the given order, merging runs of
+    packets that are adjacent in the input into a single write. Given the packet_file
+    data was read from, long runs are copied from it by the kernel (os.copy_file_range
+    or os.sendfile) so those bytes never pass through Python - file_handle must not be
+    in append mode for that, so open files to append to with open_for_append.
+    Returns bytes written"""
+    starts, ends = packet_runs(index, positions)
+    copy_functions = list(_COPY_FUNCTIONS)
+    source = None  # only opened once there is a run long enough to copy
+    try:
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if packet_file is None or end - start < KERNEL_COPY_MIN_BYTES:
+                file_handle.write(data[start:end])
+                continue
+            if source is None:
+                source = open(packet_file, "rb")
+            _copy_range(source, file_handle, start, end, copy_functions)
+    finally:
+        if source is not None:
+            source.close()
+    return int((ends - starts).sum())
+
+
+def append_file(file_handle, source_file: Path) -> int:
+    """Copy all of source_file to file_handle, in the kernel like write_packets where it
+    can be. Returns bytes written"""
+    size = os.path.getsize(source_file)
+    with open(source_file, "rb") as source:
+        _copy_range(source, file_handle, 0, size, list(_COPY_FUNCTIONS))
+    return size
+
+
+def _copy_range(source, file_handle, start: int, end: int, copy_functions: list):
+    """Copy bytes start to end of the source file to file_handle with the first of
+    copy_functions that works, dropping the ones that are not supported"""
+    file_handle.flush()
+    while start < end:
+        try:
+            copied = copy_functions[0](
+                source.fileno(), file_handle.fileno(), start, end - start
+            )
+        except OSError as error:
+            if len(copy_functions) == 1 or error.errno not in _COPY_UNSUPPORTED:
+                raise
+            # not supported for these files, so try the next way
+            copy_functions.pop(0)
+            continue
+        if copied == 0:
+            raise EOFError(f"{source.name} is shorter than its index")
+        start += copied
+
+
+def _copy_file_range(in_fd: int, out_fd: int, offset: int, count: int) -> int:
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(in_fd: int, out_fd: int, offset: int, count: int) -> int:
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+def _read_and_write(in_fd: int, out_fd: int, offset: int, count: int) -> int:
+    count = min(count, COPY_CHUNK_BYTES)
+    if hasattr(os, "pread"):
+        return os.write(out_fd, os.pread(in_fd, count, offset))
+    # no pread on Windows
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    return os.write(out_fd, os.read(in_fd, count))
+
+
+# ways to copy part of one file to another, best first
+_COPY_FUNCTIONS = (
+    ([_copy_file_range] if hasattr(os, "copy_file_range") else [])
+    + ([_sendfile] if hasattr(os, "sendfile") else [])
+    + [_read_and_write]
+)
+# errors from a kernel copy that mean it can not be used for these files
+_COPY_UNSUPPORTED = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EBADF,
+    errno.EOPNOTSUPP,
+    errno.ENOTSOCK,
+}
@@ -0,0 +1,206 @@
+import heapq
+import os
+import re
+import sys
+import tempfile
+from operator import itemgetter
+from pathlib import Path
+from typing import Callable, Iterator, List
+
+import numpy as np
+
+from packet_index import (
+    MAX_PACKET_BYTES,
+    PacketFileReader,
+    PacketIndex,
+    iter_packet_file_chunks,
+    write_packets,
+)
+
+DEFAULT_MAX_MEMORY = "1GB"
+MAX_MEMORY_HELP = "Memory budget for sorting, like '512MB' or '4GB'. Bigger files are sorted in runs that are spilled to temporary files and merged"
+# each run being merged needs a read buffer that can hold its largest packet
+MIN_MERGE_BUFFER_BYTES = 2 * MAX_PACKET_BYTES
+MIN_MAX_MEMORY = 1 << 20
+OUTPUT_BUFFER_BYTES = 1024 * 1024
+
+_MEMORY_UNITS = {
+    "": 1,
+    "b": 1,
+    "k": 1 << 10,
+    "kb": 1 << 10,
+    "m": 1 << 20,
+    "mb": 1 << 20,
+    "g": 1 << 30,
+    "gb": 1 << 30,
+    "t": 1 << 40,
+    "tb": 1 << 40,
+}
+
+
+def parse_memory_size(value: str) -> int | None:
+    """Parse a size like '512MB' into bytes, or print an error and return None"""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kmgt]?b?)", value.strip().lower())
+    if match:
+        size = int(float(match.group(1)) * _MEMORY_UNITS[match.group(2)])
+        if size >= MIN_MAX_MEMORY:
+            return size
+    print(
+        f"max-memory must be a size of at least 1MB like '512MB' or '4GB', not '{value}'",
+        file=sys.stderr,
+    )
+    return None
+
+
+def sort_order(index: PacketIndex) -> np.ndarray:
+    """Positions of the packets sorted by SHCOARSE, then ApID, then seq count"""
+    # the last key is the primary one, and lexsort is stable so equal packets keep their order
+    return np.lexsort((index.seq_count, index.apid, index.shcoarse))
+
+
+def write_packets_from_files(
+    file_handle,
+    sources: List[tuple[Path, PacketIndex]],
+    sort: bool,
+    progress: Callable[[int], None] = lambda bytes_written: None,
+) -> int:
+    """
+    Write the indexed packets of each (packet_file, index) in sources to file_handle as
+    one stream - in the order given, or sorted by SHCOARSE, ApID and seq count (keeping
+    the order given for equal packets) if sort is set. Only the indexes are sorted, and
+    the packets are copied straight from the input files. Returns bytes written.
+    """
+    if not sources:
+        return 0
+    counts = [len(index) for _, index in sources]
+    first_positions = np.cumsum([0] + counts)
+    file_ids = np.repeat(np.arange(len(sources)), counts)
+    combined = PacketIndex(
+        *(
+            np.concatenate([getattr(index, field) for _, index in sources])
+            for field in ["offset", "length", "apid", "seq_count", "shcoarse"]
+        )
+    )
+    order = sort_order(combined) if sort else np.arange(len(combined))
+
+    # write each stretch of packets that come from the same file in one go
+    stretch_starts = np.flatnonzero(np.diff(file_ids[order])) + 1
+    bytes_written = 0
+    readers: dict[int, PacketFileReader] = {}
+    try:
+        for stretch in np.split(order, stretch_starts):
+            if len(stretch) == 0:
+                continue
+            file_id = int(file_ids[stretch[0]])
+            packet_file, index = sources[file_id]
+            if file_id not in readers:
+                readers[file_id] = PacketFileReader(packet_file, index=index)
+            written = write_packets(
+                file_handle,
+                readers[file_id].data,
+                index,
+                stretch - first_positions[file_id],
+                packet_file,
+            )
+            progress(written)
+            bytes_written += written
+    finally:
+        for reader in readers.values():
+            reader.close()
+    return bytes_written
+
+
+def sort_packet_file(
+    packet_file: Path,
+    output_file: Path,
+    max_memory: int,
+    progress: Callable[[int], None] = lambda bytes_written: None,
+) -> int:
+    """
+    Write the packets of packet_file to output_file sorted by SHCOARSE, ApID and seq
+    count, using about max_memory bytes. A file that fits is sorted in memory. A bigger
+    one is split into runs that are sorted in memory and spilled to temporary files next
+    to output_file, which are then merged (in several passes if there are too many
+    runs to merge at once). Both give the same order. Returns the number of packets.
+    """
+    if os.path.getsize(packet_file) <= max_memory // 2:
+        with PacketFileReader(packet_file) as reader, open(
+            output_file, "wb", buffering=OUTPUT_BUFFER_BYTES
+        ) as output:
+            progress(
+                write_packets(
+                    output,
+                    reader.data,
+                    reader.index,
+                    sort_order(reader.index),
+                    packet_file,
+                )
+            )
+            return len(reader.index)
+
+    with tempfile.TemporaryDirectory(
+        prefix=f"{output_file.name}.", dir=output_file.parent
+    ) as run_folder:
+        runs, packets = _write_sorted_runs(packet_file, Path(run_folder), max_memory)
+
+        # merge groups of neighbouring runs until they can all be merged at once
+        fan_in = max(2, (max_memory // 2) // MIN_MERGE_BUFFER_BYTES)
+        merge_pass = 0
+        while len(runs) > fan_in:
+            merge_pass += 1
+            merged_runs = []
+            for first in range(0, len(runs), fan_in):
+                merged_run = Path(run_folder) / f"merge{merge_pass}-{first}.bin"
+                with open(merged_run, "wb", buffering=OUTPUT_BUFFER_BYTES) as output:
+                    _merge_runs(runs[first : first + fan_in], output, max_memory)
+                for run in runs[first : first + fan_in]:
+                    os.remove(run)
+                merged_runs.append(merged_run)
+            runs = merged_runs
+
+        with open(output_file, "wb", buffering=OUTPUT_BUFFER_BYTES) as output:
+            progress(_merge_runs(runs, output, max_memory))
+
+    return packets
+
+
+def _write_sorted_runs(
+    packet_file: Path, run_folder: Path, max_memory: int
+) -> tuple[List[Path], int]:
+    """Sort packet_file a chunk of half the memory budget at a time into run files"""
+    runs = []
+    packets = 0
+    for data, index in iter_packet_file_chunks(packet_file, max_memory // 2):
+        run = run_folder / f"run{len(runs)}.bin"
+        with open(run, "wb", buffering=OUTPUT_BUFFER_BYTES) as output:
+            write_packets(output, data, index, sort_order(index).tolist())
+        runs.append(run)
+        packets += len(index)
+    return runs, packets
+
+
+def _read_run(run: Path, buffer_bytes: int) -> Iterator[tuple[tuple, memoryview]]:
+    """The packets of a sorted run file with their sort keys, read buffer_bytes at a time"""
+    for data, index in iter_packet_file_chunks(run, buffer_bytes):
+        view = memoryview(data)
+        for shcoarse, apid, seq_count, start, length in zip(
+            index.shcoarse.tolist(),
+            index.apid.tolist(),
+            index.seq_count.tolist(),
+            index.offset.tolist(),
+            index.length.tolist(),
+        ):
+            yield (shcoarse, apid, seq_count), view[start : start + length]
+
+
+def _merge_runs(runs: List[Path], output, max_memory: int) -> int:
+    """Merge sorted run files into output, returning the bytes written. Packets with
+    equal keys keep the order of their runs, so the sort stays stable"""
+    buffer_bytes = max(MIN_MERGE_BUFFER_BYTES, (max_memory // 2) // len(runs))
+    bytes_written = 0
+    for _, packet in heapq.merge(
+        *[_read_run(run, buffer_bytes) for run in runs], key=itemgetter(0)
+    ):
+        output.write(packet)
+        bytes_written += len(packet)
+    return bytes_written
@@ -0,0 +1,59 @@
+import os
+import sys
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+
+
+def resolve_jobs(jobs: int) -> int:
+    """Number of worker processes to use for --jobs, where 0 means one per CPU core"""
+    if jobs == 0:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def create_process_pool(jobs: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=resolve_jobs(jobs))
+
+
+def map_in_processes(func, args_list: list[tuple], jobs: int) -> list:
+    """
+    Call func(*args) for each args in args_list using a pool of worker processes.
+    Results are returned in the same order as args_list. If a call fails the
+    exception is returned in its place so the caller can report it and carry on
+    with the other files.
+    """
+    with create_process_pool(jobs) as pool:
+        futures: list[Future] = [pool.submit(func, *args) for args in args_list]
+        return [_result_or_exception(future) for future in futures]
+
+
+def imap_ordered(pool: Executor, func, args_iterable, window: int):
+    """
+    Yield func(*args) for each args in args_iterable, in order, while keeping at most
+    window calls in flight in the pool so results are not all held in memory at once
+    """
+    in_flight: deque[Future] = deque()
+    for args in args_iterable:
+        in_flight.append(pool.submit(func, *args))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def _result_or_exception(future: Future):
+    try:
+        return future.result()
+    except Exception as e:
+        return e
+
+
+def validate_jobs(jobs: int, option: str = "jobs") -> bool:
+    if jobs < 0:
+        print(
+            f"{option} must be 0 (one per CPU core) or a positive integer",
+            file=sys.stderr,
+        )
+        return False
+    return True
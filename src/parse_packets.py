@@ -1,33 +1,67 @@
 import glob
 import io
+import math
 import os
 import re
+import shutil
 import sys
+import tempfile
 from datetime import datetime, timedelta
 from io import TextIOWrapper
 from pathlib import Path
 from typing import List, Optional
 
+import numpy as np
 import typer
-from ccsdspy.utils import iter_packet_bytes
 from click.exceptions import Exit
 from rich.progress import Progress, track
 
 from constants import CONSTANTS
-from packet_util import (
-    get_imap_basic_packet_def,
-    get_imap_science_packet_def,
-    parse_apids,
+from flush_policy import (
+    FLUSH_EVERY_PACKET,
+    FLUSH_POLICY_HELP,
+    FlushPolicy,
+    parse_flush_policy,
 )
-from science_decoder import MAGScienceDecoder
 from ialirt_decoder import IALIRTDecoder
+from packet_dedupe import DEDUPE_WINDOW_HELP, PacketKeySet
+from packet_index import (
+    INDEX_CACHE_SUFFIX,
+    SCIENCE_HEADER_BYTES,
+    PacketFileReader,
+    PacketIndex,
+    discard_preloaded_indexes,
+    preload_packet_indexes,
+    read_packet_file,
+)
+from packet_util import parse_apids
+from parallel import create_process_pool, imap_ordered, resolve_jobs, validate_jobs
+from science_decoder import MAGScienceDecoder
+from table_writer import OutputFormat, append_table_file, validate_output_format
 from time_util import humanise_timedelta
 
 app = typer.Typer()
 
 packet_counter = 0
 is_multi_file = False
-unique_packets = set()
+unique_packets = PacketKeySet()
+
+MIN_SCIENCE_CHUNK = 64  # packets decoded per task when decoding one file in parallel
+
+SCIENCE_DECODE_FIELDS = [
+    "PUS_STYPE",
+    "PUS_SSUBTYPE",
+    "PRI_COARSETM",
+    "PRI_FNTM",
+    "SEC_COARSETM",
+    "SEC_FNTM",
+    "PRI_VECSEC",
+    "SEC_VECSEC",
+    "COMPRESSION",
+    "FOB_ACT",
+    "FIB_ACT",
+    "PRI_SENS",
+]
 
 
 @app.callback(
@@ -55,6 +89,37 @@ def parse_packets(
         "--apid",
         help="Restrict the results to packets with one or more specificied ApIDs. Defaults to all ApIDs.",
     ),
+    use_mmap: bool = typer.Option(
+        True,
+        "--mmap/--no-mmap",
+        help="Memory map the input file(s) and read packets in place rather than loading each file into memory",
+    ),
+    use_index_cache: bool = typer.Option(
+        False,
+        "--index-cache/--no-index-cache",
+        help="Reuse (or create) a .pktidx packet index next to each input file so later commands on the same file can skip re-reading the packet headers",
+    ),
+    jobs: int = typer.Option(
+        1,
+        "--jobs",
+        "-j",
+        help="Number of worker processes. Files are processed in parallel when given a folder or glob, otherwise the science packets in the file are decoded in parallel. 0 = one per CPU core",
+    ),
+    flush: str = typer.Option(
+        "packet",
+        "--flush",
+        help=f"How often to flush the output files to disk: {FLUSH_POLICY_HELP}. Files are always flushed when they are closed",
+    ),
+    output_format: OutputFormat = typer.Option(
+        OutputFormat.csv,
+        "--format",
+        help="Output file format. npy files hold a structured array that can be memory mapped with np.load(file, mmap_mode='r'), parquet needs the pyarrow package",
+    ),
+    dedupe_window: int = typer.Option(
+        0,
+        "--dedupe-window",
+        help=DEDUPE_WINDOW_HELP,
+    ),
 ):
     """
     Parse MAG (science only!) packets based on apid and puts vectors in a CSV file.
@@ -71,13 +136,38 @@ def parse_packets(
     elif "*" in str(packet_files) or "?" in str(packet_files):
         globPath = str(packet_files)
 
+    if not validate_jobs(jobs):
+        raise typer.Abort()
+
+    flush_policy = parse_flush_policy(flush)
+    if flush_policy is None or not validate_output_format(output_format):
+        raise typer.Abort()
+
+    if dedupe_window < 0:
+        print("dedupe-window must be 0 or a positive number of seconds")
+        raise typer.Abort()
+
+    # checked before the files are split between worker processes, so --jobs gives the
+    # same result as a serial run
+    _validate_parse_packets_options(output_folder, limit, apids)
+
     if globPath:
         _parse_packets_in_mulitple_files_from_glob_path(
-            globPath, output_folder, ctx, limit, apids
+            globPath,
+            output_folder,
+            ctx,
+            limit,
+            apids,
+            use_mmap,
+            use_index_cache,
+            jobs,
+            flush,
+            output_format,
+            dedupe_window,
         )
         return
 
-    _validate_parse_packets_args(packet_files, output_folder, limit, apids)
+    _validate_parse_packets_args(packet_files)
 
     if not output_folder:
         output_folder = Path.cwd()
@@ -95,7 +185,18 @@ def parse_packets(
     # just a single file at this point
     packet_file_name = packet_files
 
-    _parse_packets_in_one_file(packet_file_name, output_folder, limit, filter_to_apids)
+    _parse_packets_in_one_file(
+        packet_file_name,
+        output_folder,
+        limit,
+        filter_to_apids,
+        use_mmap,
+        use_index_cache,
+        jobs,
+        flush_policy,
+        output_format,
+        dedupe_window,
+    )
 
     print(f"Data extracted to {output_folder.absolute()}")
 
@@ -105,119 +206,225 @@ def _parse_packets_in_one_file(
     output_folder: Path,
     limit: int,
     apid_filter: List[int],
+    use_mmap: bool = True,
+    use_index_cache: bool = False,
+    jobs: int = 1,
+    flush_policy: FlushPolicy = FLUSH_EVERY_PACKET,
+    output_format: OutputFormat = OutputFormat.csv,
+    dedupe_window: int = 0,
 ):
     global exit_code
     global packet_counter
     global unique_packets
 
     if not is_multi_file:
-        unique_packets = set()
+        unique_packets = PacketKeySet(dedupe_window)
         packet_counter = 0
 
-    pktDefinition = get_imap_basic_packet_def()
-    sciFullPktDefinition = get_imap_science_packet_def()
-
     if limit != 0 and packet_counter >= limit:
         return
 
-    size = os.path.getsize(packet_file)
-    processed_bytes = 0
-    ignored_packets = 0
+    reader = PacketFileReader(packet_file, use_mmap, use_index_cache)
     started_at = datetime.now()
-    sci_decoder = MAGScienceDecoder(output_folder)
-    ialirt_mag_decoder = IALIRTDecoder(output_folder, "mag")
-    ialirt_scpacket_decoder = IALIRTDecoder(output_folder, "sc")
 
     with Progress(refresh_per_second=1) as progress:
-        task1 = progress.add_task(f"Processing {packet_file}", total=size)
-        for packet_bytes in iter_packet_bytes(packet_file, include_primary_header=True):
-            progress.update(task1, advance=len(packet_bytes))
-            processed_bytes += len(packet_bytes)
-
-            fileLikeObject = io.BytesIO(packet_bytes)
-            pkt = pktDefinition.load(fileLikeObject, include_primary_header=True)
-            apid = pkt["CCSDS_APID"][0].astype(int)
-
-            if apid == CONSTANTS.APID_MAG_IALIRT:
-                ialirt_mag_decoder.extract_packet_to_csv(apid, packet_bytes)
-                packet_counter += 1
-                if limit > 0 and packet_counter >= limit:
-                    print(f"Limit of {limit} packets reached")
-                    break
+        task1 = progress.add_task(f"Processing {packet_file}", total=reader.size)
+        positions, ignored_packets, processed_bytes = _select_packets_to_parse(
+            reader.index, limit, apid_filter
+        )
+        _decode_packets(
+            reader, positions, output_folder, jobs, flush_policy, output_format
+        )
+        progress.update(task1, advance=processed_bytes)
 
-                continue
-            elif apid == CONSTANTS.APID_SPACECRAFT_IALIRT:
-                ialirt_scpacket_decoder.extract_packet_to_csv(apid, packet_bytes)
-                packet_counter += 1
-                if limit > 0 and packet_counter >= limit:
-                    print(f"Limit of {limit} packets reached")
-                    break
+    reader.close()
 
-                continue
+    _report_parsed_file(
+        packet_file,
+        output_folder,
+        processed_bytes,
+        datetime.now() - started_at,
+        ignored_packets,
+    )
 
-            # check the packet should not be filtered out
-            if apid < CONSTANTS.APID_MAG_START or apid > CONSTANTS.APID_MAG_END:
-                ignored_packets += 1
-                continue
 
-            if apid_filter:
-                if apid not in apid_filter:
-                    ignored_packets += 1
-                    continue
+def _select_packets_to_parse(
+    index: PacketIndex, limit: int, apid_filter: List[int]
+) -> tuple[list[int], int, int]:
+    """
+    Work out which packets in the file will be decoded, applying the ApID filters, the
+    dedupe against packets already seen and the --limit. Returns the positions of the
+    packets to decode, the number of packets ignored and the number of bytes processed.
+    """
+    global packet_counter
+    global unique_packets
+
+    processed_bytes = index.total_bytes
+    ignored_packets = 0
+    positions = []
 
-            if not (
-                apid == CONSTANTS.APID_MAG_SCIENCE_NM
-                or apid == CONSTANTS.APID_MAG_SCIENCE_BM
-            ):
+    is_science = index.science_mask()
+    if apid_filter:
+        is_science &= np.isin(index.apid, apid_filter)
+    is_ialirt = np.isin(
+        index.apid, [CONSTANTS.APID_MAG_IALIRT, CONSTANTS.APID_SPACECRAFT_IALIRT]
+    )
+    keys = index.keys()
+    # only science packets are deduped
+    is_new = np.ones(len(index), dtype=bool)
+    is_new[is_science] = unique_packets.first_seen(keys[is_science])
+
+    for position, apid, science, ialirt, new in zip(
+        range(len(index)),
+        index.apid.tolist(),
+        is_science.tolist(),
+        is_ialirt.tolist(),
+        is_new.tolist(),
+    ):
+        if not ialirt:
+            # check the packet should not be filtered out (MAG science ApIDs only)
+            if not science:
                 ignored_packets += 1
                 continue
 
-            # So this must be a science packet, reparse it with the full science definition
-            fileLikeObject.seek(0)
-            pkt = sciFullPktDefinition.load(fileLikeObject, include_primary_header=True)
-
-            unique_id = (apid, pkt["SHCOARSE"][0], pkt["CCSDS_SEQUENCE_COUNT"][0])
-            if unique_id in unique_packets:
+            if not new:
                 print(
-                    f"Duplicate packet found - ApID: {hex(apid)} Seq Count: {pkt['CCSDS_SEQUENCE_COUNT'][0]} SHCOARSE: {pkt['SHCOARSE'][0]}. Skipping it.",
+                    f"Duplicate packet found - ApID: {hex(apid)} Seq Count: {index.seq_count[position]} SHCOARSE: {index.shcoarse[position]}. Skipping it.",
                     file=sys.stderr,
                 )
                 ignored_packets += 1
                 continue
 
-            unique_packets.add(unique_id)
-            packet_counter += 1
+        positions.append(position)
+        packet_counter += 1
 
-            # decode vectors!
-            sci_decoder.extract_packet_to_csv(
-                apid,
-                pkt["CCSDS_SEQUENCE_COUNT"][0].astype(int),
-                pkt["CCSDS_PACKET_LENGTH"][0].astype(int),
-                pkt["PUS_STYPE"][0].astype(int),
-                pkt["PUS_SSUBTYPE"][0].astype(int),
-                pkt["PRI_COARSETM"][0].astype(int),
-                pkt["PRI_FNTM"][0].astype(int),
-                pkt["SEC_COARSETM"][0].astype(int),
-                pkt["SEC_FNTM"][0].astype(int),
-                pkt["PRI_VECSEC"][0].astype(int),
-                pkt["SEC_VECSEC"][0].astype(int),
-                pkt["COMPRESSION"][0].astype(int),
-                pkt["FOB_ACT"][0].astype(int),
-                pkt["FIB_ACT"][0].astype(int),
-                pkt["PRI_SENS"][0].astype(int),
-                pkt["VECTOR_DATA"][0].tobytes(),
+        if limit > 0 and packet_counter >= limit:
+            print(f"Limit of {limit} packets reached")
+            processed_bytes = int(index.offset[position] + index.length[position])
+            break
+
+    unique_packets.add(keys[positions][is_science[positions]])
+
+    return positions, ignored_packets, processed_bytes
+
+
+def _decode_packets(
+    reader: PacketFileReader,
+    positions: list[int],
+    output_folder,
+    jobs: int = 1,
+    flush_policy: FlushPolicy = FLUSH_EVERY_PACKET,
+    output_format: OutputFormat = OutputFormat.csv,
+):
+    """
+    Decode the science and I-ALiRT packets at positions into CSV files. With more than
+    one job the science packets are decoded in chunks by worker processes and written
+    in their original order, so the CSV files are identical to a serial decode.
+    """
+    index = reader.index
+    sci_decoder = MAGScienceDecoder(output_folder, flush_policy, output_format)
+    ialirt_mag_decoder = IALIRTDecoder(
+        output_folder, "mag", flush_policy, output_format
+    )
+    ialirt_scpacket_decoder = IALIRTDecoder(
+        output_folder, "sc", flush_policy, output_format
+    )
+
+    positions = np.array(positions, dtype=np.int64)
+    science_positions = positions[index.science_mask()[positions]]
+    sci_headers = reader.science_headers(science_positions)
+    science_packets = list(
+        zip(
+            index.apid[science_positions].tolist(),
+            index.seq_count[science_positions].tolist(),
+            index.packet_length[science_positions].tolist(),
+            *[sci_headers[field].tolist() for field in SCIENCE_DECODE_FIELDS],
+        )
+    )
+
+    if resolve_jobs(jobs) > 1 and len(science_positions) >= 2 * MIN_SCIENCE_CHUNK:
+        decoded_science = _decode_science_in_parallel(
+            reader, science_positions, science_packets, jobs
+        )
+    else:
+        decoded_science = (
+            MAGScienceDecoder.decode_packet(
+                *packet, reader.packet(position, SCIENCE_HEADER_BYTES)
             )
+            for position, packet in zip(science_positions.tolist(), science_packets)
+        )
 
-            if limit > 0 and packet_counter >= limit:
-                print(f"Limit of {limit} packets reached")
-                break
+    for decoded in decoded_science:
+        sci_decoder.write_decoded_packet(decoded)
+
+    # each I-ALiRT stream goes to its own files, so is decoded as a batch on its own
+    for apid, ialirt_decoder in (
+        (CONSTANTS.APID_MAG_IALIRT, ialirt_mag_decoder),
+        (CONSTANTS.APID_SPACECRAFT_IALIRT, ialirt_scpacket_decoder),
+    ):
+        ialirt_positions = positions[index.apid[positions] == apid]
+        if len(ialirt_positions):
+            ialirt_decoder.extract_packets_to_csv(
+                apid,
+                reader.data,
+                index.offset[ialirt_positions],
+                index.length[ialirt_positions],
+                index.seq_count[ialirt_positions],
+                index.shcoarse[ialirt_positions],
+            )
 
-    ended_at = datetime.now()
-    duration = ended_at - started_at
     sci_decoder.close_all()
     ialirt_mag_decoder.close_all()
     ialirt_scpacket_decoder.close_all()
 
+
+def _decode_science_in_parallel(
+    reader: PacketFileReader,
+    science_positions: np.ndarray,
+    science_packets: list[tuple],
+    jobs: int,
+):
+    """Decode science packets in packet aligned chunks in worker processes, yielding
+    the decoded packets in their original order"""
+    workers = resolve_jobs(jobs)
+    chunk_size = max(MIN_SCIENCE_CHUNK, math.ceil(len(science_packets) / (workers * 4)))
+    offsets = reader.index.offset[science_positions].tolist()
+    lengths = reader.index.length[science_positions].tolist()
+
+    chunks = (
+        (
+            str(reader.packet_file),
+            science_packets[start : start + chunk_size],
+            offsets[start : start + chunk_size],
+            lengths[start : start + chunk_size],
+        )
+        for start in range(0, len(science_packets), chunk_size)
+    )
+
+    with create_process_pool(workers) as pool:
+        for decoded_chunk in imap_ordered(
+            pool, _decode_science_chunk, chunks, workers * 2
+        ):
+            yield from decoded_chunk
+
+
+def _decode_science_chunk(
+    packet_file: str, packets: list[tuple], offsets: list[int], lengths: list[int]
+):
+    data = memoryview(read_packet_file(packet_file, True))
+    return [
+        MAGScienceDecoder.decode_packet(
+            *packet, data[offset + SCIENCE_HEADER_BYTES : offset + length]
+        )
+        for packet, offset, length in zip(packets, offsets, lengths)
+    ]
+
+
+def _report_parsed_file(
+    packet_file, output_folder, processed_bytes, duration, ignored_packets
+):
+    global exit_code
+
     print(
         f"Extracted data from {packet_counter} packets in {packet_file} to {output_folder.name} ({processed_bytes} bytes processed in {humanise_timedelta(duration)}). Ignored {ignored_packets} packets."
     )
@@ -228,15 +435,177 @@ def _parse_packets_in_one_file(
         raise typer.Exit(code=exit_code)
 
 
+def _decode_packets_in_worker(
+    packet_file: str,
+    index: PacketIndex,
+    positions: list[int],
+    output_folder: Path,
+    use_mmap: bool,
+    flush_policy: FlushPolicy,
+    output_format: OutputFormat,
+) -> timedelta:
+    started_at = datetime.now()
+    with PacketFileReader(packet_file, use_mmap, index=index) as reader:
+        _decode_packets(
+            reader,
+            positions,
+            output_folder,
+            flush_policy=flush_policy,
+            output_format=output_format,
+        )
+    return datetime.now() - started_at
+
+
+def _merge_parsed_output(worker_folder: Path, output_folder: Path):
+    """
+    Move the files decoded by a worker into the output folder, appending to any file
+    of the same name (without repeating the header row) as a serial run would
+    """
+    for worker_file in sorted(worker_folder.iterdir()):
+        output_file = output_folder / worker_file.name
+        if not output_file.exists():
+            shutil.move(worker_file, output_file)
+            continue
+
+        append_table_file(str(worker_file), str(output_file))
+        os.remove(worker_file)
+
+    worker_folder.rmdir()
+
+
+def _parse_packets_in_parallel(
+    filenames: List[str],
+    output_folder: Path,
+    limit: int,
+    apid_filter: List[int],
+    use_mmap: bool,
+    use_index_cache: bool,
+    jobs: int,
+    flush_policy: FlushPolicy,
+    output_format: OutputFormat,
+) -> int:
+    """
+    Parse several files at once. The files are indexed in parallel, then the packets to
+    decode in each file are chosen in file order (so --limit and the dedupe across files
+    give the same result as a serial run) and each file is decoded by a worker process
+    into its own folder. The worker folders are then merged in file order.
+    """
+    multifile_exit_code = 0
+    indexes = preload_packet_indexes(filenames, jobs, use_index_cache)
+    discard_preloaded_indexes()
+
+    output_folder.mkdir(parents=True, exist_ok=True)
+    worker_root = Path(tempfile.mkdtemp(prefix=".parse-packets-", dir=output_folder))
+    decodes = []
+
+    with create_process_pool(jobs) as pool:
+        for file_number, filename in enumerate(filenames):
+            index = indexes[filename]
+            if isinstance(index, Exception):
+                decodes.append((filename, index, None, 0, 0, 0))
+                continue
+
+            if limit != 0 and packet_counter >= limit:
+                break
+
+            positions, ignored_packets, processed_bytes = _select_packets_to_parse(
+                index, limit, apid_filter
+            )
+            worker_folder = worker_root / str(file_number)
+            worker_folder.mkdir()
+            decode = pool.submit(
+                _decode_packets_in_worker,
+                filename,
+                index,
+                positions,
+                worker_folder,
+                use_mmap,
+                flush_policy,
+                output_format,
+            )
+            decodes.append(
+                (
+                    filename,
+                    decode,
+                    worker_folder,
+                    processed_bytes,
+                    ignored_packets,
+                    packet_counter,
+                )
+            )
+
+        for (
+            filename,
+            decode,
+            worker_folder,
+            processed_bytes,
+            ignored_packets,
+            counter,
+        ) in decodes:
+            try:
+                if isinstance(decode, Exception):
+                    raise decode
+                duration = decode.result()
+                _merge_parsed_output(worker_folder, output_folder)
+                print(
+                    f"Extracted data from {counter} packets in {filename} to {output_folder.name} ({processed_bytes} bytes processed in {humanise_timedelta(duration)}). Ignored {ignored_packets} packets."
+                )
+                if counter == 0:
+                    print("Zero packets parsed", file=sys.stderr)
+                    multifile_exit_code = 1
+            except Exception as e:
+                print(f"Error processing {filename}: {e}", file=sys.stderr)
+                if multifile_exit_code == 0:
+                    multifile_exit_code = 1
+
+    shutil.rmtree(worker_root, ignore_errors=True)
+
+    return multifile_exit_code
+
+
 def _parse_packets_in_mulitple_files_from_glob_path(
-    globPath, output_folder, ctx, limit, apids
+    globPath,
+    output_folder,
+    ctx,
+    limit,
+    apids,
+    use_mmap,
+    use_index_cache,
+    jobs,
+    flush,
+    output_format,
+    dedupe_window,
 ):
     multifile_exit_code = 0
     files = 0
     global is_multi_file
     global packet_counter
+    global unique_packets
     is_multi_file = True
-    for filename in glob.glob(globPath):
+    unique_packets = PacketKeySet(dedupe_window)
+    packet_counter = 0
+    filenames = [
+        filename
+        for filename in glob.glob(globPath)
+        if not filename.endswith(INDEX_CACHE_SUFFIX)
+    ]
+
+    if resolve_jobs(jobs) > 1 and len(filenames) > 1:
+        files = len(filenames)
+        multifile_exit_code = _parse_packets_in_parallel(
+            filenames,
+            output_folder or Path.cwd(),
+            limit,
+            parse_apids(apids),
+            use_mmap,
+            use_index_cache,
+            jobs,
+            parse_flush_policy(flush),
+            output_format,
+        )
+        filenames = []
+
+    for filename in filenames:
         files += 1
         try:
             result = ctx.invoke(
@@ -246,6 +615,12 @@ def _parse_packets_in_mulitple_files_from_glob_path(
                 ctx=ctx,
                 limit=limit,
                 apids=apids,
+                use_mmap=use_mmap,
+                use_index_cache=use_index_cache,
+                jobs=jobs,
+                flush=flush,
+                output_format=output_format,
+                dedupe_window=dedupe_window,
             )
             if result and result.exit_code != 0:
                 multifile_exit_code = result.exit_code
@@ -270,12 +645,7 @@ def _parse_packets_in_mulitple_files_from_glob_path(
         raise typer.Exit(code=multifile_exit_code)
 
 
-def _validate_parse_packets_args(
-    data_file: Path,
-    output_folder: Path | None,
-    limit: int,
-    apids: List[str] | None,
-):
+def _validate_parse_packets_args(data_file: Path):
     if not data_file.exists():
         print(f"{data_file} does not exist")
         raise typer.Abort()
@@ -284,6 +654,12 @@ def _validate_parse_packets_args(
         print("data_file name is empty or invalid")
         raise typer.Abort()
 
+
+def _validate_parse_packets_options(
+    output_folder: Path | None,
+    limit: int,
+    apids: List[str] | None,
+):
     if output_folder and not output_folder.is_dir():
         print(
             f"output_folder {output_folder} is not a directory, please provide a directory path"
@@ -1,4 +1,3 @@
-import csv
 import os
 import threading
 import time
@@ -9,11 +8,64 @@ from datetime import datetime
 import numpy as np
 
 from constants import CONSTANTS
+from flush_policy import FLUSH_EVERY_PACKET, FlushPolicy, FlushTracker
 from science_mode import ModeName
 from src import time_util
+from table_writer import Column, OutputFormat, open_table_file, table_file_suffix
 from time_util import get_met_from_shcourse, humanise_timedelta
 
 Vector = namedtuple("Vector", ["x", "y", "z", "rng"])
+# the vectors of one sensor in a packet as int32 x/y/z and uint8 range columns
+VectorBlock = namedtuple("VectorBlock", ["x", "y", "z", "rng"])
+SCIENCE_COLUMNS = [
+    Column("sequence", np.uint16, None),
+    Column("x_pri", np.int32, "pri"),
+    Column("y_pri", np.int32, "pri"),
+    Column("z_pri", np.int32, "pri"),
+    Column("rng_pri", np.uint8, "pri"),
+    Column("x_sec", np.int32, "sec"),
+    Column("y_sec", np.int32, "sec"),
+    Column("z_sec", np.int32, "sec"),
+    Column("rng_sec", np.uint8, "sec"),
+    Column("pri_coarse", np.uint32, "pri"),
+    Column("pri_fine", np.uint16, "pri"),
+    Column("sec_coarse", np.uint32, "sec"),
+    Column("sec_fine", np.uint16, "sec"),
+    Column("compression", np.uint8, None),
+    Column("compression_width_bits", np.uint8, None),
+    Column("pri_active", np.uint8, None),
+    Column("sec_active", np.uint8, None),
+]
+
+# uncompressed vectors are 16+16+16+2 bits, so the bit layout repeats every 4 vectors
+UNCOMPRESSED_VECTOR_BITS = 50
+UNCOMPRESSED_GROUP_BYTES = 25
+UNCOMPRESSED_VECTORS_PER_GROUP = 4
+# byte offset of each vector within a group, and the 7 bytes that contain it
+_UNCOMPRESSED_VECTOR_BYTES = np.array([0, 6, 12, 18])[:, np.newaxis] + np.arange(7)
+_UNCOMPRESSED_BYTE_SHIFTS = np.arange(48, -1, -8, dtype=np.uint64)
+# vectors start at bit 0, 2, 4 and 6 of their first byte
+_UNCOMPRESSED_VECTOR_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint64)
+DecodedSciencePacket = namedtuple(
+    "DecodedSciencePacket",
+    [
+        "mode",
+        "sequence",
+        "pri_coarse",
+        "pri_fine",
+        "sec_coarse",
+        "sec_fine",
+        "pri_vecs_per_sec",
+        "sec_vecs_per_sec",
+        "secs_per_packet",
+        "compression",
+        "compression_width_bits",
+        "primary_is_active",
+        "secondary_is_active",
+        "primary_vectors",
+        "secondary_vectors",
+    ],
+)
 
 
 class _ScienceFileWriter:
@@ -25,6 +77,8 @@ class _ScienceFileWriter:
         primaryRate: float,
         secondaryRate: float,
         secsPerPacket: float,
+        flush_policy: FlushPolicy = FLUSH_EVERY_PACKET,
+        output_format: OutputFormat = OutputFormat.csv,
     ):
 
         self.time_now = datetime.now().strftime("%Y%m%d-%Hh%M")
@@ -35,9 +89,12 @@ class _ScienceFileWriter:
         self.modeName = modeName
         self.closePending = False
         self.secsPerPacket = secsPerPacket
-        self.writer = None
         self.idleTimer = None
         self.base_path = folder
+        self.flush_tracker = FlushTracker(flush_policy)
+        self.output_format = output_format
+        # held while writing so the idle timer thread can not flush part way through
+        self.lock = threading.RLock()
 
     def _first_write(self, firstPriCoarse, firstPriFine):
 
@@ -56,34 +113,11 @@ class _ScienceFileWriter:
             self.currentRate[2],
             self.data_start_timestamp.strftime("%Y%m%d-%Hh%Mm%Ss"),
         )
-        exists_already = os.path.isfile(self.filename)
-        self.file = open(self.filename, "a")
+        self.file = open_table_file(self.output_format, self.filename, SCIENCE_COLUMNS)
         self.isOpen = 1
         self.closePending = False
         self.secsPerPacket = self.secsPerPacket
-        self.writer = csv.writer(self.file)
-        if not exists_already:
-            self.writer.writerow(
-                [
-                    "sequence",
-                    "x_pri",
-                    "y_pri",
-                    "z_pri",
-                    "rng_pri",
-                    "x_sec",
-                    "y_sec",
-                    "z_sec",
-                    "rng_sec",
-                    "pri_coarse",
-                    "pri_fine",
-                    "sec_coarse",
-                    "sec_fine",
-                    "compression",
-                    "compression_width_bits",
-                    "pri_active",
-                    "sec_active",
-                ]
-            )
+        if not self.file.exists_already:
             print(f"Opened new {self.modeName.value} data file {self.filename}")
         else:
             print(
@@ -93,13 +127,13 @@ class _ScienceFileWriter:
     def _generateFileName(
         self, modeName, primaryRate, secondaryRate, secsPerPacket, data_start_timestamp
     ):
-        return f"{self.base_path}/MAGScience-{modeName}-({primaryRate},{secondaryRate})-{secsPerPacket}s-{data_start_timestamp}.csv"
+        return f"{self.base_path}/MAGScience-{modeName}-({primaryRate},{secondaryRate})-{secsPerPacket}s-{data_start_timestamp}{table_file_suffix(self.output_format)}"
 
     def write(
         self,
         sequence_count,
-        primary_vector,
-        secondary_vector,
+        primary_vectors: VectorBlock,
+        secondary_vectors: VectorBlock,
         primary_science_time_coarse,
         primary_science_time_fine,
         secondary_science_time_course,
@@ -109,45 +143,81 @@ class _ScienceFileWriter:
         primary_is_active,
         secondary_is_active,
     ):
-        if self.isOpen == 0:
-            self._first_write(primary_science_time_coarse, primary_science_time_fine)
+        # if mixed rates (like (64,8) we need the bigger of the 2 lengths so we can put that many rows into the CSV
+        rows = max(len(primary_vectors.x), len(secondary_vectors.x))
+        if rows == 0:
+            return
 
-        assert self.writer is not None
+        with self.lock:
+            if self.isOpen == 0:
+                self._first_write(
+                    primary_science_time_coarse, primary_science_time_fine
+                )
 
-        if self.isOpen == 1:
-            self.writer.writerow(
-                [
-                    sequence_count,
-                    primary_vector.x if primary_vector else None,
-                    primary_vector.y if primary_vector else None,
-                    primary_vector.z if primary_vector else None,
-                    primary_vector.rng if primary_vector else None,
-                    secondary_vector.x if secondary_vector else None,
-                    secondary_vector.y if secondary_vector else None,
-                    secondary_vector.z if secondary_vector else None,
-                    secondary_vector.rng if secondary_vector else None,
-                    primary_science_time_coarse if primary_vector else None,
-                    primary_science_time_fine if primary_vector else None,
-                    secondary_science_time_course if secondary_vector else None,
-                    secondary_science_time_fine if secondary_vector else None,
-                    compression,
-                    compression_width_bits,
-                    int(primary_is_active),
-                    int(secondary_is_active),
-                ]
-            )
+            assert self.file is not None
+
+            if self.isOpen == 1:
+                self.file.write(
+                    rows,
+                    [
+                        sequence_count,
+                        *primary_vectors,
+                        *secondary_vectors,
+                        primary_science_time_coarse,
+                        primary_science_time_fine,
+                        secondary_science_time_course,
+                        secondary_science_time_fine,
+                        compression,
+                        compression_width_bits,
+                        int(primary_is_active),
+                        int(secondary_is_active),
+                    ],
+                    {"pri": len(primary_vectors.x), "sec": len(secondary_vectors.x)},
+                )
+
+    def packet_written(self):
+        with self.lock:
+            if self.flush_tracker.packet_written():
+                self.flush()
+            elif self.isOpen == 1:
+                self._start_idle_timer()
+
+    def _start_idle_timer(self):
+        """With a latency budget, flush on a timer thread once the oldest unflushed row
+        has waited for it, so rows reach the disk in time even if no more arrive"""
+        max_latency = self.flush_tracker.policy.max_latency
+        if max_latency is not None and self.idleTimer is None:
+            self.idleTimer = threading.Timer(max_latency, self._flush_when_idle)
+            self.idleTimer.daemon = True
+            self.idleTimer.start()
+
+    def _flush_when_idle(self):
+        with self.lock:
+            # a flush since the timer was started has already written the rows
+            if self.idleTimer is threading.current_thread():
+                self.flush()
+
+    def _cancel_idle_timer(self):
+        if self.idleTimer is not None:
+            self.idleTimer.cancel()
+            self.idleTimer = None
 
     def flush(self):
-        if self.isOpen == 1 and self.file:
-            self.file.flush()
+        with self.lock:
+            self._cancel_idle_timer()
+            if self.isOpen == 1 and self.file:
+                self.file.flush()
+            self.flush_tracker.reset()
 
     def close(self):
-        if self.isOpen == 1:
-            if self.file:
-                self.file.close()
-            self.isOpen = 0
-            self.closePending = False
-            print(f"Closed {self.modeName.value} data file {self.filename}")
+        with self.lock:
+            self._cancel_idle_timer()
+            if self.isOpen == 1:
+                if self.file:
+                    self.file.close()
+                self.isOpen = 0
+                self.closePending = False
+                print(f"Closed {self.modeName.value} data file {self.filename}")
 
     def rateHasChanged(self, primaryRate, secondaryRate, secsPerPacket):
         return (
@@ -156,6 +226,62 @@ class _ScienceFileWriter:
         )
 
 
+class _BitReader:
+    """
+    Reads big-endian bit fields of any width from a science payload. The payload is
+    loaded once as a 64-bit window starting at every byte, so a field of up to 57 bits
+    is a single shift and mask whatever its alignment.
+    """
+
+    WINDOW_BITS = 64
+
+    def __init__(self, buffer):
+        self.data = np.frombuffer(buffer, dtype=np.uint8)
+        self.bit_length = len(self.data) * 8
+        self.cursor = 0
+        padded = np.concatenate((self.data, np.zeros(8, dtype=np.uint8)))
+        self._windows = np.ndarray(
+            shape=(len(self.data) + 1,), dtype=">u8", buffer=padded, strides=(1,)
+        ).tolist()
+        self._bits = None
+
+    @property
+    def bits(self):
+        """The whole payload as an array of 0/1 values, for vectorized decoding"""
+        if self._bits is None:
+            self._bits = np.unpackbits(self.data)
+        return self._bits
+
+    def read(self, bit_count: int) -> int:
+        """Read one unsigned field"""
+        cursor = self.cursor
+        end = cursor + bit_count
+        if end > self.bit_length:
+            raise IndexError("Not enough science data left to unpack fields")
+        self.cursor = end
+        shift = self.WINDOW_BITS - (cursor & 7) - bit_count
+        if shift < 0:
+            # too wide for one window so combine it from two reads
+            high = bit_count // 2
+            self.cursor = cursor
+            return (self.read(high) << (bit_count - high)) | self.read(bit_count - high)
+        return (self._windows[cursor >> 3] >> shift) & ((1 << bit_count) - 1)
+
+    def read_fields(self, bit_count: int, count: int) -> np.ndarray:
+        """Read count consecutive unsigned fields of bit_count bits"""
+        end = self.cursor + bit_count * count
+        if end > self.bit_length:
+            raise IndexError("Not enough science data left to unpack fields")
+        fields = self.bits[self.cursor : end]
+        self.cursor = end
+        return fields.reshape(count, bit_count).astype(np.int64) @ (
+            1 << np.arange(bit_count - 1, -1, -1, dtype=np.int64)
+        )
+
+    def align_to_byte(self):
+        self.cursor = (self.cursor + 7) & ~7
+
+
 class MAGScienceDecoder:
 
     class Rates:
@@ -218,16 +344,7 @@ class MAGScienceDecoder:
         102334155,
         165580141,
     ]
-
-    @staticmethod
-    def _to_int32(val):
-        # TODO: insane to include NP just for this - replace me!
-        return np.int32(val)
-
-    @staticmethod
-    def _toSigned16(n):
-        n = n & 0xFFFF
-        return n | (-(n & 0x8000))
+    FIBONACCI_WEIGHTS = np.array(FIBONACCI_SEQUENCE, dtype=np.int64)
 
     @staticmethod
     def _twos_complement(value: int, bits: int) -> int:
@@ -253,25 +370,6 @@ class MAGScienceDecoder:
             value = value - (1 << bits)
         return value
 
-    @staticmethod
-    def _unpack_value(buffer, bit_cursor, bit_count):
-        value = 0
-        while bit_count:
-            buffer_index = bit_cursor // 8
-            bits_unread = 8 - (bit_cursor % 8)
-            bit_shift = bit_count - bits_unread
-            if bit_shift >= 0:
-                read_mask = (1 << bits_unread) - 1
-                value += (buffer[buffer_index] & read_mask) << bit_shift
-                bit_cursor += bits_unread
-                bit_count = bit_shift
-            else:
-                read_mask = ((1 << bits_unread) - 1) & (0xFF << -bit_shift)
-                value += (buffer[buffer_index] & read_mask) >> -bit_shift
-                bit_cursor += bit_count
-                bit_count = 0
-        return (value, bit_cursor)
-
     @staticmethod
     def _fibonacci_encode(value):
         value += 1
@@ -290,21 +388,54 @@ class MAGScienceDecoder:
         return code
 
     @staticmethod
-    def _fibonacci_decode(code):
-        code = code[:-1]
-        fibonacci_decomposition = [
-            MAGScienceDecoder.FIBONACCI_SEQUENCE[i]
-            for i, bit in enumerate(code)
-            if bit == "1"
+    def _fibonacci_code_ends(bits, code_count):
+        """
+        Find the end of the first code_count Fibonacci codes in a bit array that starts
+        with a code. Each code ends with the first "11" pair, so a run of ones is split
+        into terminators from its start: the second, fourth, ... one of the run.
+        Returns the bit position after each code.
+        """
+        ones = bits.astype(bool)
+        positions = np.arange(len(bits))
+        run_starts = ones & ~np.concatenate(([False], ones[:-1]))
+        run_start = np.maximum.accumulate(np.where(run_starts, positions, 0))
+        code_ends = np.flatnonzero(ones & ((positions - run_start) % 2 == 1))[
+            :code_count
         ]
-        return sum(fibonacci_decomposition) - 1
+        code_ends += 1
+        if len(code_ends) < code_count:
+            # ran out of data: without a terminator each remaining code is 1 bit
+            last_end = code_ends[-1] if len(code_ends) else 0
+            code_ends = np.concatenate(
+                (code_ends, last_end + np.arange(1, code_count - len(code_ends) + 1))
+            )
+        return code_ends
 
     @staticmethod
-    def _get_next_fibonacci_code(bit_buffer: str, bit_cursor: int):
-        code_start = bit_cursor
-        code_length = bit_buffer[bit_cursor:].find("11") + 2
-        code = bit_buffer[code_start : code_start + code_length]
-        return code, code_start + code_length
+    def _fibonacci_decode_codes(bits, code_ends):
+        """Decode the Fibonacci codes ending at code_ends with the weight table"""
+        code_starts = np.concatenate(([0], code_ends[:-1]))
+        values = np.full(len(code_ends), -1, dtype=np.int64)
+        complete = code_ends <= len(bits)
+        if not complete.any():
+            return values
+        starts = code_starts[complete]
+        ends = code_ends[complete]
+        span = int(ends[-1])
+        code_bits = bits[:span].astype(np.int64)
+        # the terminating 1 of each code has no weight
+        code_bits[ends - 1] = 0
+        position_in_code = np.arange(span) - np.repeat(starts, ends - starts)
+        weights = MAGScienceDecoder.FIBONACCI_WEIGHTS[
+            np.where(code_bits, position_in_code, 0)
+        ]
+        totals = np.concatenate(([0], np.cumsum(code_bits * weights)))
+        values[complete] = totals[ends] - totals[starts] - 1
+        return values
+
+    @staticmethod
+    def _twos_complement_array(values, bits: int):
+        return np.where(values & (1 << (bits - 1)), values - (1 << bits), values)
 
     @staticmethod
     def _zigzag_encode(value):
@@ -335,11 +466,18 @@ class MAGScienceDecoder:
         else:
             raise ValueError(f"Invalid outRateId {outRateId}")
 
-    def __init__(self, folder):
+    def __init__(
+        self,
+        folder,
+        flush_policy: FlushPolicy = FLUSH_EVERY_PACKET,
+        output_format: OutputFormat = OutputFormat.csv,
+    ):
         self._burstWriter = None
         self._normalWriter = None
         self.currentModeName = None | ModeName
         self.base_path = folder
+        self.flush_policy = flush_policy
+        self.output_format = output_format
         self.last_burst_time = None
         self.last_normal_time = None
 
@@ -362,12 +500,57 @@ class MAGScienceDecoder:
         pri_sensor,
         vector_data,
     ):
+        self.write_decoded_packet(
+            MAGScienceDecoder.decode_packet(
+                apId,
+                sequence,
+                packet_length,
+                pus_stype,
+                pus_ssubtype,
+                pri_coarse,
+                pri_fine,
+                sec_coarse,
+                sec_fine,
+                PRI_VECSEC,
+                SEC_VECSEC,
+                compression,
+                fob_is_active,
+                fib_is_active,
+                pri_sensor,
+                vector_data,
+            )
+        )
+
+    @staticmethod
+    def decode_packet(
+        apId,
+        sequence,
+        packet_length,
+        pus_stype,
+        pus_ssubtype,
+        pri_coarse,
+        pri_fine,
+        sec_coarse,
+        sec_fine,
+        PRI_VECSEC,
+        SEC_VECSEC,
+        compression,
+        fob_is_active,
+        fib_is_active,
+        pri_sensor,
+        vector_data,
+    ) -> DecodedSciencePacket:
+        """
+        Decode the vectors in one science packet. This does not depend on any previous
+        packets so can be run on many packets at once (e.g. in worker processes) as long
+        as the results are passed to write_decoded_packet in packet order.
+        """
         secs_per_packet = pus_ssubtype + 1
-        pri_vecs_per_sec = self._getVectorsPerSecond(PRI_VECSEC)
-        sec_vecs_per_sec = self._getVectorsPerSecond(SEC_VECSEC)
+        pri_vecs_per_sec = MAGScienceDecoder._getVectorsPerSecond(PRI_VECSEC)
+        sec_vecs_per_sec = MAGScienceDecoder._getVectorsPerSecond(SEC_VECSEC)
         compression_width_bits = 16
         has_range_data_section = False
-        self.currentModeName = (
+        mode = (
             ModeName.burst if apId == CONSTANTS.APID_MAG_SCIENCE_BM else ModeName.normal
         )
         pri_time_utc = time_util.get_met_from_sci_timestamp(pri_coarse, pri_fine)
@@ -417,6 +600,47 @@ class MAGScienceDecoder:
                 )
             )
 
+        return DecodedSciencePacket(
+            mode,
+            sequence,
+            pri_coarse,
+            pri_fine,
+            sec_coarse,
+            sec_fine,
+            pri_vecs_per_sec,
+            sec_vecs_per_sec,
+            secs_per_packet,
+            compression,
+            compression_width_bits,
+            primary_is_active,
+            secondary_is_active,
+            primaryVectors,
+            secondaryVectors,
+        )
+
+    def write_decoded_packet(self, packet: DecodedSciencePacket):
+        """
+        Write a decoded packet to the CSV file for its mode, starting a new file when the
+        rate changes or there is a long gap since the last packet of the same mode
+        """
+        (
+            self.currentModeName,
+            sequence,
+            pri_coarse,
+            pri_fine,
+            sec_coarse,
+            sec_fine,
+            pri_vecs_per_sec,
+            sec_vecs_per_sec,
+            secs_per_packet,
+            compression,
+            compression_width_bits,
+            primary_is_active,
+            secondary_is_active,
+            primaryVectors,
+            secondaryVectors,
+        ) = packet
+
         # close the file if the rate has changed
         if (
             self.currentModeName == ModeName.burst
@@ -477,6 +701,8 @@ class MAGScienceDecoder:
                 pri_vecs_per_sec,
                 sec_vecs_per_sec,
                 secs_per_packet,
+                self.flush_policy,
+                self.output_format,
             )
 
         if self.currentModeName == ModeName.normal and (
@@ -488,6 +714,8 @@ class MAGScienceDecoder:
                 pri_vecs_per_sec,
                 sec_vecs_per_sec,
                 secs_per_packet,
+                self.flush_policy,
+                self.output_format,
             )
 
         # which writer shall we use? based on packet ApId
@@ -500,27 +728,22 @@ class MAGScienceDecoder:
         if writer is None:
             raise ValueError(f"No writer found for mode {self.currentModeName}")
 
-        # if mixed rates (like (64,8) we need the bigger of the 2 lengths so wecan put that many rows into the CSV
-        maxVectors = max(len(primaryVectors), len(secondaryVectors))
-        for i in range(maxVectors):
-            primary = primaryVectors[i] if i < len(primaryVectors) else None
-            secondary = secondaryVectors[i] if i < len(secondaryVectors) else None
-            writer.write(
-                sequence,
-                primary,
-                secondary,
-                pri_coarse,
-                pri_fine,
-                sec_coarse,
-                sec_fine,
-                compression,
-                compression_width_bits,
-                primary_is_active,
-                secondary_is_active,
-            )
+        writer.write(
+            sequence,
+            primaryVectors,
+            secondaryVectors,
+            pri_coarse,
+            pri_fine,
+            sec_coarse,
+            sec_fine,
+            compression,
+            compression_width_bits,
+            primary_is_active,
+            secondary_is_active,
+        )
 
-        # after each packet make sure everything is written to disk
-        writer.flush()
+        # flush to disk as often as the flush policy asks
+        writer.packet_written()
 
         # close the file if we are now in config mode or have transitioned
         if self._burstWriter is not None and self._burstWriter.closePending:
@@ -536,24 +759,16 @@ class MAGScienceDecoder:
             self._normalWriter.close()
 
     @staticmethod
-    def _unpackOneVector(vector_data, sci_cursor, width, hasRange):
-        x, sci_cursor = MAGScienceDecoder._unpack_value(vector_data, sci_cursor, width)
-        y, sci_cursor = MAGScienceDecoder._unpack_value(vector_data, sci_cursor, width)
-        z, sci_cursor = MAGScienceDecoder._unpack_value(vector_data, sci_cursor, width)
-        rng, sci_cursor = (
-            (0, sci_cursor)
-            if not (hasRange)
-            else MAGScienceDecoder._unpack_value(vector_data, sci_cursor, 2)
-        )
-        # print(f"Unpacked vector: {x},{y},{z},{rng}")
-        return (
-            Vector(
-                MAGScienceDecoder._twos_complement(x, width),
-                MAGScienceDecoder._twos_complement(y, width),
-                MAGScienceDecoder._twos_complement(z, width),
-                int(rng),
-            ),
-            sci_cursor,
+    def _unpackOneVector(reader: _BitReader, width, hasRange):
+        x = reader.read(width)
+        y = reader.read(width)
+        z = reader.read(width)
+        rng = reader.read(2) if hasRange else 0
+        return Vector(
+            MAGScienceDecoder._twos_complement(x, width),
+            MAGScienceDecoder._twos_complement(y, width),
+            MAGScienceDecoder._twos_complement(z, width),
+            rng,
         )
 
     @staticmethod
@@ -566,230 +781,167 @@ class MAGScienceDecoder:
         pri_coarse,
         pri_time_utc,
     ):
-        sci_cursor = 0
-        primaryVectors = []
-        secondaryVectors = []
-        # Extract reference samples  first vectors which are packed full width
-        primaryFirstVector, sci_cursor = MAGScienceDecoder._unpackOneVector(
-            vector_data, sci_cursor, compression_width_bits, True
-        )
-        primaryVectors.append(primaryFirstVector)
-
-        # Prepare bit buffer from compressed data to support getting fibonacci codes
-        sci_bits = "".join(f"{byte:08b}" for byte in vector_data)
-
-        # Decode PRIMARY samples
-        PRI_HDR_FLAG = False
-        for i in range(1, total_pri_vecs):
-            if PRI_HDR_FLAG:
-                vector, sci_cursor = MAGScienceDecoder._unpackOneVector(
-                    vector_data, sci_cursor, compression_width_bits, False
-                )
-            else:
-                sci_cursor_start = sci_cursor
-                code, sci_cursor = MAGScienceDecoder._get_next_fibonacci_code(
-                    sci_bits, sci_cursor
-                )
-                x = MAGScienceDecoder._zigzag_decode(
-                    MAGScienceDecoder._fibonacci_decode(code)
-                )
-                code, sci_cursor = MAGScienceDecoder._get_next_fibonacci_code(
-                    sci_bits, sci_cursor
-                )
-                y = MAGScienceDecoder._zigzag_decode(
-                    MAGScienceDecoder._fibonacci_decode(code)
-                )
-                code, sci_cursor = MAGScienceDecoder._get_next_fibonacci_code(
-                    sci_bits, sci_cursor
-                )
-                z = MAGScienceDecoder._zigzag_decode(
-                    MAGScienceDecoder._fibonacci_decode(code)
-                )
-                bits_read = sci_cursor - sci_cursor_start
-                diffVector = Vector(x, y, z, 0)
-                vector = Vector(
-                    MAGScienceDecoder._to_int32(primaryVectors[i - 1].x) + diffVector.x,
-                    MAGScienceDecoder._to_int32(primaryVectors[i - 1].y) + diffVector.y,
-                    MAGScienceDecoder._to_int32(primaryVectors[i - 1].z) + diffVector.z,
-                    0,
-                )
-
-                if bits_read > MAGScienceDecoder.HDR_VECTOR_WIDTH_THRESHOLD:
-                    print(
-                        f"NOTE: HDR detected in primary sensor after {i} vectors. Switching to full width. (Primary vector time {pri_coarse} ~ {pri_time_utc.strftime('%Y-%m-%d %H:%M:%S')})"
-                    )
-                    PRI_HDR_FLAG = True
+        reader = _BitReader(vector_data)
 
-            primaryVectors.append(vector)
-
-        secondaryFirstVector, sci_cursor = MAGScienceDecoder._unpackOneVector(
-            vector_data, sci_cursor, compression_width_bits, True
+        # Extract reference samples first vectors which are packed full width
+        primaryFirstVector = MAGScienceDecoder._unpackOneVector(
+            reader, compression_width_bits, True
         )
-        secondaryVectors.append(secondaryFirstVector)
-
-        SEC_HDR_FLAG = False
-        for i in range(1, total_sec_vecs):
-            if SEC_HDR_FLAG:
-                vector, sci_cursor = MAGScienceDecoder._unpackOneVector(
-                    vector_data, sci_cursor, compression_width_bits, False
-                )
-            else:
-                sci_cursor_start = sci_cursor
-                code, sci_cursor = MAGScienceDecoder._get_next_fibonacci_code(
-                    sci_bits, sci_cursor
-                )
-                x = MAGScienceDecoder._zigzag_decode(
-                    MAGScienceDecoder._fibonacci_decode(code)
-                )
-                code, sci_cursor = MAGScienceDecoder._get_next_fibonacci_code(
-                    sci_bits, sci_cursor
-                )
-                y = MAGScienceDecoder._zigzag_decode(
-                    MAGScienceDecoder._fibonacci_decode(code)
-                )
-                code, sci_cursor = MAGScienceDecoder._get_next_fibonacci_code(
-                    sci_bits, sci_cursor
-                )
-                z = MAGScienceDecoder._zigzag_decode(
-                    MAGScienceDecoder._fibonacci_decode(code)
-                )
-                bits_read = sci_cursor - sci_cursor_start
-                diffVector = Vector(x, y, z, 0)
-                vector = Vector(
-                    MAGScienceDecoder._to_int32(secondaryVectors[i - 1].x)
-                    + diffVector.x,
-                    MAGScienceDecoder._to_int32(secondaryVectors[i - 1].y)
-                    + diffVector.y,
-                    MAGScienceDecoder._to_int32(secondaryVectors[i - 1].z)
-                    + diffVector.z,
-                    0,
-                )
-
-                if bits_read > MAGScienceDecoder.HDR_VECTOR_WIDTH_THRESHOLD:
-                    print(
-                        f"NOTE: HDR detected in secondary sensor after {i} vectors. Switching to full width. (Primary vector time {pri_coarse} ~ {pri_time_utc.strftime('%Y-%m-%d %H:%M:%S')})"
-                    )
-                    SEC_HDR_FLAG = True
+        primaryColumns, pri_hdr_vector = MAGScienceDecoder._decodeCompressedSensor(
+            reader,
+            primaryFirstVector,
+            total_pri_vecs,
+            compression_width_bits,
+        )
+        if pri_hdr_vector is not None:
+            print(
+                f"NOTE: HDR detected in primary sensor after {pri_hdr_vector} vectors. Switching to full width. (Primary vector time {pri_coarse} ~ {pri_time_utc.strftime('%Y-%m-%d %H:%M:%S')})"
+            )
 
-            secondaryVectors.append(vector)
+        secondaryFirstVector = MAGScienceDecoder._unpackOneVector(
+            reader, compression_width_bits, True
+        )
+        secondaryColumns, sec_hdr_vector = MAGScienceDecoder._decodeCompressedSensor(
+            reader,
+            secondaryFirstVector,
+            total_sec_vecs,
+            compression_width_bits,
+        )
+        if sec_hdr_vector is not None:
+            print(
+                f"NOTE: HDR detected in secondary sensor after {sec_hdr_vector} vectors. Switching to full width. (Primary vector time {pri_coarse} ~ {pri_time_utc.strftime('%Y-%m-%d %H:%M:%S')})"
+            )
 
         # Add range to the samples
+        pri_count = len(primaryColumns) - 1
+        sec_count = len(secondaryColumns) - 1
         if has_range_data_section:
             # unpack the range data and fill in the vectors with the range
-            sci_cursor = (sci_cursor + 7) & 0xFFFFFFF8
-            for i in range(1, total_pri_vecs):
-                rng, sci_cursor = MAGScienceDecoder._unpack_value(
-                    vector_data, sci_cursor, 2
-                )
-                primaryVectors[i] = primaryVectors[i]._replace(rng=int(rng))
-            for i in range(1, total_sec_vecs):
-                rng, sci_cursor = MAGScienceDecoder._unpack_value(
-                    vector_data, sci_cursor, 2
-                )
-                secondaryVectors[i] = secondaryVectors[i]._replace(rng=int(rng))
+            reader.align_to_byte()
+            ranges = reader.read_fields(2, pri_count + sec_count)
+            primaryRanges = np.concatenate(
+                ([primaryFirstVector.rng], ranges[:pri_count])
+            )
+            secondaryRanges = np.concatenate(
+                ([secondaryFirstVector.rng], ranges[pri_count:])
+            )
         else:
             # copy the range from the first vector as range has been static for the entire packet
-            for i in range(1, total_pri_vecs):
-                primaryVectors[i] = primaryVectors[i]._replace(
-                    rng=primaryVectors[0].rng
-                )
-            for i in range(1, total_sec_vecs):
-                secondaryVectors[i] = secondaryVectors[i]._replace(
-                    rng=secondaryVectors[0].rng
-                )
+            primaryRanges = np.full(pri_count + 1, primaryFirstVector.rng)
+            secondaryRanges = np.full(sec_count + 1, secondaryFirstVector.rng)
 
-        return primaryVectors, secondaryVectors
+        return (
+            VectorBlock(
+                *primaryColumns.T.astype(np.int32), primaryRanges.astype(np.uint8)
+            ),
+            VectorBlock(
+                *secondaryColumns.T.astype(np.int32), secondaryRanges.astype(np.uint8)
+            ),
+        )
 
     @staticmethod
-    def _unpackUncompressedVectors(total_pri_vecs, total_sec_vecs, vector_data):
-        pos = 0
-        primaryVectors = []
-        secondaryVectors = []
-        for i in range(total_pri_vecs + total_sec_vecs):  # 0..63 say
-            x, y, z, rng = 0, 0, 0, 0
-            if i % 4 == 0:  # start at bit 0, take 8 bits + 8bits
-                # pos = 0, 25, 50...
-                x = (
-                    ((vector_data[pos + 0] & 0xFF) << 8)
-                    | ((vector_data[pos + 1] & 0xFF) << 0)
-                ) & 0xFFFF
-                y = (
-                    ((vector_data[pos + 2] & 0xFF) << 8)
-                    | ((vector_data[pos + 3] & 0xFF) << 0)
-                ) & 0xFFFF
-                z = (
-                    ((vector_data[pos + 4] & 0xFF) << 8)
-                    | ((vector_data[pos + 5] & 0xFF) << 0)
-                ) & 0xFFFF
-                rng = (vector_data[pos + 6] >> 6) & 0x3
-                pos += 6
-            elif i % 4 == 1:  # start at bit 2, take 6 bits, 8 bit, 2 bits per vector
-                # pos = 6, 31...
-                x = (
-                    ((vector_data[pos + 0] & 0x3F) << 10)
-                    | ((vector_data[pos + 1] & 0xFF) << 2)
-                    | ((vector_data[pos + 2] >> 6) & 0x03)
-                ) & 0xFFFF
-                y = (
-                    ((vector_data[pos + 2] & 0x3F) << 10)
-                    | ((vector_data[pos + 3] & 0xFF) << 2)
-                    | ((vector_data[pos + 4] >> 6) & 0x03)
-                ) & 0xFFFF
-                z = (
-                    ((vector_data[pos + 4] & 0x3F) << 10)
-                    | ((vector_data[pos + 5] & 0xFF) << 2)
-                    | ((vector_data[pos + 6] >> 6) & 0x03)
-                ) & 0xFFFF
-                rng = (vector_data[pos + 6] >> 4) & 0x3
-                pos += 6
-            elif i % 4 == 2:  # start at bit 4, take 4 bits, 8 bits, 4 bits per vector
-                # pos = 12, 37...
-                x = (
-                    ((vector_data[pos + 0] & 0x0F) << 12)
-                    | ((vector_data[pos + 1] & 0xFF) << 4)
-                    | ((vector_data[pos + 2] >> 4) & 0x0F)
-                ) & 0xFFFF
-                y = (
-                    ((vector_data[pos + 2] & 0x0F) << 12)
-                    | ((vector_data[pos + 3] & 0xFF) << 4)
-                    | ((vector_data[pos + 4] >> 4) & 0x0F)
-                ) & 0xFFFF
-                z = (
-                    ((vector_data[pos + 4] & 0x0F) << 12)
-                    | ((vector_data[pos + 5] & 0xFF) << 4)
-                    | ((vector_data[pos + 6] >> 4) & 0x0F)
-                ) & 0xFFFF
-                rng = (vector_data[pos + 6] >> 2) & 0x3
-                pos += 6
-            elif i % 4 == 3:  # start at bit 6, take 2 bits, 8 bits, 6 bits per vector
-                # pos = 18, 43...
-                x = (
-                    ((vector_data[pos + 0] & 0x03) << 14)
-                    | ((vector_data[pos + 1] & 0xFF) << 6)
-                    | ((vector_data[pos + 2] >> 2) & 0x3F)
-                ) & 0xFFFF
-                y = (
-                    ((vector_data[pos + 2] & 0x03) << 14)
-                    | ((vector_data[pos + 3] & 0xFF) << 6)
-                    | ((vector_data[pos + 4] >> 2) & 0x3F)
-                ) & 0xFFFF
-                z = (
-                    ((vector_data[pos + 4] & 0x03) << 14)
-                    | ((vector_data[pos + 5] & 0xFF) << 6)
-                    | ((vector_data[pos + 6] >> 2) & 0x3F)
-                ) & 0xFFFF
-                rng = (vector_data[pos + 6] >> 0) & 0x3
-                pos += 7
-
-            vector = Vector(
-                MAGScienceDecoder._toSigned16(x),
-                MAGScienceDecoder._toSigned16(y),
-                MAGScienceDecoder._toSigned16(z),
-                rng,
+    def _decodeCompressedSensor(reader: _BitReader, first_vector, total_vecs, width):
+        """
+        Decode the delta compressed vectors of one sensor that follow its full width
+        first vector, leaving the reader after the last vector. Returns a (vectors, 3)
+        array of x, y, z including the first vector and the vector number where HDR
+        switched the packing to full width (or None).
+        """
+        delta_count = max(total_vecs - 1, 0)
+        code_bits = reader.bits[reader.cursor :]
+        code_ends = MAGScienceDecoder._fibonacci_code_ends(
+            code_bits, delta_count * MAGScienceDecoder.AXIS_COUNT
+        )
+
+        # the first vector whose 3 codes are wider than the threshold switches the rest
+        # of the sensor's vectors to full width
+        vector_ends = code_ends[MAGScienceDecoder.AXIS_COUNT - 1 :: 3]
+        vector_bits = np.diff(vector_ends, prepend=0)
+        hdr = np.flatnonzero(vector_bits > MAGScienceDecoder.HDR_VECTOR_WIDTH_THRESHOLD)
+        hdr_vector = int(hdr[0]) + 1 if len(hdr) else None
+        delta_vectors = hdr_vector if hdr_vector is not None else delta_count
+
+        deltas = MAGScienceDecoder._zigzag_decode(
+            MAGScienceDecoder._fibonacci_decode_codes(
+                code_bits,
+                code_ends[: delta_vectors * MAGScienceDecoder.AXIS_COUNT],
             )
+        ).reshape(delta_vectors, MAGScienceDecoder.AXIS_COUNT)
+        if delta_vectors:
+            reader.cursor += int(vector_ends[delta_vectors - 1])
+
+        # rebuild absolute values from the deltas, wrapping at 32 bits
+        first = np.array(first_vector[:3], dtype=np.int64).astype(np.int32)
+        vectors = np.cumsum(
+            np.vstack((first[np.newaxis, :], deltas)), axis=0, dtype=np.int64
+        ).astype(np.int32)
+
+        full_width_count = delta_count - delta_vectors
+        if full_width_count:
+            full_width = MAGScienceDecoder._twos_complement_array(
+                reader.read_fields(
+                    width, full_width_count * MAGScienceDecoder.AXIS_COUNT
+                ),
+                width,
+            ).reshape(full_width_count, MAGScienceDecoder.AXIS_COUNT)
+            vectors = np.vstack((vectors, full_width))
+
+        return vectors, hdr_vector
 
-            if i < total_pri_vecs:
-                primaryVectors.append(vector)
-            else:
-                secondaryVectors.append(vector)
-        return primaryVectors, secondaryVectors
+    @staticmethod
+    def _unpackUncompressedColumns(vector_data, total_vecs):
+        """
+        Unpack uncompressed 16+16+16+2 bit vectors into x, y, z and range columns.
+        The layout repeats every 4 vectors in 25 bytes, so the payload is viewed as
+        25 byte groups and all vectors are extracted with a few array operations.
+        vector_data can be the payload of one packet or a 2D array holding the payloads
+        of a batch of packets (one per row), in which case the columns are 2D too.
+        """
+        data = np.asarray(
+            vector_data
+            if isinstance(vector_data, np.ndarray)
+            else np.frombuffer(vector_data, dtype=np.uint8)
+        )
+        batch = np.atleast_2d(data)
+        if batch.shape[1] < -(-total_vecs * UNCOMPRESSED_VECTOR_BITS // 8):
+            raise IndexError("Not enough science data left to unpack vectors")
+        groups = -(-total_vecs // UNCOMPRESSED_VECTORS_PER_GROUP)
+        group_bytes = groups * UNCOMPRESSED_GROUP_BYTES
+        if batch.shape[1] < group_bytes:
+            # only the unused end of the last group is missing, so no vector reads it
+            batch = np.pad(batch, ((0, 0), (0, group_bytes - batch.shape[1])))
+        batch = batch[:, :group_bytes].reshape(
+            batch.shape[0], groups, UNCOMPRESSED_GROUP_BYTES
+        )
+
+        # the 7 bytes holding each 50 bit vector, combined into one word per vector and
+        # shifted so the vector sits in the lowest 50 bits
+        words = np.bitwise_or.reduce(
+            batch[:, :, _UNCOMPRESSED_VECTOR_BYTES].astype(np.uint64)
+            << _UNCOMPRESSED_BYTE_SHIFTS,
+            axis=-1,
+        )
+        words >>= _UNCOMPRESSED_VECTOR_SHIFTS
+        words = words.reshape(batch.shape[0], -1)[:, :total_vecs]
+
+        x = (words >> np.uint64(34)).astype(np.uint16).view(np.int16)
+        y = (words >> np.uint64(18)).astype(np.uint16).view(np.int16)
+        z = (words >> np.uint64(2)).astype(np.uint16).view(np.int16)
+        rng = (words & np.uint64(0x3)).astype(np.uint8)
+
+        if data.ndim == 1:
+            return x[0], y[0], z[0], rng[0]
+        return x, y, z, rng
+
+    @staticmethod
+    def _unpackUncompressedVectors(total_pri_vecs, total_sec_vecs, vector_data):
+        x, y, z, rng = MAGScienceDecoder._unpackUncompressedColumns(
+            vector_data, total_pri_vecs + total_sec_vecs
+        )
+        block = VectorBlock(
+            x.astype(np.int32), y.astype(np.int32), z.astype(np.int32), rng
+        )
+        return (
+            VectorBlock(*(column[:total_pri_vecs] for column in block)),
+            VectorBlock(*(column[total_pri_vecs:] for column in block)),
+        )
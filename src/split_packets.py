@@ -1,25 +1,42 @@
+import contextlib
 import glob
 import io
 import os
 import re
 import sys
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from enum import Enum
 from io import TextIOWrapper
 from pathlib import Path
 from typing import List, Optional
 
+import numpy as np
 import typer
-from ccsdspy.utils import iter_packet_bytes
 from click.exceptions import Exit
 from rich.progress import Progress, track
 
 from constants import CONSTANTS
-from packet_util import (
-    get_imap_basic_packet_def,
-    get_imap_science_packet_headers_only_def,
-    parse_apids,
+from packet_archive import (
+    ARCHIVE_INDEX_SUFFIX,
+    ARCHIVE_SUFFIX,
+    PacketArchive,
+    archive_keys,
 )
-from time_util import get_met_from_shcourse
+from packet_dedupe import PacketKeySet
+from packet_index import (
+    INDEX_CACHE_SUFFIX,
+    PacketFileReader,
+    PacketIndex,
+    discard_preloaded_indexes,
+    open_for_append,
+    preload_packet_indexes,
+    write_packets,
+)
+from packet_util import parse_apids
+from parallel import create_process_pool, resolve_jobs, validate_jobs
+from time_util import get_met_from_shcourse, get_met_from_shcourses
 
 app = typer.Typer()
 
@@ -28,6 +45,42 @@ sci_report_file: TextIOWrapper
 exit_code = 0
 packet_counter = 0
 is_multi_file = False
+# the --bucket files being appended to, shared by all the files of a folder or glob
+bucket_files = None
+
+# the one file per packet output is written by a pool of threads, so many files are being
+# created at once rather than each waiting on the file system (slow on network shares)
+SPLIT_WRITER_THREADS = 16
+SPLIT_WRITES_IN_FLIGHT = 1024
+# the --bucket output keeps this many files open, closing the least recently used
+BUCKET_OPEN_FILES = 64
+BUCKET_FILE_BUFFER_BYTES = 256 * 1024
+# the reports are formatted from the packet index this many rows at a time
+REPORT_BLOCK_ROWS = 65536
+
+
+class TimeBucket(str, Enum):
+    hour = "hour"
+    day = "day"
+
+
+BUCKET_SECONDS = {TimeBucket.hour: 60 * 60, TimeBucket.day: 24 * 60 * 60}
+# strftime format of the start of each bucket, for the bucket file names
+BUCKET_NAME_FORMATS = {TimeBucket.hour: "%Y-%m-%d_%H", TimeBucket.day: "%Y-%m-%d"}
+
+SCIENCE_REPORT_FIELDS = [
+    "PUS_SSUBTYPE",
+    "COMPRESSION",
+    "FOB_ACT",
+    "FIB_ACT",
+    "PRI_SENS",
+    "PRI_VECSEC",
+    "SEC_VECSEC",
+    "PRI_COARSETM",
+    "PRI_FNTM",
+    "SEC_COARSETM",
+    "SEC_FNTM",
+]
 
 
 @app.callback(
@@ -52,6 +105,17 @@ def split_packets(
         "--summarise",
         help="Skip the packet splitting and just generate the summary files",
     ),
+    packed: bool = typer.Option(
+        False,
+        "--packed",
+        help=f"Append the packets of each ApID to one <apid>/<apid>{ARCHIVE_SUFFIX} file (or one <apid>/<apid>_<UTC hour or day>{ARCHIVE_SUFFIX} file per hour or day with --bucket), with a {ARCHIVE_INDEX_SUFFIX} index of the SHCOARSE, seq count and offset of each packet next to it, rather than saving each packet to its own file",
+    ),
+    bucket: Optional[TimeBucket] = typer.Option(
+        None,
+        "--bucket",
+        case_sensitive=False,
+        help="Append the packets of each ApID to one <apid>/<apid>_<UTC hour or day>.bin file per hour or day (of SHCOARSE), in one pass over the input, rather than saving each packet to its own file. Packets are appended to bucket files that already exist, skipping packets that are already in them",
+    ),
     limit: int = typer.Option(
         0,
         "--limit",
@@ -67,6 +131,22 @@ def split_packets(
         "--mag-only/--all",
         help="mag-only = only process MAG packets and ignore ApIDs outside of the MAG range, all = process all packets inc spacecraft and other instruments",
     ),
+    use_mmap: bool = typer.Option(
+        True,
+        "--mmap/--no-mmap",
+        help="Memory map the input file(s) and read packets in place rather than loading each file into memory",
+    ),
+    use_index_cache: bool = typer.Option(
+        False,
+        "--index-cache/--no-index-cache",
+        help="Reuse (or create) a .pktidx packet index next to each input file so later commands on the same file can skip re-reading the packet headers",
+    ),
+    jobs: int = typer.Option(
+        1,
+        "--jobs",
+        "-j",
+        help="Number of worker processes to split the files with when given a folder or glob. 0 = one per CPU core. The output, reports and --limit are the same as with 1. With --packed or --bucket the packets are still appended to their files one input file at a time",
+    ),
 ):
     """
     Check MAG science CSV files for gaps in sequence counters and time stamps
@@ -75,9 +155,13 @@ def split_packets(
     global sci_report_file
     global exit_code
     global is_multi_file
+    global packet_counter
+    global bucket_files
 
     report_file = None
     exit_code = 0
+    if not is_multi_file:
+        packet_counter = 0
     globPath = None
 
     if packets_files.is_dir():
@@ -91,6 +175,13 @@ def split_packets(
         else report_file_path
     )
 
+    if not validate_jobs(jobs):
+        raise typer.Abort()
+
+    # checked before the files are split between worker processes, so --jobs gives the
+    # same result as a serial run
+    _validate_split_packets_options(limit, apids)
+
     if globPath:
         _split_packets_in_multiple_files_from_glob(
             globPath,
@@ -98,46 +189,50 @@ def split_packets(
             report_file_path,
             no_report,
             summarise_only,
+            packed,
+            bucket,
             limit,
             apids,
             mag_only,
+            use_mmap,
+            use_index_cache,
+            jobs,
         )
         return
 
     _validate_split_packets_args(
-        packets_files, report_file_path, no_report, summarise_only, limit, apids
+        packets_files, report_file_path, no_report, summarise_only
     )
 
     if not no_report:
-        headers = False
-        if not report_file_path.exists():
-            headers = True
-        report_file = open(report_file_path, "a")
-        if headers:
-            report_file.write("APID,Sequence Count,Length,SHCOURSE,MET_UTC\n")
-
-        sci_file = (
-            report_file_path.parent
-            / f"{report_file_path.with_suffix('').name}_scionly.csv"
-        )
-        headers = False
-        if not sci_file.exists():
-            headers = True
-        sci_report_file = open(sci_file, "a")
-        if headers:
-            sci_report_file.write(
-                "APID,PHSEQCNT,PHDLEN,SHCOURSE,PUS_SSUBTYPE,COMPRESSION,FOB_ACT,FIB_ACT,PRI_SENS,PRI_VECSEC,SEC_VECSEC,PRI_COARSETM,PRI_FNTM,SEC_COARSETM,SEC_FNTM,MET_UTC\n"
-            )
+        report_file, sci_report_file = _open_report_files(report_file_path)
 
     filter_to_apids = parse_apids(apids)
 
-    _split_packets_in_one_file(
-        packets_files, no_report, limit, mag_only, filter_to_apids, summarise_only
-    )
+    if not is_multi_file:
+        bucket_files = _BucketFiles()
+    try:
+        _split_packets_in_one_file(
+            packets_files,
+            no_report,
+            limit,
+            mag_only,
+            filter_to_apids,
+            summarise_only,
+            use_mmap,
+            use_index_cache,
+            packed,
+            bucket,
+        )
+    finally:
+        if not is_multi_file:
+            bucket_files.close()
 
-    if not no_report and not is_multi_file:
+    if not no_report:
         report_file.close()
-        print(f"Packet summary saved to {report_file_path}")
+        sci_report_file.close()
+        if not is_multi_file:
+            print(f"Packet summary saved to {report_file_path}")
 
     if exit_code != 0:
         raise typer.Exit(code=exit_code)
@@ -150,112 +245,631 @@ def _split_packets_in_one_file(
     mag_only: bool,
     apid_filter: List[int],
     summarise_only: bool = False,
+    use_mmap: bool = True,
+    use_index_cache: bool = False,
+    packed: bool = False,
+    bucket: TimeBucket | None = None,
 ):
     global exit_code
     global packet_counter
     global report_file
     global sci_report_file
 
-    pktDefinition = get_imap_basic_packet_def()
-    sciPktDefinition = get_imap_science_packet_headers_only_def()
-
     if limit != 0 and packet_counter >= limit:
         return
 
-    size = os.path.getsize(packet_file)
-    processed_bytes = 0
+    reader = PacketFileReader(packet_file, use_mmap, use_index_cache)
+    index = reader.index
+    size = reader.size
+    selected = index.select(mag_only, apid_filter)
+    if limit > 0:
+        selected = selected[: limit - packet_counter]
+
+    if not no_report:
+        _write_reports(reader, selected, report_file, sci_report_file)
+
+    if not summarise_only:
+        _append_packets_to_files(reader, packet_file, selected, packed, bucket)
+
     with Progress(refresh_per_second=1) as progress:
         task1 = progress.add_task(f"Processing {packet_file}", total=size)
-        for packet_bytes in iter_packet_bytes(packet_file, include_primary_header=True):
-            progress.update(task1, advance=len(packet_bytes))
-            processed_bytes += len(packet_bytes)
+        if not summarise_only and not packed and bucket is None:
+            if _split_packets_to_files(reader, packet_file, selected):
+                exit_code = 1
 
-            fileLikeObject = io.BytesIO(packet_bytes)
-            pkt = pktDefinition.load(fileLikeObject, include_primary_header=True)
-            apid = pkt["CCSDS_APID"][0]
+        packet_counter += len(selected)
+        progress.update(
+            task1, advance=_processed_bytes(index, selected, limit, packet_counter)
+        )
 
-            # check the packet shopuld not be filtered out
-            if mag_only:
-                if apid < CONSTANTS.APID_MAG_START or apid > CONSTANTS.APID_MAG_END:
-                    continue
+    reader.close()
 
-            if apid_filter:
-                if apid not in apid_filter:
-                    continue
+    _print_split_file(
+        packet_file, index, selected, limit, packet_counter, summarise_only
+    )
 
-            is_science = False
-            if (
-                apid == CONSTANTS.APID_MAG_SCIENCE_NM
-                or apid == CONSTANTS.APID_MAG_SCIENCE_BM
-            ):
-                is_science = True
-
-                fileLikeObject.seek(0)
-                pkt = sciPktDefinition.load(fileLikeObject, include_primary_header=True)
-
-            # Save the single packet to it's own .bin file?
-            if not summarise_only:
-                newFileName = (
-                    packet_file.parent
-                    / str(apid)
-                    / f"{pkt['SHCOARSE'][0]}-{pkt['CCSDS_SEQUENCE_COUNT'][0]}.bin"
-                )
 
-                if newFileName.exists():
-                    print(f"Existing packet found: {newFileName} - skipped it")
-                    exit_code = 1
-                else:
-                    if not newFileName.parent.exists():
-                        newFileName.parent.mkdir(parents=True)
+def _split_packets_to_files(
+    reader: PacketFileReader,
+    packet_file: Path,
+    selected: np.ndarray,
+    split_before: np.ndarray | None = None,
+) -> int:
+    """Save each selected packet to its own file in a folder per ApID next to
+    packet_file. The packets marked in split_before were split from an earlier file of
+    the run, so are reported as existing rather than written. Returns the number of
+    packets that were found to exist already"""
+    index = reader.index
+    if split_before is None:
+        split_before = np.zeros(len(selected), dtype=bool)
+    split_writer = _SplitFileWriter()
+    for position, apid, seq_count, shcoarse, before in zip(
+        selected.tolist(),
+        index.apid[selected].tolist(),
+        index.seq_count[selected].tolist(),
+        index.shcoarse[selected].tolist(),
+        split_before.tolist(),
+    ):
+        filename = packet_file.parent / str(apid) / f"{shcoarse}-{seq_count}.bin"
+        if before:
+            split_writer.skip(filename)
+            continue
+
+        # Save the single packet to it's own .bin file
+        split_writer.write(filename, reader.packet(position))
+
+    # the packets being written are views of the input file, so finish them first
+    split_writer.close()
+    return split_writer.existing_packets
+
+
+def _append_packets_to_files(
+    reader: PacketFileReader,
+    packet_file: Path,
+    selected: np.ndarray,
+    packed: bool,
+    bucket: TimeBucket | None,
+):
+    """Append the selected packets to the --packed archives or --bucket files"""
+    if packed:
+        _append_packets_to_archives(reader, packet_file, selected, bucket)
+    elif bucket is not None:
+        _append_packets_to_buckets(reader, packet_file, selected, bucket, bucket_files)
 
-                    with open(newFileName, "wb") as f:
-                        f.write(packet_bytes)
 
-            packet_counter += 1
+def _processed_bytes(
+    index: PacketIndex, selected: np.ndarray, limit: int, counter: int
+) -> int:
+    """The bytes of the file read up to the last packet selected if the limit was
+    reached in it, or else all of them"""
+    if limit > 0 and counter >= limit and len(selected) > 0:
+        last = int(selected[-1])
+        return int(index.offset[last] + index.length[last])
+    return index.total_bytes
 
-            if not no_report:
-                met_utc = get_met_from_shcourse(int(pkt["SHCOARSE"][0])).strftime(
-                    "%Y-%m-%d %H:%M:%S.%f"
-                )[:-3]
-                report_file.write(
-                    f"{apid},{pkt['CCSDS_SEQUENCE_COUNT'][0]},{pkt['CCSDS_PACKET_LENGTH'][0]},{pkt['SHCOARSE'][0]},{met_utc}\n"
-                )
-                if is_science:
-                    sci_report_file.write(
-                        f"{apid},{pkt['CCSDS_SEQUENCE_COUNT'][0]},{pkt['CCSDS_PACKET_LENGTH'][0]},{pkt['SHCOARSE'][0]},"
-                        + f"{pkt['PUS_SSUBTYPE'][0]},"
-                        + f"{pkt['COMPRESSION'][0]},"
-                        + f"{pkt['FOB_ACT'][0]},"
-                        + f"{pkt['FIB_ACT'][0]},"
-                        + f"{pkt['PRI_SENS'][0]},"
-                        + f"{pkt['PRI_VECSEC'][0]},"
-                        + f"{pkt['SEC_VECSEC'][0]},"
-                        + f"{pkt['PRI_COARSETM'][0]},"
-                        + f"{pkt['PRI_FNTM'][0]},"
-                        + f"{pkt['SEC_COARSETM'][0]},"
-                        + f"{pkt['SEC_FNTM'][0]}"
-                        + f",{met_utc}"
-                        + "\n"
-                    )
 
-            if limit > 0 and packet_counter >= limit:
-                print(f"Limit of {limit} packets reached")
-                break
+def _print_split_file(
+    packet_file: Path,
+    index: PacketIndex,
+    selected: np.ndarray,
+    limit: int,
+    counter: int,
+    summarise_only: bool,
+):
+    if limit > 0 and counter >= limit and len(selected) > 0:
+        print(f"Limit of {limit} packets reached")
 
     if not summarise_only:
         print(
-            f"Saved {packet_counter} packets from {packet_file} to {packet_file.parent} ({processed_bytes} bytes processed)"
+            f"Saved {counter} packets from {packet_file} to {packet_file.parent} ({_processed_bytes(index, selected, limit, counter)} bytes processed)"
+        )
+
+
+def _open_report_files(report_file_path: Path) -> tuple[TextIOWrapper, TextIOWrapper]:
+    """Open the packet report and the science report next to it to append to, writing
+    the header rows if they are new"""
+    headers = False
+    if not report_file_path.exists():
+        headers = True
+    report_file = open(report_file_path, "a")
+    if headers:
+        report_file.write("APID,Sequence Count,Length,SHCOURSE,MET_UTC\n")
+
+    sci_file = (
+        report_file_path.parent / f"{report_file_path.with_suffix('').name}_scionly.csv"
+    )
+    headers = False
+    if not sci_file.exists():
+        headers = True
+    sci_report_file = open(sci_file, "a")
+    if headers:
+        sci_report_file.write(
+            "APID,PHSEQCNT,PHDLEN,SHCOURSE,PUS_SSUBTYPE,COMPRESSION,FOB_ACT,FIB_ACT,PRI_SENS,PRI_VECSEC,SEC_VECSEC,PRI_COARSETM,PRI_FNTM,SEC_COARSETM,SEC_FNTM,MET_UTC\n"
+        )
+    return report_file, sci_report_file
+
+
+def _write_reports(
+    reader: PacketFileReader,
+    selected: np.ndarray,
+    report_file: TextIOWrapper,
+    sci_report_file: TextIOWrapper,
+):
+    """Add the selected packets to the packet report, and the science packets among them
+    to the science report. The rows are formatted from the index arrays
+    REPORT_BLOCK_ROWS at a time, rather than one packet at a time"""
+    index = reader.index
+    science_mask = index.science_mask()
+    for first in range(0, len(selected), REPORT_BLOCK_ROWS):
+        block = selected[first : first + REPORT_BLOCK_ROWS]
+        is_science = science_mask[block]
+        sci_headers = reader.science_headers(block[is_science])
+        columns = [
+            index.apid[block],
+            index.seq_count[block],
+            index.packet_length[block],
+            index.shcoarse[block],
+        ]
+        met_utc = _format_met_utc(get_met_from_shcourses(index.shcoarse[block]))
+
+        report_file.write(_format_csv_rows(columns + [met_utc]))
+        sci_report_file.write(
+            _format_csv_rows(
+                [column[is_science] for column in columns]
+                + [sci_headers[field] for field in SCIENCE_REPORT_FIELDS]
+                + [met_utc[is_science]]
+            )
+        )
+
+
+def _format_met_utc(met: np.ndarray) -> np.ndarray:
+    """datetime64 values as 'YYYY-MM-DD HH:MM:SS.mmm' strings"""
+    text = np.datetime_as_string(met.astype("datetime64[ms]"), unit="ms")
+    if len(text) == 0:
+        return text
+    # every string is the same length, so swap the 'T' for a space in place
+    text.view("U1").reshape(len(text), -1)[:, 10] = " "
+    return text
+
+
+def _format_csv_rows(columns: List[np.ndarray]) -> str:
+    """The columns as CSV rows, formatted by one % for all of the rows"""
+    rows = len(columns[0])
+    # interleave the columns into the order of the fields in the rows
+    values = [None] * (len(columns) * rows)
+    for i, column in enumerate(columns):
+        values[i :: len(columns)] = column.tolist()
+    return ((",".join(["%s"] * len(columns)) + "\n") * rows) % tuple(values)
+
+
+class _SplitFileWriter:
+    """
+    Saves packets to their own files from a pool of threads, with up to
+    SPLIT_WRITES_IN_FLIGHT writes queued. Each folder is listed once so a packet that
+    has been split already is found without a stat per packet, and files are created
+    exclusively so one that appears after the folder was listed is never overwritten.
+    """
+
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=SPLIT_WRITER_THREADS)
+        self.in_flight: deque[Future] = deque()
+        self.folder_files: dict[Path, set[str]] = {}
+        self.existing_packets = 0
+
+    def write(self, filename: Path, packet: memoryview):
+        files = self.folder_files.get(filename.parent)
+        if files is None:
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            files = set(os.listdir(filename.parent))
+            self.folder_files[filename.parent] = files
+
+        if filename.name in files:
+            self._existing_packet(filename)
+            return
+        files.add(filename.name)
+
+        self.in_flight.append(self.pool.submit(_write_new_file, filename, packet))
+        if len(self.in_flight) >= SPLIT_WRITES_IN_FLIGHT:
+            self._finish(self.in_flight.popleft())
+
+    def skip(self, filename: Path):
+        """Report a packet that has been split already without looking for its file"""
+        self._existing_packet(filename)
+
+    def close(self):
+        while self.in_flight:
+            self._finish(self.in_flight.popleft())
+        self.pool.shutdown()
+
+    def _finish(self, write: Future):
+        filename, created = write.result()
+        if not created:
+            self._existing_packet(filename)
+
+    def _existing_packet(self, filename: Path):
+        print(f"Existing packet found: {filename} - skipped it")
+        self.existing_packets += 1
+
+
+def _write_new_file(filename: Path, packet: memoryview) -> tuple[Path, bool]:
+    try:
+        with open(filename, "xb") as f:
+            f.write(packet)
+    except FileExistsError:
+        return filename, False
+    return filename, True
+
+
+def _append_packets_to_archives(
+    reader: PacketFileReader,
+    packet_file: Path,
+    selected: np.ndarray,
+    bucket: TimeBucket | None = None,
+):
+    """Append the selected packets to the archive for their ApID (and hour or day with
+    bucket), skipping packets that are already in it"""
+    global exit_code
+
+    index = reader.index
+    archive_ids = index.apid[selected].astype(np.int64)
+    if bucket is not None:
+        archive_ids = (archive_ids << 32) | (
+            index.shcoarse[selected] // BUCKET_SECONDS[bucket]
+        )
+    order = np.argsort(archive_ids, kind="stable")
+    archive_starts = np.flatnonzero(np.diff(archive_ids[order])) + 1
+    for positions in np.split(selected[order], archive_starts):
+        if len(positions) == 0:
+            continue
+        apid = int(index.apid[positions[0]])
+        name = (
+            str(apid)
+            if bucket is None
+            else _bucket_file_stem(apid, int(index.shcoarse[positions[0]]), bucket)
+        )
+        archive = PacketArchive(
+            packet_file.parent / str(apid) / f"{name}{ARCHIVE_SUFFIX}"
         )
+        keys = archive_keys(index.shcoarse[positions], index.seq_count[positions])
+        existing = np.ones(len(keys), dtype=bool)
+        existing[np.unique(keys, return_index=True)[1]] = False
+        existing |= np.isin(keys, archive.keys())
+
+        for shcoarse, seq_count in zip(
+            index.shcoarse[positions[existing]].tolist(),
+            index.seq_count[positions[existing]].tolist(),
+        ):
+            print(
+                f"Existing packet found: {shcoarse}-{seq_count} in {archive.path} - skipped it"
+            )
+            exit_code = 1
+
+        archive.append(reader.data, index, positions[~existing], packet_file)
+
+
+def _bucket_file_stem(apid: int, shcoarse: int, bucket: TimeBucket) -> str:
+    """<apid>_<start of the hour or day holding shcoarse>, naming the bucket files"""
+    bucket_start = get_met_from_shcourse(
+        shcoarse // BUCKET_SECONDS[bucket] * BUCKET_SECONDS[bucket]
+    )
+    return f"{apid}_{bucket_start.strftime(BUCKET_NAME_FORMATS[bucket])}"
+
+
+def _append_packets_to_buckets(
+    reader: PacketFileReader,
+    packet_file: Path,
+    selected: np.ndarray,
+    bucket: TimeBucket,
+    bucket_files: "_BucketFiles",
+):
+    """Append the selected packets, in the order they are in, to the file for their ApID
+    and hour or day, skipping packets that are already in it. The packets for each file
+    are written in one go"""
+    global exit_code
+
+    index = reader.index
+    bucket_ids = (index.apid[selected].astype(np.int64) << 32) | (
+        index.shcoarse[selected] // BUCKET_SECONDS[bucket]
+    )
+    order = np.argsort(bucket_ids, kind="stable")
+    bucket_starts = np.flatnonzero(np.diff(bucket_ids[order])) + 1
+    keys = index.keys()
+    for positions in np.split(selected[order], bucket_starts):
+        if len(positions) == 0:
+            continue
+        apid = int(index.apid[positions[0]])
+        stem = _bucket_file_stem(apid, int(index.shcoarse[positions[0]]), bucket)
+        filename = packet_file.parent / str(apid) / f"{stem}.bin"
+        new = bucket_files.new_packets(filename, keys[positions])
+
+        for shcoarse, seq_count in zip(
+            index.shcoarse[positions[~new]].tolist(),
+            index.seq_count[positions[~new]].tolist(),
+        ):
+            print(
+                f"Existing packet found: {shcoarse}-{seq_count} in {filename} - skipped it"
+            )
+            exit_code = 1
+
+        if np.any(new):
+            write_packets(
+                bucket_files.get(filename),
+                reader.data,
+                index,
+                positions[new],
+                packet_file,
+            )
+
+
+class _BucketFiles:
+    """
+    The files being appended to by split-packets --bucket, for the whole run (all the
+    files of a folder or glob), keeping at most BUCKET_OPEN_FILES open. The least
+    recently written one is closed to make room for another, and is opened again if more
+    packets for it turn up later. The keys of the packets in each file (read from the
+    file the first time it is used in the run) are kept after it is closed, to skip
+    packets that are already in it.
+    """
+
+    def __init__(self):
+        self.files: OrderedDict[Path, io.BufferedWriter] = OrderedDict()
+        self.packet_keys: dict[Path, PacketKeySet] = {}
+
+    def new_packets(self, filename: Path, keys: np.ndarray) -> np.ndarray:
+        """True for each packet key that is not in the file yet (nor earlier in keys),
+        which are then counted as being in it"""
+        packet_keys = self.packet_keys.get(filename)
+        if packet_keys is None:
+            packet_keys = self.packet_keys[filename] = PacketKeySet()
+            if filename.exists() and filename.stat().st_size > 0:
+                with PacketFileReader(filename) as existing:
+                    packet_keys.add(existing.index.keys())
+
+        new = packet_keys.first_seen(keys)
+        packet_keys.add(keys[new])
+        return new
+
+    def get(self, filename: Path) -> io.BufferedWriter:
+        file = self.files.get(filename)
+        if file is not None:
+            self.files.move_to_end(filename)
+            return file
+
+        if len(self.files) >= BUCKET_OPEN_FILES:
+            _, idle_file = self.files.popitem(last=False)
+            idle_file.close()
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        file = open_for_append(filename, buffering=BUCKET_FILE_BUFFER_BYTES)
+        self.files[filename] = file
+        return file
+
+    def close(self):
+        while self.files:
+            self.files.popitem()[1].close()
+
+
+def _split_packets_in_worker(
+    packet_file: str,
+    index: PacketIndex,
+    selected: np.ndarray,
+    no_report: bool,
+    split_before: np.ndarray | None,
+    use_mmap: bool,
+) -> tuple[str, str, str, int]:
+    """
+    Format the report rows for the packets selected from one file and, unless
+    split_before is None, save each of them to its own file. Returns the rows of the
+    two reports, what was printed and the number of packets found to exist already, so
+    they can be written out in file order.
+    """
+    report, sci_report, output = io.StringIO(), io.StringIO(), io.StringIO()
+    existing_packets = 0
+    with PacketFileReader(packet_file, use_mmap, index=index) as reader:
+        if not no_report:
+            _write_reports(reader, selected, report, sci_report)
+        if split_before is not None:
+            with contextlib.redirect_stdout(output):
+                existing_packets = _split_packets_to_files(
+                    reader, Path(packet_file), selected, split_before
+                )
+    return (
+        report.getvalue(),
+        sci_report.getvalue(),
+        output.getvalue(),
+        existing_packets,
+    )
+
+
+def _save_split_file(
+    packet_file: Path,
+    index: PacketIndex,
+    selected: np.ndarray,
+    result: tuple[str, str, str, int],
+    counter: int,
+    report_file_path: Path,
+    no_report: bool,
+    summarise_only: bool,
+    packed: bool,
+    bucket: TimeBucket | None,
+    limit: int,
+    use_mmap: bool,
+):
+    """Write out what a worker split from one file and append its packets to the
+    --packed or --bucket files, as _split_packets_in_one_file would"""
+    global exit_code
+
+    report, sci_report, output, existing_packets = result
+    if not no_report:
+        report_file, sci_report_file = _open_report_files(report_file_path)
+        with report_file, sci_report_file:
+            report_file.write(report)
+            sci_report_file.write(sci_report)
+
+    if not summarise_only and (packed or bucket is not None):
+        with PacketFileReader(packet_file, use_mmap, index=index) as reader:
+            _append_packets_to_files(reader, packet_file, selected, packed, bucket)
+
+    print(output, end="")
+    if existing_packets:
+        exit_code = 1
+
+    _print_split_file(packet_file, index, selected, limit, counter, summarise_only)
+
+
+def _split_packets_in_parallel(
+    filenames: List[str],
+    report_file_path: Path,
+    no_report: bool,
+    summarise_only: bool,
+    packed: bool,
+    bucket: TimeBucket | None,
+    limit: int,
+    mag_only: bool,
+    apid_filter: List[int],
+    use_mmap: bool,
+    use_index_cache: bool,
+    jobs: int,
+) -> int:
+    """
+    Split several files at once. The files are indexed in parallel, then the packets to
+    split from each file are chosen in file order (so --limit gives the same result as
+    a serial run, and a packet in more than one file is saved from the first) and each
+    file is split and reported on by a worker process. The reports are then written,
+    and the packets appended to any --packed or --bucket files, in file order.
+    """
+    global exit_code
+    global packet_counter
+
+    multifile_exit_code = 0
+    indexes = preload_packet_indexes(filenames, jobs, use_index_cache)
+    discard_preloaded_indexes()
+
+    split_to_files = not summarise_only and not packed and bucket is None
+    # folder -> the keys of the packets split into it from the files before
+    split_keys: dict[Path, PacketKeySet] = {}
+    splits = []
+
+    with create_process_pool(jobs) as pool:
+        for filename in filenames:
+            packet_file = Path(filename)
+            index = indexes[filename]
+            if isinstance(index, Exception):
+                splits.append((packet_file, index, None, index, packet_counter))
+                continue
+
+            if limit != 0 and packet_counter >= limit:
+                splits.append((packet_file, index, None, None, packet_counter))
+                continue
+
+            selected = index.select(mag_only, apid_filter)
+            if limit > 0:
+                selected = selected[: limit - packet_counter]
+
+            split_before = None
+            if split_to_files:
+                keys = index.keys()[selected]
+                folder_keys = split_keys.setdefault(packet_file.parent, PacketKeySet())
+                split_before = folder_keys.contains(keys)
+                folder_keys.add(keys)
+
+            packet_counter += len(selected)
+            split = pool.submit(
+                _split_packets_in_worker,
+                filename,
+                index,
+                selected,
+                no_report,
+                split_before,
+                use_mmap,
+            )
+            splits.append((packet_file, index, selected, split, packet_counter))
+
+        for packet_file, index, selected, split, counter in splits:
+            exit_code = 0
+            try:
+                if not no_report and report_file_path.exists() and not summarise_only:
+                    print(
+                        f"{report_file_path} already exists - will append to this file"
+                    )
+                if isinstance(split, Exception):
+                    raise split
+                if split is None:
+                    # the limit was reached in the files before
+                    continue
+
+                _save_split_file(
+                    packet_file,
+                    index,
+                    selected,
+                    split.result(),
+                    counter,
+                    report_file_path,
+                    no_report,
+                    summarise_only,
+                    packed,
+                    bucket,
+                    limit,
+                    use_mmap,
+                )
+                if exit_code != 0:
+                    multifile_exit_code = exit_code
+            except Exception as e:
+                print(f"Error processing {packet_file}: {e}", file=sys.stderr)
+                if multifile_exit_code == 0:
+                    multifile_exit_code = 1
+
+    return multifile_exit_code
 
 
 def _split_packets_in_multiple_files_from_glob(
-    globPath, ctx, report_file_path, no_report, summarise_only, limit, apids, mag_only
+    globPath,
+    ctx,
+    report_file_path,
+    no_report,
+    summarise_only,
+    packed,
+    bucket,
+    limit,
+    apids,
+    mag_only,
+    use_mmap,
+    use_index_cache,
+    jobs,
 ):
     multifile_exit_code = 0
     files = 0
     global is_multi_file
+    global bucket_files
     is_multi_file = True
-    for filename in glob.glob(globPath):
+    bucket_files = _BucketFiles()
+    filenames = [
+        filename
+        for filename in glob.glob(globPath)
+        if not filename.endswith(INDEX_CACHE_SUFFIX)
+    ]
+
+    if resolve_jobs(jobs) > 1 and len(filenames) > 1:
+        files = len(filenames)
+        try:
+            multifile_exit_code = _split_packets_in_parallel(
+                filenames,
+                report_file_path,
+                no_report,
+                summarise_only,
+                packed,
+                bucket,
+                limit,
+                mag_only,
+                parse_apids(apids),
+                use_mmap,
+                use_index_cache,
+                jobs,
+            )
+        finally:
+            bucket_files.close()
+        filenames = []
+
+    for filename in filenames:
         files += 1
         try:
             result = ctx.invoke(
@@ -265,9 +879,14 @@ def _split_packets_in_multiple_files_from_glob(
                 report_file_path=report_file_path,
                 no_report=no_report,
                 summarise_only=summarise_only,
+                packed=packed,
+                bucket=bucket,
                 limit=limit,
                 apids=apids,
                 mag_only=mag_only,
+                use_mmap=use_mmap,
+                use_index_cache=use_index_cache,
+                jobs=jobs,
             )
             if result and result.exit_code != 0:
                 multifile_exit_code = result.exit_code
@@ -278,6 +897,9 @@ def _split_packets_in_multiple_files_from_glob(
             if multifile_exit_code == 0:
                 multifile_exit_code = 1
 
+    bucket_files.close()
+    is_multi_file = False
+
     if files == 0:
         multifile_exit_code = 1
 
@@ -295,8 +917,6 @@ def _validate_split_packets_args(
     report_file_path,
     no_report: bool,
     summarise_only: bool,
-    limit: int,
-    apids: List[str] | None,
 ):
     if not data_file.exists():
         print(f"{data_file} does not exist")
@@ -309,6 +929,8 @@ def _validate_split_packets_args(
         print("data_file name is empty or invalid")
         raise typer.Abort()
 
+
+def _validate_split_packets_options(limit: int, apids: List[str] | None):
     if limit < 0:
         print("limit must be a positive integer")
         raise typer.Abort()
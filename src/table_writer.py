@@ -0,0 +1,303 @@
+import csv
+import os
+import shutil
+import struct
+import sys
+from collections import namedtuple
+from datetime import datetime, timezone
+from enum import Enum
+from itertools import chain, islice, repeat
+
+import numpy as np
+
+from flush_policy import WRITE_BUFFER_BYTES
+
+
+class OutputFormat(str, Enum):
+    csv = "csv"
+    npy = "npy"
+    parquet = "parquet"
+
+
+# sensor is "pri" or "sec" for values that only exist for that sensor's vectors, so with
+# mixed rates the rows after the last vector of the slower sensor are left empty
+Column = namedtuple("Column", ["name", "dtype", "sensor"])
+
+
+# rows buffered into each Parquet row group, so flushing every packet does not write
+# a tiny row group each time
+PARQUET_ROW_GROUP_ROWS = 65536
+
+
+def validate_output_format(output_format: OutputFormat) -> bool:
+    if output_format == OutputFormat.parquet and _import_pyarrow() is None:
+        print(
+            "Parquet output needs the pyarrow package - install the parquet extra with 'poetry install --extras parquet' (or 'pip install pyarrow')",
+            file=sys.stderr,
+        )
+        return False
+    return True
+
+
+def open_table_file(output_format: OutputFormat, filename: str, columns: list[Column]):
+    """
+    Open filename (which must end in the suffix for output_format) to append rows of
+    columns to, creating it if it does not exist yet
+    """
+    return _TABLE_FILES[output_format](filename, columns)
+
+
+def table_file_suffix(output_format: OutputFormat) -> str:
+    return _TABLE_FILES[output_format].suffix
+
+
+def append_table_file(source: str, target: str):
+    """Append the rows of one table file to another of the same format and columns"""
+    if source.endswith(_NpyTableFile.suffix):
+        _NpyTableFile.append_file(source, target)
+    elif source.endswith(_ParquetTableFile.suffix):
+        _ParquetTableFile.append_file(source, target)
+    else:
+        with open(source, "r") as rows, open(target, "a") as target_file:
+            rows.readline()  # header
+            shutil.copyfileobj(rows, target_file)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def _column_values(column: Column, value, rows: int, counts: dict[str, int]):
+    """A typed array of rows values for a column, and its valid rows (None if all valid)"""
+    count = rows if column.sensor is None else counts[column.sensor]
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        # datetime64 has no time zone so times are stored as UTC
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    values = np.zeros(rows, dtype=column.dtype)
+    values[:count] = value[:count] if isinstance(value, np.ndarray) else value
+    return values, (None if count == rows else np.arange(rows) < count)
+
+
+class _CsvTableFile:
+    suffix = ".csv"
+
+    def __init__(self, filename: str, columns: list[Column]):
+        self.columns = columns
+        self.exists_already = os.path.isfile(filename)
+        self.file = open(filename, "a", buffering=WRITE_BUFFER_BYTES)
+        self.writer = csv.writer(self.file)
+        if not self.exists_already:
+            self.writer.writerow([column.name for column in columns])
+
+    def write(self, rows: int, values: list, counts: dict[str, int]):
+        cells = []
+        for column, value in zip(self.columns, values):
+            if isinstance(value, np.ndarray) and value.dtype.kind == "M":
+                # datetime64 values are UTC, so write them like UTC datetimes
+                items = (d.replace(tzinfo=timezone.utc) for d in value.tolist())
+            elif isinstance(value, np.ndarray):
+                items = value.tolist()
+            else:
+                items = repeat(value)
+            count = rows if column.sensor is None else counts[column.sensor]
+            cells.append(chain(islice(items, count), repeat(None, rows - count)))
+        self.writer.writerows(zip(*cells))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def _read_npy_header(file) -> tuple[int, np.dtype, int]:
+    """Read the header of a .npy file opened for update, leaving it at the end of the file"""
+    np.lib.format.read_magic(file)
+    shape, _, dtype = np.lib.format.read_array_header_1_0(file)
+    header_bytes = file.tell()
+    file.seek(0, os.SEEK_END)
+    return shape[0], dtype, header_bytes
+
+
+def _npy_header_text(dtype: np.dtype, rows: int) -> str:
+    return repr(
+        {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": (rows,),
+        }
+    )
+
+
+def _write_npy_header(file, dtype: np.dtype, rows: int, header_bytes: int):
+    """
+    (Re)write a version 1.0 .npy header padded to header_bytes so the data after it
+    does not move as the row count grows
+    """
+    header = _npy_header_text(dtype, rows)
+    padding = header_bytes - 10 - len(header) - 1
+    if padding < 0:
+        raise ValueError(f"No room to update the header of {file.name}")
+    file.seek(0)
+    file.write(
+        np.lib.format.MAGIC_PREFIX
+        + b"\x01\x00"
+        + struct.pack("<H", header_bytes - 10)
+        + (header + " " * padding + "\n").encode("latin1")
+    )
+    file.seek(0, os.SEEK_END)
+
+
+class _NpyTableFile:
+    """
+    A .npy file holding a structured array with a field per column, plus a <sensor>_valid
+    field for each sensor that can have empty rows. The header has room for any row
+    count so rows can be streamed to the end of the file, and the file can be loaded
+    with np.load(filename, mmap_mode="r") without copying it.
+    """
+
+    suffix = ".npy"
+
+    def __init__(self, filename: str, columns: list[Column]):
+        self.columns = columns
+        sensors = list(dict.fromkeys(c.sensor for c in columns if c.sensor))
+        self.dtype = np.dtype(
+            [(column.name, column.dtype) for column in columns]
+            + [(f"{sensor}_valid", np.bool_) for sensor in sensors]
+        )
+        self.exists_already = os.path.isfile(filename)
+        if self.exists_already:
+            self.file = open(filename, "r+b", buffering=WRITE_BUFFER_BYTES)
+            self.rows, dtype, self.header_bytes = _read_npy_header(self.file)
+            if dtype != self.dtype:
+                raise ValueError(f"{filename} has different columns so cannot append")
+        else:
+            self.file = open(filename, "w+b", buffering=WRITE_BUFFER_BYTES)
+            self.rows = 0
+            # leave room in the header for the largest possible row count
+            largest = _npy_header_text(self.dtype, np.iinfo(np.int64).max)
+            self.header_bytes = -(-(10 + len(largest) + 1) // 64) * 64
+            _write_npy_header(self.file, self.dtype, 0, self.header_bytes)
+
+    def write(self, rows: int, values: list, counts: dict[str, int]):
+        records = np.zeros(rows, dtype=self.dtype)
+        for column, value in zip(self.columns, values):
+            records[column.name], valid = _column_values(column, value, rows, counts)
+            if column.sensor:
+                records[f"{column.sensor}_valid"] = True if valid is None else valid
+        self.file.write(records.tobytes())
+        self.rows += rows
+
+    def flush(self):
+        _write_npy_header(self.file, self.dtype, self.rows, self.header_bytes)
+        self.file.flush()
+
+    def close(self):
+        _write_npy_header(self.file, self.dtype, self.rows, self.header_bytes)
+        self.file.close()
+
+    @staticmethod
+    def append_file(source: str, target: str):
+        records = np.load(source, mmap_mode="r")
+        with open(target, "r+b") as target_file:
+            rows, dtype, header_bytes = _read_npy_header(target_file)
+            if dtype != records.dtype:
+                raise ValueError(f"{target} has different columns so cannot append")
+            target_file.write(records.tobytes())
+            _write_npy_header(target_file, dtype, rows + len(records), header_bytes)
+
+
+def _parquet_type(pa, dtype: np.dtype):
+    if dtype.kind == "M":
+        return pa.timestamp(np.datetime_data(dtype)[0], tz="UTC")
+    return pa.from_numpy_dtype(dtype)
+
+
+class _ParquetTableFile:
+    """
+    A Parquet file with a typed column per column, where empty rows are nulls. Rows are
+    buffered and written PARQUET_ROW_GROUP_ROWS at a time as one row group, with the
+    rest written when the file is closed. Flushing does nothing, as a Parquet file can
+    not be read until its footer is written on close anyway.
+    """
+
+    suffix = ".parquet"
+
+    def __init__(self, filename: str, columns: list[Column]):
+        pa = _import_pyarrow()
+        self.columns = columns
+        self.schema = pa.schema(
+            [(c.name, _parquet_type(pa, np.dtype(c.dtype))) for c in columns]
+        )
+        self.exists_already = os.path.isfile(filename)
+        existing = pa.parquet.read_table(filename) if self.exists_already else None
+        self.writer = pa.parquet.ParquetWriter(filename, self.schema)
+        if existing is not None:
+            # Parquet files cannot be appended to, so rewrite the existing rows first
+            self.writer.write_table(
+                existing.cast(self.schema), row_group_size=PARQUET_ROW_GROUP_ROWS
+            )
+        self.batches = []
+        self.buffered_rows = 0
+
+    def write(self, rows: int, values: list, counts: dict[str, int]):
+        pa = _import_pyarrow()
+        arrays = []
+        for column, value in zip(self.columns, values):
+            typed, valid = _column_values(column, value, rows, counts)
+            arrays.append(
+                pa.array(
+                    typed,
+                    type=self.schema.field(column.name).type,
+                    mask=None if valid is None else ~valid,
+                )
+            )
+        self.batches.append(pa.record_batch(arrays, schema=self.schema))
+        self.buffered_rows += rows
+        if self.buffered_rows >= PARQUET_ROW_GROUP_ROWS:
+            self._write_row_groups(final=False)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._write_row_groups(final=True)
+        self.writer.close()
+
+    def _write_row_groups(self, final: bool):
+        """Write the buffered rows as full row groups, keeping the rows left over unless
+        this is the final write"""
+        if not self.batches:
+            return
+        pa = _import_pyarrow()
+        table = pa.Table.from_batches(self.batches, self.schema)
+        rows = (
+            len(table)
+            if final
+            else len(table) // PARQUET_ROW_GROUP_ROWS * PARQUET_ROW_GROUP_ROWS
+        )
+        self.writer.write_table(
+            table.slice(0, rows), row_group_size=PARQUET_ROW_GROUP_ROWS
+        )
+        self.batches = table.slice(rows).to_batches()
+        self.buffered_rows = len(table) - rows
+
+    @staticmethod
+    def append_file(source: str, target: str):
+        pa = _import_pyarrow()
+        table = pa.concat_tables(
+            [pa.parquet.read_table(target), pa.parquet.read_table(source)]
+        )
+        pa.parquet.write_table(table, target)
+
+
+_TABLE_FILES = {
+    OutputFormat.csv: _CsvTableFile,
+    OutputFormat.npy: _NpyTableFile,
+    OutputFormat.parquet: _ParquetTableFile,
+}
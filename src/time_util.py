@@ -2,6 +2,8 @@ import re
 from datetime import datetime, timedelta
 from string import Formatter
 
+import numpy as np
+
 from constants import CONSTANTS
 
 
@@ -9,11 +11,35 @@ def get_met_from_shcourse(seconds_since_epoch: float) -> datetime:
     return CONSTANTS.IMAP_EPOCH + timedelta(seconds=seconds_since_epoch)
 
 
+def get_met_from_shcourses(seconds_since_epoch: np.ndarray) -> np.ndarray:
+    """get_met_from_shcourse for an array of whole seconds, as UTC datetime64[ms] values"""
+    epoch = np.datetime64(CONSTANTS.IMAP_EPOCH.replace(tzinfo=None), "ms")
+    return epoch + seconds_since_epoch.astype(np.int64).astype("timedelta64[s]")
+
+
 def get_met_from_sci_timestamp(course_time, fine_time) -> datetime:
     seconds_since_epoch = course_time + (fine_time / CONSTANTS.MAX_FINE_TIME)
     return CONSTANTS.IMAP_EPOCH + timedelta(seconds=seconds_since_epoch)
 
 
+def get_met_from_sci_timestamps(
+    course_times: np.ndarray, fine_times: np.ndarray
+) -> np.ndarray:
+    """
+    get_met_from_sci_timestamp for arrays of times, as UTC datetime64[us] values. The
+    fine time is rounded to the microsecond half to even, the same as timedelta does.
+    """
+    micros, remainder = np.divmod(
+        fine_times.astype(np.int64) * 1_000_000, CONSTANTS.MAX_FINE_TIME
+    )
+    half = CONSTANTS.MAX_FINE_TIME // 2
+    micros += (remainder > half) | ((remainder == half) & (micros % 2 == 1))
+    epoch = np.datetime64(CONSTANTS.IMAP_EPOCH.replace(tzinfo=None), "us")
+    return epoch + (course_times.astype(np.int64) * 1_000_000 + micros).astype(
+        "timedelta64[us]"
+    )
+
+
 def humanise_timedelta(
     tdelta, fmt="{D}d {H}h {M}m {S}s", strip_zeros=True, inputtype="timedelta"
 ):
@@ -98,3 +98,177 @@ def test_filter_packets_creates_output_with_sorted_packets():
     assert os.path.exists(output_file.absolute())
     assert ( f"Packet sorting needed in {output_file.absolute()} - rerun with --sort-packets" not in result.output)
     assert ( f"Sorted 3 packets in {output_file.absolute()} in result.output)")
+
+
+def test_filter_packets_sorts_files_bigger_than_max_memory_in_runs(tmp_path, monkeypatch):
+    import random
+
+    from ccsdspy.utils import iter_packet_bytes
+
+    import filter_packets
+    from packet_dedupe import PacketKeySet
+    from packet_sort import sort_packet_file
+
+    packets = list(iter_packet_bytes(f"{SAMPLE_DATA_FOLDER}/ialirt/sc_packets_1443038138000000_to_1443053061000000.bin"))
+    random.Random(0).shuffle(packets)
+    with open(tmp_path / "shuffled.bin", "wb") as f:
+        f.write(b"".join(packets))
+
+    # the packets seen are remembered between commands in the same process
+    monkeypatch.setattr(filter_packets, "unique_packets", PacketKeySet())
+    monkeypatch.setattr(filter_packets, "packet_counter", 0)
+    # the filtered packets are sorted by their index and written once
+    result = runner.invoke(
+        app,
+        ["filter-packets", "--all", "--sort-packets", "--max-memory", "1MB"]
+        + ["--output-file", str(tmp_path / "one-pass.bin"), str(tmp_path / "shuffled.bin")],
+    )
+    print(result.output)
+    assert result.exit_code == 0
+    assert f"Sorted {len(packets)} packets" in result.output
+
+    # 2.6MB of packets sorted in 512KB runs, which takes more than one merge pass
+    for name, max_memory in [("in-memory.bin", 1 << 30), ("external.bin", 1 << 20)]:
+        assert sort_packet_file(tmp_path / "shuffled.bin", tmp_path / name, max_memory) == len(packets)
+
+    with open(tmp_path / "one-pass.bin", "rb") as one_pass:
+        sorted_packets = one_pass.read()
+    for name in ["in-memory.bin", "external.bin"]:
+        with open(tmp_path / name, "rb") as f:
+            assert f.read() == sorted_packets
+    assert sorted(os.listdir(tmp_path)) == ["external.bin", "in-memory.bin", "one-pass.bin", "shuffled.bin"]
+
+    result = runner.invoke(app, command_start_params[0:4] + ["--max-memory", "lots", command_start_params[4]])
+    assert result.exit_code != 0
+    assert "max-memory must be a size" in result.output
+
+
+@pytest.mark.parametrize(
+    "value, size",
+    [
+        ("4096k", 4 << 20),
+        ("4096KB", 4 << 20),
+        ("4k", None),
+        ("512m", 512 << 20),
+        ("512M", 512 << 20),
+        ("512 MB", 512 << 20),
+        ("2G", 2 << 30),
+        ("1.5gb", 3 << 29),
+        ("1t", 1 << 40),
+        ("1048576", 1 << 20),
+        ("lots", None),
+        ("12x", None),
+        ("1mbb", None),
+        ("-1GB", None),
+        ("512", None),
+    ],
+)
+def test_parse_memory_size(value, size):
+    from packet_sort import parse_memory_size
+
+    assert parse_memory_size(value) == size
+
+
+def test_filter_packets_dedupes_against_output_file_with_dedupe_store(tmp_path, monkeypatch):
+    import filter_packets
+    from packet_dedupe import PacketKeySet
+
+    output = tmp_path / "archive.bin"
+    for packet_file, saved in [
+        ("mag_l0_test_data.pkts", 36),
+        ("mag_l0_test_data.pkts", 0),
+        ("mag_l0_missordered.pkts", 3),
+    ]:
+        # each command is a new run, so only the dedupe store knows what is in the output
+        monkeypatch.setattr(filter_packets, "unique_packets", PacketKeySet())
+        monkeypatch.setattr(filter_packets, "packet_counter", 0)
+        result = runner.invoke(
+            app,
+            ["filter-packets", "--all", "--dedupe-store", "--output-file", str(output)]
+            + [f"{SAMPLE_DATA_FOLDER}/{packet_file}"],
+        )
+        print(result.output)
+        assert result.exit_code == 0
+        assert f"Saved {saved} packets" in result.output
+
+    assert os.path.getsize(output) == 38608 + 1988
+    assert os.path.exists(f"{output}.pktkeys")
+
+    # a store that no longer matches the output file is rebuilt from it
+    with open(output, "ab") as f:
+        f.write(open(f"{SAMPLE_DATA_FOLDER}/mag_l0_missordered.pkts", "rb").read())
+    monkeypatch.setattr(filter_packets, "unique_packets", PacketKeySet())
+    result = runner.invoke(
+        app,
+        ["filter-packets", "--all", "--dedupe-store", "--output-file", str(output)]
+        + [f"{SAMPLE_DATA_FOLDER}/mag_l0_missordered.pkts"],
+    )
+    assert result.exit_code == 0
+    assert "is out of date - rebuilding it" in result.output
+    assert os.path.getsize(output) == 38608 + 1988 * 2
+
+
+def test_filter_packets_reports_conflicting_duplicates(tmp_path):
+    from ccsdspy.utils import iter_packet_bytes
+
+    packets = list(iter_packet_bytes(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts"))
+    corrupted = bytearray(packets[5])
+    corrupted[-1] ^= 0xFF
+    (tmp_path / "input").mkdir()
+    # a true duplicate and a conflicting one in the same file, then the same in a later file
+    with open(tmp_path / "input" / "a.bin", "wb") as f:
+        f.write(b"".join(packets + [packets[3], bytes(corrupted)]))
+    with open(tmp_path / "input" / "b.bin", "wb") as f:
+        f.write(packets[7] + bytes(corrupted))
+
+    result = runner.invoke(
+        app,
+        ["filter-packets", "--all", "--check-conflicts", "--output-file", str(tmp_path / "output.bin")]
+        + [str(tmp_path / "input" / "*.bin")],
+    )
+
+    print(result.output)
+    assert result.exit_code == 0
+    assert "Duplicate packet found - ApID: 0x42c Seq Count: 3 SHCOARSE: 435954640" in result.output
+    assert "Duplicate packet found - ApID: 0x42c Seq Count: 7 SHCOARSE: 435954656" in result.output
+    assert result.output.count("Conflicting duplicate packet found - ApID: 0x42c Seq Count: 5 SHCOARSE: 435954648") == 2
+    assert "Skipped 1 packets in" in result.output
+    assert os.path.getsize(tmp_path / "output.bin") == 38608
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--all"],
+        ["--all", "--limit", "40"],
+        ["--all", "--check-conflicts"],
+        ["--all", "--dedupe-store"],
+        ["--all", "--sort-packets", "--limit", "50"],
+    ],
+)
+def test_filter_packets_jobs_gives_the_same_output_as_a_serial_run(tmp_path, options):
+    import shutil
+
+    folder = tmp_path / "in"
+    folder.mkdir()
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", folder / "a.bin")
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_missordered.pkts", folder / "b.bin")
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", folder / "c.bin")
+
+    messages = {}
+    for name, jobs in [("serial", "1"), ("parallel", "2")]:
+        output_file = tmp_path / name / "output.bin"
+        result = runner.invoke(
+            app, ["filter-packets", *options, "--jobs", jobs, "-o", str(output_file), str(folder)]
+        )
+        print(result.output)
+        assert result.exit_code == 0
+        messages[name] = [
+            line.replace(name, "")
+            for line in result.output.splitlines()
+            if not line.startswith(("Processing", "Writing"))
+        ]
+
+    assert (tmp_path / "serial" / "output.bin").read_bytes() == (tmp_path / "parallel" / "output.bin").read_bytes()
+    assert messages["serial"] == messages["parallel"]
+    assert not [path for path in (tmp_path / "parallel").iterdir() if path.name.startswith(".filter-packets-")]
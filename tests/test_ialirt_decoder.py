@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Tests for `ialirt_decoder`."""
+# pylint: disable=redefined-outer-name
+
+import time
+
+from src.flush_policy import parse_flush_policy
+from src.ialirt_decoder import Vector, _IALIRTFileWriter, _QuartetReorderBuffer
+from src.time_util import get_met_from_sci_timestamp
+
+
+def _write_row(writer, coarse):
+    writer.write(
+        Vector(1, 2, 3, 0),
+        Vector(4, 5, 6, 1),
+        coarse,
+        0,
+        coarse,
+        0,
+        get_met_from_sci_timestamp(coarse, 0),
+        get_met_from_sci_timestamp(coarse, 0),
+    )
+
+
+def _rows_on_disk(writer):
+    with open(writer.filename) as f:
+        return len(f.readlines()) - 1
+
+
+def test_ialirt_writer_flushes_within_latency_budget_without_more_rows(tmp_path):
+    writer = _IALIRTFileWriter(str(tmp_path), "mag", parse_flush_policy("latency:50ms"))
+
+    _write_row(writer, 497857222)
+    _write_row(writer, 497857226)
+    # rows are coalesced rather than flushed as they are written
+    assert writer.idleTimer is not None
+
+    deadline = time.monotonic() + 5
+    while _rows_on_disk(writer) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert _rows_on_disk(writer) == 2
+    assert writer.idleTimer is None
+
+    _write_row(writer, 497857230)
+    writer.close()
+    assert writer.idleTimer is None
+    assert _rows_on_disk(writer) == 3
+
+
+def test_quartet_reorder_buffer_counts_dropped_packets_and_incomplete_groups():
+    buffer = _QuartetReorderBuffer(window=4)
+
+    # a group with its packets out of order, then one missing its counter 2 packet
+    released = []
+    for seq_count, counter in [(101, 1), (100, 0), (103, 3), (102, 2), (102, 2)]:
+        released += buffer.add(seq_count, 1000, counter, bytes([counter]))
+    for seq_count, counter in [(104, 0), (105, 1), (107, 3)]:
+        released += buffer.add(seq_count, 1000, counter, bytes([counter]))
+
+    assert released == [[b"\x00", b"\x01", b"\x02", b"\x03"]]
+    assert buffer.dropped_packets == 1
+
+    # the incomplete group is given up on once the window has passed
+    for seq_count in range(108, 116):
+        released += buffer.add(seq_count, 1000, seq_count % 4, bytes([seq_count]))
+    assert buffer.incomplete_groups == 1
+    assert len(released) == 3
+
+    assert buffer.drain() == []
+
+    # a group can span the wrap of the sequence count
+    buffer = _QuartetReorderBuffer(window=4)
+    released = []
+    for seq_count, counter in [(16383, 1), (16382, 0), (0, 2), (1, 3)]:
+        released += buffer.add(seq_count, 1000, counter, bytes([counter]))
+    assert released == [[b"\x00", b"\x01", b"\x02", b"\x03"]]
+
+
+def test_batch_decode_matches_the_reorder_buffer_around_gaps_and_reordering(tmp_path):
+    import numpy as np
+
+    from src.constants import CONSTANTS
+    from src.ialirt_decoder import IALIRTDecoder
+
+    rng = np.random.default_rng(3)
+    packets = []
+    seq_count = 16300  # wraps part way through
+    shcoarse = 1000
+    for group in range(400):
+        if group == 200:
+            shcoarse += 5000  # a new pass
+        quartet = []
+        for counter in range(4):
+            mag_data = bytearray(rng.integers(0, 256, 12, np.uint8).tobytes())
+            mag_data[6] = (counter << 6) | (mag_data[6] & 0x3F)
+            quartet.append(((seq_count + counter) % 16384, shcoarse, bytes(mag_data)))
+        seq_count += 4
+        shcoarse += 1
+        if rng.random() < 0.1:
+            quartet.pop(int(rng.integers(4)))  # lost packet
+        if rng.random() < 0.1:
+            rng.shuffle(quartet)  # reordered packets
+        if rng.random() < 0.05:
+            quartet.append(quartet[0])  # repeated packet
+        packets += quartet
+    # a packet arriving a few groups late
+    packets.insert(900, packets.pop(880))
+
+    data = b"".join(
+        (0x0800 | CONSTANTS.APID_MAG_IALIRT).to_bytes(2, "big")
+        + (0xC000 | seq).to_bytes(2, "big")
+        + (17).to_bytes(2, "big")
+        + coarse.to_bytes(4, "big")
+        + mag_data
+        + bytes(2)
+        for seq, coarse, mag_data in packets
+    )
+
+    written = []
+    decoder = IALIRTDecoder(str(tmp_path))
+    decoder._write_records = lambda mag_data: written.append(mag_data.copy())
+    decoder.extract_packets_to_csv(
+        CONSTANTS.APID_MAG_IALIRT,
+        np.frombuffer(data, np.uint8),
+        np.arange(len(packets)) * 24,
+        np.full(len(packets), 24),
+        np.array([seq for seq, _, _ in packets], np.uint16),
+        np.array([coarse for _, coarse, _ in packets], np.uint32),
+    )
+
+    expected = []
+    buffer = _QuartetReorderBuffer()
+    for seq, coarse, mag_data in packets:
+        for group in buffer.add(seq, coarse, mag_data[6] >> 6, mag_data):
+            expected.append(b"".join(group))
+
+    assert np.concatenate(written).tobytes() == b"".join(expected)
+    assert decoder.reorder_buffer.dropped_packets == buffer.dropped_packets
+    assert decoder.reorder_buffer.incomplete_groups == buffer.incomplete_groups
+    assert len(expected) > 300
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Tests for `join-packets`."""
+# pylint: disable=redefined-outer-name
+
+import shutil
+from pathlib import Path
+
+from typer.testing import CliRunner
+
+from src.main import app
+
+runner = CliRunner()
+SAMPLE_DATA_FOLDER = "sample-data"
+
+
+def split_into(folder: Path, sample: str, *options: str):
+    folder.mkdir()
+    packet_file = folder / Path(sample).name
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/{sample}", packet_file)
+    result = runner.invoke(app, ["split-packets", "--all", "--no-report", *options, str(packet_file)])
+    assert result.exit_code == 0
+
+
+def test_join_packets_matches_filter_packets_sort_packets(tmp_path):
+    split_into(tmp_path / "files", "mag_l0_test_data.pkts")
+    split_into(tmp_path / "packed", "mag_l0_missordered.pkts", "--packed")
+
+    result = runner.invoke(
+        app,
+        ["join-packets", "--all", "-o", str(tmp_path / "joined.bin"), str(tmp_path / "files"), str(tmp_path / "packed")],
+    )
+
+    print(result.stdout)
+    assert result.exit_code == 0
+    assert "Joined 39 packets" in result.stdout
+
+    with open(tmp_path / "both.bin", "wb") as f:
+        f.write(Path(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts").read_bytes())
+        f.write(Path(f"{SAMPLE_DATA_FOLDER}/mag_l0_missordered.pkts").read_bytes())
+    runner.invoke(
+        app,
+        ["filter-packets", "--all", "--sort-packets", "-o", str(tmp_path / "filtered.bin"), str(tmp_path / "both.bin")],
+    )
+    assert (tmp_path / "joined.bin").read_bytes() == (tmp_path / "filtered.bin").read_bytes()
+
+
+def test_join_packets_keeps_one_of_each_packet(tmp_path):
+    split_into(tmp_path / "first", "mag_l0_test_data.pkts")
+    split_into(tmp_path / "second", "mag_l0_test_data.pkts", "--packed")
+    output_file = tmp_path / "joined.bin"
+
+    result = runner.invoke(
+        app,
+        ["join-packets", "--all", "-o", str(output_file), str(tmp_path / "first"), str(tmp_path / "second")],
+    )
+
+    print(result.stdout)
+    assert result.exit_code == 0
+    assert "Skipped 36 duplicate packets" in result.stdout
+    assert "Joined 36 packets" in result.stdout
+    assert output_file.stat().st_size == 38608
+
+    # the output file is not overwritten without --force
+    result = runner.invoke(app, ["join-packets", "--all", "-o", str(output_file), str(tmp_path / "first")])
+    assert result.exit_code != 0
+    assert "already exists" in result.output
+
+    result = runner.invoke(
+        app, ["join-packets", "--all", "--apid", "1052", "--force", "-o", str(output_file), str(tmp_path / "first")]
+    )
+    assert result.exit_code == 0
+    assert "Joined 17 packets" in result.stdout
+
+
+def test_join_packets_gives_the_same_output_with_few_bytes_in_flight(tmp_path, monkeypatch):
+    import join_packets
+
+    split_into(tmp_path / "files", "mag_l0_test_data.pkts")
+    split_into(tmp_path / "packed", "mag_l0_missordered.pkts", "--packed")
+    folders = [str(tmp_path / "files"), str(tmp_path / "packed")]
+    runner.invoke(app, ["join-packets", "--all", "-o", str(tmp_path / "joined.bin"), *folders])
+
+    # small reads of the archives, and only one read waiting to be written at a time
+    monkeypatch.setattr(join_packets, "JOIN_READ_BYTES", 2000)
+    monkeypatch.setattr(join_packets, "JOIN_READ_BYTES_IN_FLIGHT", 1)
+    result = runner.invoke(app, ["join-packets", "--all", "-o", str(tmp_path / "bounded.bin"), *folders])
+
+    assert result.exit_code == 0
+    assert (tmp_path / "bounded.bin").read_bytes() == (tmp_path / "joined.bin").read_bytes()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Tests for `packet_dedupe`."""
+# pylint: disable=redefined-outer-name
+
+import numpy as np
+
+from src.packet_dedupe import PacketKeySet, PacketKeyStore
+
+
+def _keys(apid, shcoarse, seq_count):
+    return (
+        (np.asarray(apid, dtype=np.uint64) << np.uint64(46))
+        | (np.asarray(shcoarse, dtype=np.uint64) << np.uint64(14))
+        | np.asarray(seq_count, dtype=np.uint64)
+    )
+
+
+def test_packet_key_set_matches_a_python_set():
+    rng = np.random.default_rng(0)
+    key_set = PacketKeySet()
+    seen = set()
+
+    # enough batches of keys, with duplicates within and between them, to grow the table
+    for _ in range(20):
+        keys = _keys(rng.integers(1000, 1100, 500), rng.integers(0, 5, 500), rng.integers(0, 50, 500))
+        expected = []
+        for key in keys.tolist():
+            expected.append(key not in seen)
+            seen.add(key)
+
+        assert key_set.first_seen(keys).tolist() == expected
+        key_set.add(keys)
+
+    assert len(key_set) == len(seen)
+    assert all(key in key_set for key in seen)
+
+
+def test_packet_key_set_forgets_keys_outside_the_window():
+    key_set = PacketKeySet(window_seconds=60)
+
+    for second in range(0, 36000, 10):
+        key_set.add(_keys(1000, second + np.zeros(100, dtype=int), np.arange(100)))
+
+    assert int(_keys(1000, 35990, 0)) in key_set
+    assert int(_keys(1000, 35990 - 60, 0)) in key_set
+    assert int(_keys(1000, 35990 - 70, 0)) not in key_set
+    # 360,000 keys added but only those in the last minute are kept
+    assert len(key_set) < 2000
+
+
+def test_packet_key_store_keeps_few_runs_as_keys_are_added(tmp_path):
+    packet_file = tmp_path / "archive.bin"
+    store = PacketKeyStore(packet_file)
+    added = []
+
+    for batch in range(100):
+        keys = _keys(1000, batch, np.arange(10))
+        assert not store.contains(keys).any()
+        # the packets are appended to the archive before their keys are added
+        with open(packet_file, "ab") as f:
+            f.write(b"\0" * 10)
+        store.add(keys)
+        added.extend(keys.tolist())
+
+    store = PacketKeyStore(packet_file)
+    assert len(store) == len(added)
+    assert store.contains(np.array(added, dtype=np.uint64)).all()
+    assert len(store._runs) <= 8
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Tests for `packet_index`."""
+# pylint: disable=redefined-outer-name
+
+import io
+import os
+import shutil
+
+import numpy as np
+import pytest
+from ccsdspy.utils import iter_packet_bytes
+
+from src import packet_index
+from src.packet_index import (
+    PacketFileReader,
+    index_packet_file,
+    load_index_cache,
+    open_for_append,
+    read_science_headers,
+    write_packets,
+)
+from src.packet_util import get_imap_basic_packet_def, get_imap_science_packet_def
+
+SAMPLE_DATA_FOLDER = "sample-data"
+
+
+def test_packet_index_matches_ccsdspy_headers():
+    packet_file = f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts"
+    data, index = index_packet_file(packet_file)
+
+    assert len(index) == 36
+    assert index.total_bytes == 38608
+
+    pktDefinition = get_imap_basic_packet_def()
+    for i, packet_bytes in enumerate(iter_packet_bytes(packet_file)):
+        pkt = pktDefinition.load(io.BytesIO(packet_bytes), include_primary_header=True)
+        assert index.apid[i] == pkt["CCSDS_APID"][0]
+        assert index.seq_count[i] == pkt["CCSDS_SEQUENCE_COUNT"][0]
+        assert index.packet_length[i] == pkt["CCSDS_PACKET_LENGTH"][0]
+        assert index.shcoarse[i] == pkt["SHCOARSE"][0]
+        assert data[index.offset[i] : index.offset[i] + index.length[i]].tobytes() == (
+            packet_bytes
+        )
+
+
+def test_packet_index_reads_science_headers():
+    packet_file = f"{SAMPLE_DATA_FOLDER}/mag_l0_missordered.pkts"
+    data, index = index_packet_file(packet_file)
+    headers = read_science_headers(data, index.offset)
+
+    sciDefinition = get_imap_science_packet_def()
+    for i, packet_bytes in enumerate(iter_packet_bytes(packet_file)):
+        pkt = sciDefinition.load(io.BytesIO(packet_bytes), include_primary_header=True)
+        for field, values in headers.items():
+            assert values[i] == pkt[field][0], field
+
+
+def test_packet_index_selects_by_apid():
+    _, index = index_packet_file(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts")
+
+    assert len(index.select(True, [])) == 36
+    assert len(index.select(False, [0x41C])) == 17
+    assert np.all(index.apid[index.select(False, [1068])] == 1068)
+
+
+def test_packet_file_reader_returns_views_into_the_file():
+    packet_file = f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts"
+
+    with PacketFileReader(packet_file) as mapped, PacketFileReader(
+        packet_file, use_mmap=False
+    ) as in_memory:
+        assert len(mapped) == len(in_memory) == 36
+        for i, packet_bytes in enumerate(iter_packet_bytes(packet_file)):
+            view = mapped.packet(i)
+            assert isinstance(view, memoryview)
+            assert view.tobytes() == packet_bytes
+            assert in_memory.packet(i, 6).tobytes() == packet_bytes[6:]
+
+
+def test_packet_index_cache_is_reused_until_file_changes(tmp_path):
+    packet_file = tmp_path / "mag_l0_test_data.pkts"
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", packet_file)
+    cache_file = tmp_path / "mag_l0_test_data.pkts.pktidx"
+
+    assert load_index_cache(packet_file) is None
+
+    with PacketFileReader(packet_file, use_index_cache=True) as reader:
+        built = reader.index
+        built_science = reader.science_headers(reader.index.science_mask().nonzero()[0])
+
+    assert cache_file.exists()
+    cached = load_index_cache(packet_file)
+    assert cached is not None
+    assert np.array_equal(cached.offset, built.offset)
+    assert np.array_equal(cached.shcoarse, built.shcoarse)
+
+    with PacketFileReader(packet_file, use_index_cache=True) as reader:
+        science = reader.science_headers(reader.index.science_mask().nonzero()[0])
+        for field, values in built_science.items():
+            assert np.array_equal(science[field], values)
+
+    # a changed file invalidates the index
+    with open(packet_file, "ab") as f:
+        f.write(b"\x00")
+    os.utime(packet_file, ns=(0, 0))
+    assert load_index_cache(packet_file) is None
+
+
+def test_write_packets_copies_runs_of_packets_from_the_file(tmp_path, monkeypatch):
+    packet_file = f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts"
+    data, index = index_packet_file(packet_file)
+    # the last half of the packets, then the first half reversed
+    positions = list(range(18, 36)) + list(range(17, -1, -1))
+
+    with open(tmp_path / "written.bin", "wb") as f:
+        written = write_packets(f, data, index, positions)
+
+    # copy every run in the kernel, however short
+    monkeypatch.setattr(packet_index, "KERNEL_COPY_MIN_BYTES", 0)
+    with open(tmp_path / "copied.bin", "wb") as f:
+        copied = write_packets(f, data, index, positions, packet_file)
+
+    assert written == copied == index.total_bytes
+    assert (tmp_path / "written.bin").read_bytes() == (tmp_path / "copied.bin").read_bytes()
+
+
+@pytest.mark.parametrize("copy_function", ["_copy_file_range", "_sendfile", "_read_and_write"])
+def test_write_packets_copies_in_the_kernel_when_appending(tmp_path, monkeypatch, copy_function):
+    if not hasattr(packet_index, copy_function):
+        pytest.skip(f"no {copy_function} on this platform")
+    packet_file = f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts"
+    data, index = index_packet_file(packet_file)
+    positions = list(range(18, 36)) + list(range(0, 18))
+    output_file = tmp_path / "appended.bin"
+    output_file.write_bytes(b"existing")
+
+    # only this way of copying, which raises rather than falling back if it fails
+    monkeypatch.setattr(packet_index, "KERNEL_COPY_MIN_BYTES", 0)
+    monkeypatch.setattr(packet_index, "_COPY_FUNCTIONS", (getattr(packet_index, copy_function),))
+    with open_for_append(output_file) as f:
+        write_packets(f, data, index, positions, packet_file)
+    with open_for_append(output_file) as f:
+        write_packets(f, data, index, positions[:1], packet_file)
+
+    packets = list(iter_packet_bytes(packet_file))
+    expected = b"existing" + b"".join(packets[position] for position in positions) + packets[18]
+    assert output_file.read_bytes() == expected
+
+
+def test_write_packets_copies_without_pread(tmp_path, monkeypatch):
+    packet_file = f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts"
+    data, index = index_packet_file(packet_file)
+    positions = list(range(17, -1, -1))
+
+    # as on Windows
+    monkeypatch.delattr(os, "pread", raising=False)
+    monkeypatch.setattr(packet_index, "KERNEL_COPY_MIN_BYTES", 0)
+    monkeypatch.setattr(packet_index, "_COPY_FUNCTIONS", (packet_index._read_and_write,))
+    with open(tmp_path / "copied.bin", "wb") as f:
+        write_packets(f, data, index, positions, packet_file)
+
+    packets = list(iter_packet_bytes(packet_file))
+    assert (tmp_path / "copied.bin").read_bytes() == b"".join(packets[position] for position in positions)
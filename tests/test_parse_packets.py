@@ -2,11 +2,14 @@
 """Tests for `check-gaps`."""
 # pylint: disable=redefined-outer-name
 
+import csv
 import glob
 import json
 import os
+import shutil
 from pathlib import Path
 
+import numpy as np
 import pytest
 from typer.testing import CliRunner
 
@@ -118,3 +121,209 @@ def test_parse_packets_errors_when_zero_packets():
     print(result.output)
     assert result.exit_code != 0
     assert "Zero packets parsed" in result.output
+
+
+@pytest.mark.parametrize("flush", ["close", "10", "5s", "latency:50ms"])
+def test_parse_packets_results_match_expected_with_flush_policy(flush):
+    global output_file_glob
+
+    result = runner.invoke(app, command_start_params[0:3] + ["--flush", flush] + command_start_params[3:])
+
+    print(result.output)
+    assert result.exit_code == 0
+
+    with open(glob.glob(output_file_glob).pop(), "r") as actual, open(
+        f"{SAMPLE_DATA_FOLDER}/mag-l0-l1a-t003-out.csv", "r"
+    ) as expected:
+        assert actual.readlines() == expected.readlines()
+
+
+def test_parse_packets_rejects_unknown_flush_policy():
+    result = runner.invoke(app, command_start_params[0:3] + ["--flush", "sometimes"] + command_start_params[3:])
+
+    print(result.output)
+    assert result.exit_code != 0
+    assert "flush must be" in result.output
+
+
+def _expected_rows():
+    with open(f"{SAMPLE_DATA_FOLDER}/mag-l0-l1a-t003-out.csv", "r") as expected:
+        reader = csv.DictReader(expected)
+        return reader.fieldnames, list(reader)
+
+
+def test_parse_packets_writes_npy_that_can_be_appended_to_and_memory_mapped():
+    output_file_npy = output_file_glob.replace(".csv", ".npy")
+    params = command_start_params[0:3] + ["--format", "npy"] + command_start_params[3:]
+
+    for run in range(2):
+        result = runner.invoke(app, params)
+        print(result.output)
+        assert result.exit_code == 0
+
+    assert "Appending to existing normal data file" in result.output
+    data = np.load(glob.glob(output_file_npy).pop(), mmap_mode="r")
+    columns, expected_rows = _expected_rows()
+    assert len(data) == 2 * len(expected_rows)
+    assert data["x_pri"].dtype == np.int32
+    assert data["pri_valid"].all() and data["sec_valid"].all()
+    for row, expected in zip(data, expected_rows * 2):
+        assert [str(row[column]) for column in columns] == [expected[column] for column in columns]
+
+
+def test_parse_packets_writes_parquet():
+    pq = pytest.importorskip("pyarrow.parquet")
+    output_file_parquet = output_file_glob.replace(".csv", ".parquet")
+
+    result = runner.invoke(app, command_start_params[0:3] + ["--format", "parquet"] + command_start_params[3:])
+
+    print(result.output)
+    assert result.exit_code == 0
+    table = pq.read_table(glob.glob(output_file_parquet).pop()).to_pylist()
+    columns, expected_rows = _expected_rows()
+    assert [[str(row[column]) for column in columns] for row in table] == [
+        [expected[column] for column in columns] for expected in expected_rows
+    ]
+
+
+def test_parse_packets_writes_parquet_in_full_row_groups(monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    import table_writer
+
+    monkeypatch.setattr(table_writer, "PARQUET_ROW_GROUP_ROWS", 5)
+    output_file_parquet = output_file_glob.replace(".csv", ".parquet")
+
+    # the rows of every packet are flushed, but only whole row groups are written
+    result = runner.invoke(
+        app, command_start_params[0:3] + ["--format", "parquet", "--flush", "packet"] + command_start_params[3:]
+    )
+
+    assert result.exit_code == 0
+    metadata = pq.ParquetFile(glob.glob(output_file_parquet).pop()).metadata
+    group_rows = [metadata.row_group(group).num_rows for group in range(metadata.num_row_groups)]
+    assert metadata.num_rows == len(_expected_rows()[1]) > 5
+    assert group_rows[:-1] == [5] * (len(group_rows) - 1)
+    assert 0 < group_rows[-1] <= 5
+
+
+def test_parse_packets_in_parallel_matches_serial_output(tmp_path):
+    input_folder = tmp_path / "input"
+    input_folder.mkdir()
+    shutil.copy("sample-data/mag_l0_test_data.pkts", input_folder / "a.bin")
+    shutil.copy("sample-data/mag_l0_test_data.pkts", input_folder / "b.bin")
+    shutil.copy("sample-data/mag_l0_missordered.pkts", input_folder / "c.bin")
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag-l0-l1a-t003-in.bin", input_folder / "d.bin")
+
+    for name, jobs in [("serial", "1"), ("parallel", "3")]:
+        (tmp_path / name).mkdir()
+        result = runner.invoke(
+            app,
+            ["parse-packets", "--jobs", jobs, "-o", str(tmp_path / name)]
+            + [str(input_folder)],
+        )
+        print(result.output)
+        assert result.exit_code == 0
+
+    serial_files = sorted(os.listdir(tmp_path / "serial"))
+    assert serial_files == sorted(os.listdir(tmp_path / "parallel"))
+    assert len(serial_files) == 4
+    for name in serial_files:
+        with open(tmp_path / "serial" / name) as serial, open(
+            tmp_path / "parallel" / name
+        ) as parallel:
+            assert serial.read() == parallel.read()
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_parse_packets_rejects_an_invalid_apid_for_a_folder(tmp_path, jobs):
+    input_folder = tmp_path / "input"
+    input_folder.mkdir()
+    shutil.copy("sample-data/mag_l0_test_data.pkts", input_folder / "a.bin")
+    shutil.copy("sample-data/mag_l0_test_data.pkts", input_folder / "b.bin")
+
+    result = runner.invoke(
+        app, ["parse-packets", "--jobs", jobs, "--apid", "xyz", "-o", str(tmp_path), str(input_folder)]
+    )
+
+    assert result.exit_code != 0
+    assert "Invalid APID: xyz" in result.output
+    assert not glob.glob(f"{tmp_path}/*.csv")
+
+
+def test_parse_packets_decodes_one_file_in_parallel(tmp_path, monkeypatch):
+    import parse_packets
+
+    # use small chunks so the sample file is split across several workers
+    monkeypatch.setattr(parse_packets, "MIN_SCIENCE_CHUNK", 4)
+
+    for name, jobs in [("serial", "1"), ("parallel", "3")]:
+        (tmp_path / name).mkdir()
+        result = runner.invoke(
+            app,
+            ["parse-packets", "--jobs", jobs, "-o", str(tmp_path / name)]
+            + ["sample-data/mag_l0_test_data.pkts"],
+        )
+        print(result.output)
+        assert result.exit_code == 0
+
+    serial_files = sorted(os.listdir(tmp_path / "serial"))
+    assert serial_files == sorted(os.listdir(tmp_path / "parallel"))
+    for name in serial_files:
+        with open(tmp_path / "serial" / name) as serial, open(
+            tmp_path / "parallel" / name
+        ) as parallel:
+            assert serial.read() == parallel.read()
+
+
+def test_parse_packets_decodes_ialirt_the_same_as_one_packet_at_a_time(tmp_path):
+    from ccsdspy.utils import iter_packet_bytes
+
+    from ialirt_decoder import IALIRTDecoder
+
+    packet_file = "sample-data/ialirt/mag_packets_1443038138000000_to_1443053061000000.bin"
+    (tmp_path / "batch").mkdir()
+    (tmp_path / "single").mkdir()
+
+    result = runner.invoke(
+        app, ["parse-packets", "-o", str(tmp_path / "batch"), packet_file]
+    )
+    print(result.output)
+    assert result.exit_code == 0
+
+    decoder = IALIRTDecoder(str(tmp_path / "single"), "mag")
+    for packet_bytes in iter_packet_bytes(packet_file):
+        decoder.extract_packet_to_csv(0x3E9, packet_bytes)
+    decoder.close_all()
+
+    batch_files = sorted(os.listdir(tmp_path / "batch"))
+    assert batch_files == sorted(os.listdir(tmp_path / "single"))
+    assert len(batch_files) == 1
+    with open(tmp_path / "batch" / batch_files[0]) as batch, open(
+        tmp_path / "single" / batch_files[0]
+    ) as single:
+        assert batch.read() == single.read()
+
+
+def test_parse_packets_reassembles_reordered_ialirt_packets(tmp_path):
+    from ccsdspy.utils import iter_packet_bytes
+
+    packet_file = "sample-data/ialirt/mag_packets_1443038138000000_to_1443053061000000.bin"
+    packets = list(iter_packet_bytes(packet_file))
+    # swap neighbouring packets, as a ground station merge might
+    for i in range(0, len(packets) - 1, 3):
+        packets[i], packets[i + 1] = packets[i + 1], packets[i]
+    with open(tmp_path / "reordered.bin", "wb") as f:
+        f.write(b"".join(packets))
+
+    for name, input_file in [("in-order", packet_file), ("reordered", str(tmp_path / "reordered.bin"))]:
+        (tmp_path / name).mkdir()
+        result = runner.invoke(app, ["parse-packets", "-o", str(tmp_path / name), input_file])
+        print(result.output)
+        assert result.exit_code == 0
+
+    files = sorted(os.listdir(tmp_path / "in-order"))
+    assert files == sorted(os.listdir(tmp_path / "reordered"))
+    with open(tmp_path / "in-order" / files[0]) as in_order, open(
+        tmp_path / "reordered" / files[0]
+    ) as reordered:
+        assert in_order.read() == reordered.read()
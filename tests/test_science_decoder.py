@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Tests for `science_decoder`."""
+# pylint: disable=redefined-outer-name
+
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from src.science_decoder import MAGScienceDecoder, _BitReader
+
+
+def _vectors(block):
+    return list(zip(*(column.tolist() for column in block)))
+
+
+def _unpack_with_bit_reader(vector_data, total_vecs):
+    reader = _BitReader(vector_data)
+    vectors = []
+    for _ in range(total_vecs):
+        vector = []
+        for bits in (16, 16, 16, 2):
+            value = reader.read(bits)
+            if bits == 16:
+                value = MAGScienceDecoder._twos_complement(value, 16)
+            vector.append(value)
+        vectors.append(tuple(vector))
+    return vectors
+
+
+def test_bit_reader_reads_fields_of_any_width():
+    rng = np.random.default_rng(3)
+    vector_data = rng.integers(0, 256, 40, np.uint8).tobytes()
+    bit_string = "".join(f"{byte:08b}" for byte in vector_data)
+    widths = rng.integers(1, 65, 20).tolist()
+
+    reader = _BitReader(vector_data)
+    cursor = 0
+    for width in widths:
+        if cursor + width > len(bit_string):
+            with pytest.raises(IndexError):
+                reader.read(width)
+            break
+        assert reader.read(width) == int(bit_string[cursor : cursor + width], 2)
+        cursor += width
+
+    reader = _BitReader(vector_data)
+    reader.read(3)
+    reader.align_to_byte()
+    assert reader.read_fields(2, 8).tolist() == [
+        int(bit_string[8 + 2 * i : 10 + 2 * i], 2) for i in range(8)
+    ]
+    assert reader.cursor == 24
+
+
+def test_uncompressed_vectors_match_bit_reader():
+    rng = np.random.default_rng(42)
+    for total_pri_vecs, total_sec_vecs in [(4, 4), (8, 2), (16, 16), (2, 1)]:
+        total_vecs = total_pri_vecs + total_sec_vecs
+        vector_data = rng.integers(0, 256, -(-total_vecs * 50 // 8), np.uint8).tobytes()
+        expected = _unpack_with_bit_reader(vector_data, total_vecs)
+
+        primary, secondary = MAGScienceDecoder._unpackUncompressedVectors(
+            total_pri_vecs, total_sec_vecs, memoryview(vector_data)
+        )
+
+        assert primary.x.dtype == np.int32 and primary.rng.dtype == np.uint8
+        assert _vectors(primary) == expected[:total_pri_vecs]
+        assert _vectors(secondary) == expected[total_pri_vecs:]
+
+
+def test_uncompressed_columns_unpack_a_batch_of_packets():
+    rng = np.random.default_rng(7)
+    payloads = rng.integers(0, 256, (5, 50), np.uint8)
+
+    x, y, z, r = MAGScienceDecoder._unpackUncompressedColumns(payloads, 8)
+
+    assert x.shape == (5, 8)
+    for i, payload in enumerate(payloads):
+        expected = _unpack_with_bit_reader(payload.tobytes(), 8)
+        assert list(zip(x[i], y[i], z[i], r[i])) == expected
+
+
+def test_uncompressed_vectors_fail_on_a_truncated_payload():
+    vector_data = bytes(range(63))  # exactly 10 vectors
+
+    MAGScienceDecoder._unpackUncompressedVectors(8, 2, memoryview(vector_data))
+    with pytest.raises(IndexError):
+        MAGScienceDecoder._unpackUncompressedVectors(8, 2, memoryview(vector_data[:62]))
+    with pytest.raises(IndexError):
+        MAGScienceDecoder._unpackUncompressedColumns(np.zeros((3, 40), np.uint8), 8)
+
+
+def _compress_sensor(vectors, width, hdr_after):
+    bits = ""
+    for value in vectors[0][:3]:
+        bits += f"{value & ((1 << width) - 1):0{width}b}"
+    bits += f"{vectors[0][3]:02b}"
+    for i in range(1, len(vectors)):
+        for axis in range(3):
+            if i > hdr_after:
+                bits += f"{vectors[i][axis] & ((1 << width) - 1):0{width}b}"
+            else:
+                delta = vectors[i][axis] - vectors[i - 1][axis]
+                bits += MAGScienceDecoder._fibonacci_encode(
+                    MAGScienceDecoder._zigzag_encode(delta)
+                )
+    return bits
+
+
+def test_compressed_vectors_decode_deltas_and_switch_to_full_width_after_hdr(capsys):
+    width = 18
+    primary = [(100, -200, 300, 2)] + [
+        (100 + i, -200 - 3 * i, 300 + (i % 5), i % 4) for i in range(1, 8)
+    ]
+    # a big jump in vector 4 is too wide to compress so the rest is sent full width
+    primary[4] = (100000, -100000, 100000, 0)
+    secondary = [(-5, 5, 0, 1)] + [(-5 - i, 5 + i, i, 3 - i % 4) for i in range(1, 4)]
+
+    bits = _compress_sensor(primary, width, 4) + _compress_sensor(secondary, width, 99)
+    bits += "0" * (-len(bits) % 8)
+    for vector in primary[1:] + secondary[1:]:
+        bits += f"{vector[3]:02b}"
+    bits += "0" * (-len(bits) % 8)
+    vector_data = int(bits, 2).to_bytes(len(bits) // 8, "big")
+
+    decoded_primary, decoded_secondary = MAGScienceDecoder._unpackCompressedVectors(
+        8, 4, memoryview(vector_data), width, True, 0, datetime(2025, 1, 1)
+    )
+
+    assert _vectors(decoded_primary) == primary
+    assert _vectors(decoded_secondary) == secondary
+    assert "HDR detected in primary sensor after 4 vectors" in capsys.readouterr().out
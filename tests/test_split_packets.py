@@ -79,3 +79,285 @@ def test_split_packets_creates_one_file_per_packet():
 
     assert len(glob.glob(f"{SAMPLE_DATA_FOLDER}/1068/*.bin")) == 19
     assert len(glob.glob(f"{SAMPLE_DATA_FOLDER}/1052/*.bin")) == 17
+
+
+def test_split_packets_packed_writes_one_archive_per_apid(tmp_path):
+    import shutil
+
+    from ccsdspy.utils import iter_packet_bytes
+
+    from packet_archive import PacketArchive
+
+    packet_file = tmp_path / "packets.bin"
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", packet_file)
+
+    result = runner.invoke(app, ["split-packets", "--all", "--packed", "--no-report", str(packet_file)])
+
+    print(result.stdout)
+    assert result.exit_code == 0
+    assert sorted(os.listdir(tmp_path / "1068")) == ["1068.pkts", "1068.pkts.pktoff"]
+    assert sorted(os.listdir(tmp_path / "1052")) == ["1052.pkts", "1052.pkts.pktoff"]
+
+    archive = PacketArchive(tmp_path / "1052" / "1052.pkts")
+    assert len(archive) == 17
+    packets = list(iter_packet_bytes(str(packet_file)))
+    for shcoarse, seq_count in archive.records[["shcoarse", "seq_count"]].tolist():
+        assert archive.read_packet(shcoarse, seq_count) in packets
+
+    # packets already in the archives are not appended again
+    result = runner.invoke(app, ["split-packets", "--all", "--packed", "--no-report", str(packet_file)])
+    assert result.exit_code == 1
+    assert "Existing packet found" in result.stdout
+    assert len(PacketArchive(tmp_path / "1052" / "1052.pkts")) == 17
+
+
+def test_packet_archive_rebuilds_a_lost_index_from_the_packets(tmp_path):
+    import shutil
+
+    from packet_archive import PacketArchive
+
+    packet_file = tmp_path / "packets.bin"
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", packet_file)
+    runner.invoke(app, ["split-packets", "--all", "--packed", "--no-report", str(packet_file)])
+    archive_file = tmp_path / "1052" / "1052.pkts"
+    records = PacketArchive(archive_file).records
+    archived = archive_file.read_bytes()
+
+    os.remove(tmp_path / "1052" / "1052.pkts.pktoff")
+    archive = PacketArchive(archive_file)
+
+    assert archive_file.read_bytes() == archived
+    assert (archive.records == records).all()
+    assert (tmp_path / "1052" / "1052.pkts.pktoff").stat().st_size == records.nbytes
+    record = records[5]
+    assert archive.read_packet(int(record["shcoarse"]), int(record["seq_count"])) == archived[
+        record["offset"] : record["offset"] + record["length"]
+    ]
+    assert archive.read_packet(0, 0) is None
+
+    # a packet cut off part way through is trimmed off
+    with open(archive_file, "ab") as f:
+        f.write(archived[:10])
+    assert len(PacketArchive(archive_file)) == 17
+    assert archive_file.read_bytes() == archived
+
+
+def test_split_packets_never_overwrites_existing_packet_files(tmp_path):
+    import shutil
+
+    from split_packets import _SplitFileWriter
+
+    packet_file = tmp_path / "packets.bin"
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", packet_file)
+    runner.invoke(app, ["split-packets", "--all", "--no-report", str(packet_file)])
+
+    result = runner.invoke(app, ["split-packets", "--all", "--no-report", str(packet_file)])
+    assert result.exit_code == 1
+    assert result.stdout.count("Existing packet found") == 36
+
+    # a file that appears after its folder was listed is found when it is created
+    writer = _SplitFileWriter()
+    writer.write(tmp_path / "new" / "1.bin", memoryview(b"first"))
+    with open(tmp_path / "new" / "2.bin", "wb") as f:
+        f.write(b"not a packet")
+    writer.write(tmp_path / "new" / "2.bin", memoryview(b"second"))
+    writer.close()
+
+    assert writer.existing_packets == 1
+    assert (tmp_path / "new" / "1.bin").read_bytes() == b"first"
+    assert (tmp_path / "new" / "2.bin").read_bytes() == b"not a packet"
+
+
+def test_split_packets_report_rows_match_the_packet_headers(tmp_path, monkeypatch):
+    import csv
+
+    from ccsdspy.utils import iter_packet_bytes
+
+    import split_packets
+    from time_util import get_met_from_shcourse
+
+    # format the reports several blocks at a time
+    monkeypatch.setattr(split_packets, "REPORT_BLOCK_ROWS", 5)
+    report = tmp_path / "packets.csv"
+    result = runner.invoke(
+        app,
+        ["split-packets", "--all", "--summarise", "--report", str(report), f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts"],
+    )
+
+    assert result.exit_code == 0
+    with open(report) as f:
+        rows = list(csv.DictReader(f))
+    packets = list(iter_packet_bytes(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts"))
+    assert len(rows) == len(packets) == 36
+    for row, packet in zip(rows, packets):
+        assert int(row["APID"]) == int.from_bytes(packet[0:2], "big") & 0x7FF
+        assert int(row["Sequence Count"]) == int.from_bytes(packet[2:4], "big") & 0x3FFF
+        assert int(row["Length"]) == int.from_bytes(packet[4:6], "big")
+        shcoarse = int.from_bytes(packet[6:10], "big")
+        assert int(row["SHCOURSE"]) == shcoarse
+        assert row["MET_UTC"] == get_met_from_shcourse(shcoarse).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+    with open(tmp_path / "packets_scionly.csv") as f:
+        sci_rows = list(csv.DictReader(f))
+    assert len(sci_rows) == 36
+    assert [row["MET_UTC"] for row in sci_rows] == [row["MET_UTC"] for row in rows]
+
+
+def test_split_packets_bucket_appends_packets_to_one_file_per_apid_and_hour(tmp_path, monkeypatch):
+    import shutil
+    from collections import defaultdict
+
+    from ccsdspy.utils import iter_packet_bytes
+
+    import split_packets
+    from time_util import get_met_from_shcourse
+
+    # close files to make room for others as often as possible
+    monkeypatch.setattr(split_packets, "BUCKET_OPEN_FILES", 1)
+    packet_file = tmp_path / "packets.bin"
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", packet_file)
+
+    result = runner.invoke(app, ["split-packets", "--all", "--no-report", "--bucket", "hour", str(packet_file)])
+
+    print(result.stdout)
+    assert result.exit_code == 0
+    expected = defaultdict(bytes)
+    for packet in iter_packet_bytes(str(packet_file)):
+        apid = int.from_bytes(packet[0:2], "big") & 0x7FF
+        hour = get_met_from_shcourse(int.from_bytes(packet[6:10], "big")).strftime("%Y-%m-%d_%H")
+        expected[f"{apid}/{apid}_{hour}.bin"] += packet
+    written = {
+        os.path.relpath(filename, tmp_path): Path(filename).read_bytes()
+        for filename in glob.glob(f"{tmp_path}/*/*.bin")
+    }
+    assert written == expected
+
+    # packets already in the bucket files are not appended again
+    result = runner.invoke(app, ["split-packets", "--all", "--no-report", "--bucket", "hour", str(packet_file)])
+    assert result.exit_code == 1
+    assert result.stdout.count("Existing packet found") == 36
+    for filename, packets in expected.items():
+        assert (tmp_path / filename).read_bytes() == packets
+
+
+def test_split_packets_bucket_reads_each_bucket_file_once_per_folder(tmp_path, monkeypatch):
+    import shutil
+
+    import split_packets
+
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", tmp_path / "a.bin")
+    result = runner.invoke(app, ["split-packets", "--all", "--no-report", "--bucket", "day", str(tmp_path / "a.bin")])
+    assert result.exit_code == 0
+    bucket_files = sorted(glob.glob(f"{tmp_path}/*/*.bin"))
+    written = [Path(filename).read_bytes() for filename in bucket_files]
+
+    # the packets of a.bin are in b.bin and c.bin too
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", tmp_path / "b.bin")
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", tmp_path / "c.bin")
+    opened = []
+    reader = split_packets.PacketFileReader
+
+    def counting_reader(packet_file, *args, **kwargs):
+        opened.append(str(packet_file))
+        return reader(packet_file, *args, **kwargs)
+
+    monkeypatch.setattr(split_packets, "PacketFileReader", counting_reader)
+    result = runner.invoke(app, ["split-packets", "--all", "--no-report", "--bucket", "day", str(tmp_path)])
+
+    print(result.stdout)
+    assert result.exit_code == 1
+    assert result.stdout.count("Existing packet found") == 3 * 36
+    assert [Path(filename).read_bytes() for filename in bucket_files] == written
+    # the existing bucket files are read once for the whole folder, not once per input
+    assert sorted(filename for filename in opened if filename in bucket_files) == bucket_files
+
+
+def test_split_packets_packed_with_bucket_writes_one_archive_per_apid_and_day(tmp_path):
+    import shutil
+
+    from packet_archive import PacketArchive
+
+    packet_file = tmp_path / "packets.bin"
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", packet_file)
+
+    result = runner.invoke(app, ["split-packets", "--all", "--no-report", "--packed", "--bucket", "day", str(packet_file)])
+
+    print(result.stdout)
+    assert result.exit_code == 0
+    assert sorted(os.listdir(tmp_path / "1052")) == ["1052_2023-10-25.pkts", "1052_2023-10-25.pkts.pktoff"]
+    assert len(PacketArchive(tmp_path / "1052" / "1052_2023-10-25.pkts")) == 17
+    assert len(PacketArchive(tmp_path / "1068" / "1068_2023-10-25.pkts")) == 19
+
+
+def test_split_packets_counts_the_packets_of_each_run_from_zero():
+    # a second run in the same process is not cut short by the --limit of the first
+    for _ in range(2):
+        result = runner.invoke(
+            app,
+            ["split-packets", "--all", "--summarise", "--no-report", "--limit", "10", f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts"],
+        )
+
+        print(result.stdout)
+        assert result.exit_code == 0
+        assert "Limit of 10 packets reached" in result.stdout
+
+
+def test_split_packets_of_one_file_after_a_folder_is_a_run_of_its_own(tmp_path):
+    import shutil
+
+    shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", tmp_path / "a.bin")
+    result = runner.invoke(app, ["split-packets", "--all", "--summarise", "--no-report", str(tmp_path)])
+    assert result.exit_code == 0
+
+    report = tmp_path / "report.csv"
+    result = runner.invoke(
+        app, ["split-packets", "--all", "--summarise", "--report", str(report), str(tmp_path / "a.bin")]
+    )
+
+    print(result.stdout)
+    assert result.exit_code == 0
+    assert f"Packet summary saved to {report}" in result.stdout
+    assert len(report.read_text().splitlines()) == 37
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        [],
+        ["--limit", "40"],
+        ["--summarise"],
+        ["--bucket", "hour"],
+        ["--packed"],
+    ],
+)
+def test_split_packets_jobs_gives_the_same_output_as_a_serial_run(tmp_path, options):
+    import shutil
+
+    outputs = {}
+    for name, jobs in [("serial", "1"), ("parallel", "2")]:
+        folder = tmp_path / name
+        folder.mkdir()
+        shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", folder / "a.bin")
+        shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_missordered.pkts", folder / "b.bin")
+        # the packets of a.bin again, which are reported as existing
+        shutil.copy(f"{SAMPLE_DATA_FOLDER}/mag_l0_test_data.pkts", folder / "c.bin")
+        report = tmp_path / f"{name}.csv"
+
+        result = runner.invoke(
+            app, ["split-packets", "--all", *options, "--jobs", jobs, "--report", str(report), str(folder)]
+        )
+
+        print(result.stdout)
+        files = {
+            os.path.relpath(filename, folder): Path(filename).read_bytes()
+            for filename in glob.glob(f"{folder}/*/*")
+        }
+        messages = [
+            line.replace(name, "")
+            for line in result.stdout.splitlines()
+            if not line.startswith("Processing")
+        ]
+        reports = [report.read_text(), (tmp_path / f"{name}_scionly.csv").read_text()]
+        outputs[name] = (result.exit_code, files, messages, reports)
+
+    assert outputs["serial"] == outputs["parallel"]